@@ -0,0 +1,124 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the per-block RPC cost of picking the hat contender.
+
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/approval_scan.py --yays 100 1000 --blocks 200
+
+Three strategies run against the same simulated DS-Chief activity: the original loop (one
+`get_approvals` call per yay), a batched full scan and the incremental `ApprovalIndex`.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from web3 import Web3, HTTPProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+from rpc_node import FakeChief, StandInNode  # noqa: E402
+
+from chief_keeper.approvals import ApprovalIndex, ApprovalReader  # noqa: E402
+
+from pymaker import Address  # noqa: E402
+from pymaker.governance import DSChief  # noqa: E402
+
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+
+
+def address(i: int) -> str:
+    return Web3.toChecksumAddress("0x" + f"{i + 1:040x}")
+
+
+def build_chief(node: StandInNode, yay_count: int, voter_count: int) -> FakeChief:
+    chief = FakeChief(node, CHIEF, block=1)
+    chief.yays = [address(i) for i in range(yay_count)]
+    chief.voters = [address(10**6 + i) for i in range(voter_count)]
+
+    rng = random.Random(1)
+    for voter in chief.voters:
+        chief.lock(voter, rng.randint(1, 1000) * 10**18)
+        chief.vote(voter, rng.sample(chief.yays, min(3, yay_count)))
+    chief.lift(chief.yays[0])
+    chief.mine()
+    return chief
+
+
+def legacy_loop(chief: FakeChief, ds_chief: DSChief):
+    hat = ds_chief.get_hat().address
+    highest = ds_chief.get_approvals(hat)
+    for yay in chief.yays:
+        approvals = ds_chief.get_approvals(yay)
+        if approvals > highest:
+            highest = approvals
+
+
+def run(strategy: str, yay_count: int, blocks: int, activity: float) -> dict:
+    node = StandInNode().start()
+    try:
+        chief = build_chief(node, yay_count, voter_count=max(10, yay_count // 10))
+        web3 = Web3(HTTPProvider(node.url))
+        ds_chief = DSChief(web3, Address(CHIEF))
+        reader = ApprovalReader(web3, ds_chief)
+        index = ApprovalIndex(web3, reader, lambda slate: list(chief.slates[slate]))
+        rng = random.Random(2)
+
+        node.reset_counters()
+        started = time.perf_counter()
+        for _ in range(blocks):
+            chief.mine()
+            if rng.random() < activity:
+                voter = rng.choice(chief.voters)
+                chief.vote(voter, rng.sample(chief.yays, min(3, yay_count)))
+
+            if strategy == "loop":
+                legacy_loop(chief, ds_chief)
+            elif strategy == "batch":
+                reader.read(chief.yays, chief.block)
+            else:
+                index.update(chief.yays, chief.block)
+                index.contender()
+        elapsed = time.perf_counter() - started
+
+        return {
+            "round_trips": node.round_trips / blocks,
+            "calls": sum(node.calls.values()) / blocks,
+            "ms": elapsed * 1000 / blocks,
+        }
+    finally:
+        node.stop()
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("approval-scan-benchmark")
+    parser.add_argument("--yays", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--activity", type=float, default=0.1, help="Probability of a vote in any given block")
+    arguments = parser.parse_args(args)
+
+    print(f"{'yays':>6} {'strategy':>8} {'round-trips/block':>18} {'calls/block':>12} {'ms/block':>9}")
+    for yay_count in arguments.yays:
+        for strategy in ["loop", "batch", "index"]:
+            result = run(strategy, yay_count, arguments.blocks, arguments.activity)
+            print(f"{yay_count:>6} {strategy:>8} {result['round_trips']:>18.1f} {result['calls']:>12.1f} {result['ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,170 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the time from starting the keeper process to the end of its first block, with and without a fast start.
+
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/cold_start.py --yays 1000 --blocks 100000
+
+Each mode starts a fresh interpreter against a stand-in node serving DS-Chief and DS-Pause at their mainnet
+addresses, with `--yays` etched yays spread over `--blocks` blocks. `full` builds the whole `DssDeployment`
+and backfills the database, as the keeper did before `--fast-start`; `fast` only builds DS-Chief and DS-Pause
+(`--fast-start`) and creates the database from a snapshot (`--snapshot`). The first block is the read path of
+`check_hat` and `check_eta`: bringing yays and etas up to the head and picking the hat contender.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from web3 import Web3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+NETWORK = "coldstart"
+
+
+def child(mode: str, url: str, snapshot: str):
+    """Runs in the spawned interpreter; prints the end of each start-up phase as a wall-clock timestamp"""
+    phases = {}
+
+    from web3 import HTTPProvider
+    from chief_keeper.approvals import ApprovalIndex, ApprovalReader
+    from chief_keeper.database import SimpleDatabase
+    from chief_keeper.deployment import ChiefDeployment
+    phases["imports"] = time.time()
+
+    web3 = Web3(HTTPProvider(url))
+    if mode == "fast":
+        dss = ChiefDeployment.from_network(web3, "mainnet")
+    else:
+        from pymaker.deployment import DssDeployment
+        dss = DssDeployment.from_network(web3, "mainnet")
+    phases["deployment"] = time.time()
+
+    database = SimpleDatabase(web3, 0, NETWORK, dss, snapshot=snapshot if mode == "fast" else None)
+    database.create()
+    phases["database"] = time.time()
+
+    block = web3.eth.blockNumber
+    database.update_db_yays(block)
+    database.update_db_etas(block)
+    index = ApprovalIndex(web3, ApprovalReader(web3, dss.ds_chief), database.get_slate_yays)
+    index.update(database.get_db_yays(), block)
+    index.contender()
+    database.close()
+    phases["first_block"] = time.time()
+
+    print(json.dumps(phases))
+
+
+def mainnet_addresses() -> dict:
+    import pymaker
+    path = os.path.join(os.path.dirname(os.path.realpath(pymaker.__file__)), "..", "config", "mainnet-addresses.json")
+    with open(path) as f:
+        return json.load(f)
+
+
+def database_files() -> list:
+    import chief_keeper
+    directory = os.path.join(os.path.dirname(os.path.abspath(chief_keeper.__file__)), "database")
+    return [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(f"db_{NETWORK}.")]
+
+
+def build_chain(yay_count: int, blocks: int):
+    from rpc_node import FakeChief, FakePause, StandInNode
+
+    addresses = mainnet_addresses()
+    node = StandInNode()
+    chief = FakeChief(node, addresses["MCD_ADM"], block=1)
+    FakePause(node, addresses["MCD_PAUSE"], block=1)
+
+    yays = [Web3.toChecksumAddress("0x" + f"{i + 1:040x}") for i in range(yay_count)]
+    for yay in yays:
+        chief.etch([yay])
+        chief.mine(max(1, blocks // yay_count))
+    chief.lift(yays[0])
+    node.handlers["eth_getBlockByNumber"] = lambda params: {"number": hex(chief.block), "timestamp": hex(0),
+                                                           "hash": "0x" + f"{chief.block:064x}",
+                                                           "parentHash": "0x" + f"{chief.block - 1:064x}"}
+    node.handlers["eth_chainId"] = lambda params: hex(1)
+    return node.start(), chief, yays, addresses
+
+
+def write_snapshot_for(chief, yays: list, addresses: dict, path: str):
+    from chief_keeper.snapshot import write_snapshot
+    from chief_keeper.storage import TinyDBStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = TinyDBStore(os.path.join(directory, "db.json"))
+        store.initialize(chief.block, yays, {}, chief.block)
+        write_snapshot(store, path, NETWORK, addresses["MCD_ADM"])
+        store.close()
+
+
+def run(mode: str, url: str, snapshot: str) -> dict:
+    for path in database_files():
+        os.remove(path)
+
+    spawned = time.time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, "--url", url,
+                             "--snapshot-path", snapshot], check=True, capture_output=True, text=True).stdout
+    phases = json.loads(output.strip().splitlines()[-1])
+
+    result, previous = {}, spawned
+    for phase in ["imports", "deployment", "database", "first_block"]:
+        result[phase] = (phases[phase] - previous) * 1000
+        previous = phases[phase]
+    result["total"] = (phases["first_block"] - spawned) * 1000
+    return result
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("cold-start-benchmark")
+    parser.add_argument("--yays", type=int, default=1000)
+    parser.add_argument("--blocks", type=int, default=100000, help="Blocks between the DS-Chief deployment and the head")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--url", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--snapshot-path", type=str, default=None, help=argparse.SUPPRESS)
+    arguments = parser.parse_args(args)
+
+    if arguments.child is not None:
+        child(arguments.child, arguments.url, arguments.snapshot_path)
+        return
+
+    node, chief, yays, addresses = build_chain(arguments.yays, arguments.blocks)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = os.path.join(directory, "snapshot.json")
+            write_snapshot_for(chief, yays, addresses, snapshot)
+
+            print(f"{'mode':>5} {'imports ms':>11} {'deployment ms':>14} {'database ms':>12} {'first block ms':>15} {'total ms':>9}")
+            for mode in ["full", "fast"]:
+                result = run(mode, node.url, snapshot)
+                print(f"{mode:>5} {result['imports']:>11.0f} {result['deployment']:>14.0f} {result['database']:>12.0f} "
+                      f"{result['first_block']:>15.0f} {result['total']:>9.0f}")
+    finally:
+        node.stop()
+        for path in database_files():
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the steady-state cost per block of building the gas strategy eagerly and lazily.
+
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/gas_strategy.py --blocks 200 --tip-latency 0.1
+
+The tip source is a stand-in node answering `eth_feeHistory` after `--tip-latency` seconds. `eager` fetches
+the tip and builds a `GeometricGasPrice` on every block, as `check_hat` used to; `lazy` goes through a
+`GasStrategyFactory`, which only does so for the blocks that send a transaction (`--tx-rate`).
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from web3 import Web3, HTTPProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+from rpc_node import StandInNode  # noqa: E402
+
+from chief_keeper.gas import GWEI, FeeHistoryTipSource, GasStrategyFactory, TipOracle  # noqa: E402
+
+from pymaker.gas import GeometricGasPrice  # noqa: E402
+
+
+def run(strategy: str, blocks: int, tip_latency: float, tx_rate: float) -> dict:
+    node = StandInNode()
+
+    def fee_history(params):
+        time.sleep(tip_latency)
+        return {"oldestBlock": hex(1), "baseFeePerGas": [hex(GWEI)] * 2, "gasUsedRatio": [0.5], "reward": [[hex(2 * GWEI)]]}
+
+    node.handlers["eth_feeHistory"] = fee_history
+    node.start()
+    try:
+        web3 = Web3(HTTPProvider(node.url))
+        source = FeeHistoryTipSource(web3)
+        # Without a background refresh and with a TTL shorter than a block, every strategy fetches the tip
+        factory = GasStrategyFactory(web3, TipOracle([source], refresh_interval=0, ttl=0))
+        rng = random.Random(1)
+
+        node.reset_counters()
+        started = time.perf_counter()
+        for _ in range(blocks):
+            transact = rng.random() < tx_rate
+            if strategy == "eager":
+                GeometricGasPrice(web3=web3, initial_price=None, initial_tip=source.fetch(), every_secs=180)
+            else:
+                factory.begin_block()
+                if transact:
+                    factory()
+                factory.end_block()
+        elapsed = time.perf_counter() - started
+
+        return {
+            "fetches": node.calls["eth_feeHistory"] / blocks,
+            "ms": elapsed * 1000 / blocks,
+        }
+    finally:
+        node.stop()
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("gas-strategy-benchmark")
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--tip-latency", type=float, default=0.1, help="Seconds the tip source takes to answer")
+    parser.add_argument("--tx-rate", type=float, default=0.01, help="Probability of a lift, schedule or cast in any given block")
+    arguments = parser.parse_args(args)
+
+    print(f"{'strategy':>8} {'tip fetches/block':>18} {'ms/block':>9}")
+    for strategy in ["eager", "lazy"]:
+        result = run(strategy, arguments.blocks, arguments.tip_latency, arguments.tx_rate)
+        print(f"{strategy:>8} {result['fetches']:>18.2f} {result['ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures how long logging holds up a steady-state block, for each logging pipeline.
+
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/logging_overhead.py --blocks 2000 --write-latency 0.0005
+
+Each block replays the lines `process_block` logs when nothing changes: connection, hat and eta checks, the
+`METRIC:` line of the hat validity and the warning for a hat that isn't a spell. They go to a stream taking
+`--write-latency` seconds per write, standing in for a pipe to a log collector that is falling behind.
+`sync` is the default `ExitOnCritical` handler; `queue` writes from a listener thread, `json` formats the
+records as JSON, and `limited` also rate limits repeated lines to one per `--rate-limit` seconds. The
+time per block is what the keeper's thread spends logging; `drain` is how long the listener then takes to
+write out what was queued.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from chief_keeper.log import RATE_LIMITED, configure_logging, log_context, stop_listener
+
+HAT = "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"
+
+PIPELINES = {
+    "sync": {},
+    "queue": {"queued": True},
+    "json": {"queued": True, "json_output": True},
+    "limited": {"queued": True, "json_output": True, "rate_limit": 60},
+}
+
+
+class SlowStream:
+    """A stream taking `latency` seconds to accept each write"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.writes = 0
+
+    def write(self, text: str):
+        self.writes += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+
+def steady_block(logger: logging.Logger, metrics_logger: logging.Logger, block: int):
+    with log_context(block=block):
+        logger.info(f"web3 isConnected: True", extra=RATE_LIMITED)
+        with log_context(phase="check_hat"):
+            logger.info(f"Checking Hat on block {block}", extra=RATE_LIMITED)
+            metrics_logger.info(f"METRIC: Hat validity set to 1 for address {HAT}", extra=RATE_LIMITED)
+            logger.info(f"Current hat ({HAT}) with Approvals Wad(100000000000000000000000)", extra=RATE_LIMITED)
+            logger.warning(f"Spell is an EOA or 0x0, so keeper will not attempt to call schedule()", extra=RATE_LIMITED)
+        with log_context(phase="check_eta"):
+            logger.info(f"Checking scheduled spells on block {block}", extra=RATE_LIMITED)
+
+
+def run(pipeline: str, blocks: int, write_latency: float, rate_limit: float) -> dict:
+    options = dict(PIPELINES[pipeline])
+    if "rate_limit" in options:
+        options["rate_limit"] = rate_limit
+    stream = SlowStream(write_latency)
+    listener = configure_logging(stream=stream, **options)
+    logger, metrics_logger = logging.getLogger(), logging.getLogger("chief_keeper.metrics")
+
+    started = time.perf_counter()
+    for block in range(blocks):
+        steady_block(logger, metrics_logger, block)
+    elapsed = time.perf_counter() - started
+
+    if listener is not None:
+        stop_listener(listener)
+    drained = time.perf_counter() - started - elapsed
+
+    return {"us_per_block": elapsed / blocks * 10**6, "drain_ms": drained * 1000, "lines": stream.writes}
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("logging-overhead-benchmark")
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--write-latency", type=float, default=0.0, help="Seconds the output takes per write")
+    parser.add_argument("--rate-limit", type=float, default=60, help="Seconds between repeated lines in `limited`")
+    parser.add_argument("--pipelines", type=str, nargs="+", choices=list(PIPELINES), default=list(PIPELINES))
+    arguments = parser.parse_args(args)
+
+    results = {pipeline: run(pipeline, arguments.blocks, arguments.write_latency, arguments.rate_limit)
+               for pipeline in arguments.pipelines}
+    logging.basicConfig(force=True, handlers=[logging.StreamHandler()])
+
+    print(f"{'pipeline':>8} {'us/block':>9} {'drain ms':>9} {'lines':>6}")
+    for pipeline, result in results.items():
+        print(f"{pipeline:>8} {result['us_per_block']:>9.1f} {result['drain_ms']:>9.0f} {result['lines']:>6}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
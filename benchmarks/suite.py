@@ -0,0 +1,307 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs the whole keeper against a scripted fake chain and reports what each scenario costs.
+
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/suite.py --yays 100 1000 10000 --save baseline.json
+    PYTHONPATH=$PYTHONPATH:.:./lib/pymaker python3 benchmarks/suite.py --yays 100 1000 10000 --compare baseline.json
+
+The chain is a `FakeChain` (tests/rpc_node.py): DS-Chief with `--yays` etched yays and one voter per ten yays,
+DS-Pause and its spells, answering every method after `--latency` seconds. Each scenario runs at every yay count:
+
+    bootstrap  `check_deployment`, building the database from the DS-Chief deployment block
+    steady     `process_block` on each of `--blocks` blocks, with a vote in `--activity` of them
+    lift       `process_block` on a block where a yay overtakes the hat, sending a lift
+    cast       `process_block` on a block where a scheduled spell is due, sending a cast
+
+Wall time, JSON-RPC round-trips and calls are per block for `steady`, from the median of `--repeat` runs. Peak allocations are measured with
+tracemalloc on a second run of the scenario, so tracing doesn't slow the timed run (`--no-allocations` skips it).
+Transactions go through the keeper's pipeline, simulation and nonce included, up to signing.
+
+`--save` writes the results as a baseline; `--compare` prints the change against one and exits with 1 if RPC
+counts grew, or wall time or allocations grew by more than `--tolerance`.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from web3 import Web3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+# The keeper's metrics server listens on a free port
+os.environ.setdefault("METRICS_PORT", "0")
+
+from rpc_node import FakeChain, StandInNode  # noqa: E402
+
+import chief_keeper  # noqa: E402
+from chief_keeper.chief_keeper import ChiefKeeper  # noqa: E402
+from chief_keeper.transactions import TransactionPipeline  # noqa: E402
+
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+PAUSE = "0xbE286431454714F511008713973d3B053A2d38f3"
+KEEPER = "0xaAaAaAaaAaAaAaaAaAAAAAAAAaaaAaAaAaaAaaAa"
+NETWORK = "benchmark"
+SCENARIOS = ["bootstrap", "steady", "lift", "cast"]
+METRICS = ["ms", "round_trips", "calls", "peak_kib"]
+
+
+def address(i: int) -> str:
+    return Web3.toChecksumAddress("0x" + f"{i + 1:040x}")
+
+
+class RecordingPipeline(TransactionPipeline):
+    """The keeper's pipeline, recording transactions instead of signing and sending them"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    def _send(self, key, transact, gas_strategy, nonce, on_done):
+        self.sent.append(key)
+        receipt = SimpleNamespace(successful=True)
+        if on_done is not None:
+            on_done(receipt)
+        self._finish(key, receipt)
+
+
+class Bench:
+    """A fake chain with `yay_count` etched yays and a keeper pointed at it"""
+
+    def __init__(self, yay_count: int, latency: float, directory: str):
+        self.node = StandInNode()
+        self.node.latency = {"*": latency}
+        self.chain = FakeChain(self.node, CHIEF, PAUSE)
+        self.rng = random.Random(1)
+
+        chief = self.chain.chief
+        self.yays = [address(i) for i in range(yay_count)]
+        for yay in self.yays:
+            chief.etch([yay])
+            self.chain.mine()
+
+        self.voters = [address(10**6 + i) for i in range(max(10, yay_count // 10))]
+        for voter in self.voters:
+            chief.lock(voter, self.rng.randint(1, 1000) * 10**18)
+            chief.vote(voter, self.rng.sample(self.yays[1:], min(3, yay_count - 1)))
+
+        # The hat's approvals stay ahead of anything the voters can move, so only the lift scenario lifts
+        whale = address(3 * 10**6)
+        chief.lock(whale, 10**8 * 10**18)
+        chief.vote(whale, [self.yays[0]])
+        chief.lift(self.yays[0])
+        self.chain.mine()
+        self.node.start()
+
+        deployment_file = os.path.join(directory, "addresses.json")
+        with open(deployment_file, "w") as f:
+            json.dump({"MCD_ADM": CHIEF, "MCD_PAUSE": PAUSE}, f)
+
+        self.keeper = ChiefKeeper([
+            "--rpc-primary-url", self.node.url, "--rpc-backup-url", self.node.url, "--network", NETWORK,
+            "--eth-from", KEEPER, "--dss-deployment-file", deployment_file, "--fast-start", "--gas-tip-refresh", "0",
+            "--health-file", "",
+        ])
+        self.keeper.transactions = RecordingPipeline(self.keeper.web3, KEEPER)
+
+    def stop(self):
+        self.keeper.shutdown()
+        self.node.stop()
+
+    def measure(self, step, allocations: bool = False) -> dict:
+        self.node.reset_counters()
+        if allocations:
+            tracemalloc.start()
+        started = time.perf_counter()
+        step()
+        elapsed = time.perf_counter() - started
+        result = {"ms": elapsed * 1000, "round_trips": self.node.round_trips, "calls": sum(self.node.calls.values())}
+        if allocations:
+            result["peak_kib"] = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        return result
+
+    def bootstrap(self, allocations: bool) -> dict:
+        return self.measure(self.keeper.check_deployment, allocations)
+
+    def steady(self, blocks: int, activity: float, allocations: bool) -> dict:
+        chief = self.chain.chief
+
+        def step():
+            for _ in range(blocks):
+                self.chain.mine()
+                if self.rng.random() < activity:
+                    voter = self.rng.choice(self.voters)
+                    chief.vote(voter, self.rng.sample(self.yays[1:], min(3, len(self.yays) - 1)))
+                self.keeper.process_block()
+
+        result = self.measure(step, allocations)
+        return {metric: value / blocks if metric != "peak_kib" else value for metric, value in result.items()}
+
+    def lift(self, allocations: bool) -> dict:
+        chief = self.chain.chief
+        contender = self.yays[1]
+        # Logs land in the head block, so a block is mined for them before they happen
+        self.chain.mine()
+        chief.lock(KEEPER, 10**9 * 10**18)
+        chief.vote(KEEPER, [contender])
+
+        result = self.measure(self.step_and_wait, allocations)
+        assert ("lift", contender) in self.keeper.transactions.sent
+        return result
+
+    def cast(self, allocations: bool) -> dict:
+        pause = self.chain.pause
+        spell = pause.deploy(address(2 * 10**6), address(2 * 10**6 + 1))
+        self.chain.mine()
+        self.chain.chief.etch([spell])
+        self.keeper.process_block()
+
+        self.chain.mine()
+        pause.plot(spell, self.chain.timestamp())
+
+        result = self.measure(self.step_and_wait, allocations)
+        assert ("cast", spell) in self.keeper.transactions.sent
+        return result
+
+    def step_and_wait(self):
+        self.keeper.process_block()
+        self.keeper.transactions.wait(10)
+
+
+def database_files() -> list:
+    directory = os.path.join(os.path.dirname(os.path.abspath(chief_keeper.__file__)), "database")
+    return [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(f"db_{NETWORK}.")]
+
+
+def run_scenario(scenario: str, yay_count: int, arguments, allocations: bool) -> dict:
+    for path in database_files():
+        os.remove(path)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench = Bench(yay_count, arguments.latency, directory)
+        try:
+            if scenario == "bootstrap":
+                return bench.bootstrap(allocations)
+
+            bench.keeper.check_deployment()
+            bench.chain.mine()
+            bench.keeper.process_block()
+            if scenario == "steady":
+                return bench.steady(arguments.blocks, arguments.activity, allocations)
+            return getattr(bench, scenario)(allocations)
+        finally:
+            bench.stop()
+            for path in database_files():
+                os.remove(path)
+
+
+def run(arguments) -> dict:
+    results = {}
+    for scenario in arguments.scenarios:
+        for yay_count in arguments.yays:
+            # Single blocks take milliseconds, so the run with the median wall time is kept
+            runs = sorted([run_scenario(scenario, yay_count, arguments, allocations=False)
+                           for _ in range(arguments.repeat)], key=lambda result: result["ms"])
+            result = runs[len(runs) // 2]
+            if arguments.allocations:
+                result["peak_kib"] = run_scenario(scenario, yay_count, arguments, allocations=True)["peak_kib"]
+            results.setdefault(scenario, {})[str(yay_count)] = result
+            print_result(scenario, yay_count, result)
+    return results
+
+
+def print_result(scenario: str, yay_count: int, result: dict, baseline: dict = None):
+    line = f"{scenario:>9} {yay_count:>6}"
+    for metric in METRICS:
+        value = result.get(metric)
+        line += f" {'-' if value is None else f'{value:.1f}':>11}"
+        if baseline is not None and value is not None and baseline.get(metric):
+            line += f" {(value - baseline[metric]) / baseline[metric] * 100:>+7.1f}%"
+    print(line)
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for scenario, by_yays in results.items():
+        for yay_count, result in by_yays.items():
+            previous = baseline.get("results", {}).get(scenario, {}).get(yay_count)
+            if previous is None:
+                continue
+            for metric, value in result.items():
+                before = previous.get(metric)
+                if before is None:
+                    continue
+                # RPC counts are deterministic, any increase is a regression
+                allowed = before if metric in ["round_trips", "calls"] else before * (1 + tolerance)
+                if value > allowed:
+                    found.append(f"{scenario} at {yay_count} yays: {metric} {before:.1f} -> {value:.1f}")
+    return found
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("benchmark-suite")
+    parser.add_argument("--yays", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--scenarios", type=str, nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--blocks", type=int, default=50, help="Blocks processed in the steady scenario")
+    parser.add_argument("--activity", type=float, default=0.1, help="Probability of a vote in any given steady block")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each scenario, of which the median is reported (default: 3)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake node takes to answer each request")
+    parser.add_argument("--no-allocations", dest="allocations", action="store_false", help="Skip the traced run measuring allocations")
+    parser.add_argument("--save", type=str, default=None, help="Write the results to this baseline file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare the results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative growth of wall time and allocations (default: 0.25)")
+    arguments = parser.parse_args(args)
+
+    # Keep the keeper's per-block logging out of the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'scenario':>9} {'yays':>6} " + " ".join(f"{metric:>11}" for metric in METRICS))
+    results = run(arguments)
+
+    if arguments.save:
+        with open(arguments.save, "w") as f:
+            json.dump({"python": platform.python_version(), "latency": arguments.latency, "blocks": arguments.blocks,
+                       "results": results}, f, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+
+        print(f"\nCompared with {arguments.compare}:")
+        for scenario, by_yays in results.items():
+            for yay_count, result in by_yays.items():
+                print_result(scenario, int(yay_count), result, baseline.get("results", {}).get(scenario, {}).get(yay_count))
+
+        found = regressions(results, baseline, arguments.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,297 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from eth_utils import event_signature_to_log_topic, function_signature_to_4byte_selector
+from web3 import Web3
+
+from chief_keeper.rpc import BatchUnavailable, batch_request, eth_call_params
+
+from pymaker.governance import DSChief
+from pymaker.numeric import Wad
+
+EMPTY_SLATE = bytes(32)
+
+
+def note_topic(signature: str) -> str:
+    """Topic of a ds-note `LogNote`, which is the function selector padded to 32 bytes"""
+    return "0x" + function_signature_to_4byte_selector(signature).hex().ljust(64, "0")
+
+
+def event_topic(signature: str) -> str:
+    return "0x" + event_signature_to_log_topic(signature).hex()
+
+
+# DS-Chief logs whose second topic is the voter (`guy` for LogNote, `usr` for events)
+VOTER_TOPICS = {
+    note_topic("lock(uint256)"),
+    note_topic("free(uint256)"),
+    note_topic("vote(bytes32)"),
+    note_topic("vote(address[])"),
+    event_topic("Lock(address,uint256)"),
+    event_topic("Free(address,uint256)"),
+    event_topic("Vote(address,bytes32)"),
+}
+
+# DS-Chief logs that can't change any approvals
+NEUTRAL_TOPICS = {
+    note_topic("etch(address[])"),
+    note_topic("lift(address)"),
+    note_topic("launch()"),
+    event_topic("Etch(bytes32)"),
+    event_topic("Etch(bytes32,address[])"),
+    event_topic("Lift(address)"),
+    event_topic("Launch()"),
+}
+
+
+class ApprovalReader:
+    """Reads the DS-Chief hat and the approvals of every candidate at a single block.
+
+    All reads are sent as one JSON-RPC batch. If the node can't serve batches, the reader
+    falls back to one `eth_call` per candidate, still pinned to the same block.
+    """
+
+    def __init__(self, web3: Web3, ds_chief: DSChief, max_batch_size: int = 500):
+        assert isinstance(web3, Web3)
+        assert isinstance(ds_chief, DSChief)
+
+        self.web3 = web3
+        self.ds_chief = ds_chief
+        self.max_batch_size = max_batch_size
+        self.batching = True
+        self.logger = logging.getLogger()
+
+    def read(self, yays: List[str], block_number: int) -> Tuple[str, Dict[str, Wad]]:
+        """Returns the hat and a yay:approvals dictionary (hat included), both read at `block_number`"""
+        candidates = list(dict.fromkeys(yays))
+        results = self.call_many([("hat", [])] + [("approvals", [yay]) for yay in candidates], block_number)
+
+        hat = results[0]
+        approvals = {yay: Wad(result) for yay, result in zip(candidates, results[1:])}
+
+        # The hat is read in the same batch, so its approvals are requested separately if it isn't a known yay
+        if hat not in approvals:
+            approvals[hat] = Wad(self._call("approvals", [hat], block_number))
+
+        return hat, approvals
+
+    def call_many(self, calls: List[Tuple[str, list]], block_number: int) -> List[Any]:
+        """Calls DS-Chief view functions ((name, args) pairs) at `block_number` and returns their outputs"""
+        if self.batching:
+            try:
+                return self._call_batched(calls, block_number)
+            except BatchUnavailable as e:
+                self.logger.warning(f"Batched DS-Chief reads unavailable, using one call per read: {e}")
+                self.batching = False
+            except Exception as e:
+                self.logger.warning(f"Batched DS-Chief read failed on block {block_number}, using one call per read: {e}")
+
+        return [self._call(fn_name, args, block_number) for fn_name, args in calls]
+
+    def _call(self, fn_name: str, args: list, block_number: int) -> Any:
+        return getattr(self.ds_chief._contract.functions, fn_name)(*args).call(block_identifier=block_number)
+
+    def _call_batched(self, calls: List[Tuple[str, list]], block_number: int) -> List[Any]:
+        chief = self.ds_chief.address.address
+        contract = self.ds_chief._contract
+
+        requests = [
+            ("eth_call", eth_call_params(chief, contract.encodeABI(fn_name=fn_name, args=args), block_number))
+            for fn_name, args in calls
+        ]
+        results = batch_request(self.web3, requests, self.max_batch_size)
+
+        outputs = []
+        for (fn_name, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                raise result
+
+            output_type = contract.get_function_by_name(fn_name).abi["outputs"][0]["type"]
+            value = self.web3.codec.decode_single(output_type, Web3.toBytes(hexstr=result))
+            outputs.append(Web3.toChecksumAddress(value) if output_type == "address" else value)
+
+        return outputs
+
+
+class ApprovalIndex:
+    """Approvals of every yay, kept in memory and refreshed only where DS-Chief logs show a change.
+
+    The index is seeded with a full approval scan. After that, each block only re-reads the hat, the
+    approvals of newly etched yays and those of yays in the old and new slates of every voter that
+    locked, freed or voted in the new block range. Candidates sit in a max-heap, so picking the
+    contender doesn't walk every yay. Unrecognised DS-Chief logs, long gaps between blocks and every
+    `reconcile_blocks` blocks trigger a full rescan to catch any drift.
+    """
+
+    def __init__(self, web3: Web3, reader: ApprovalReader, unpack_slate: Callable[[bytes], List[str]],
+                 reconcile_blocks: int = 100, max_log_range: int = 1000):
+        assert isinstance(web3, Web3)
+        assert isinstance(reader, ApprovalReader)
+        assert callable(unpack_slate)
+
+        self.web3 = web3
+        self.reader = reader
+        self.unpack_slate = unpack_slate
+        self.reconcile_blocks = reconcile_blocks
+        self.max_log_range = max_log_range
+
+        self.hat = None
+        self.block = None
+        self.last_rescan = None
+        self.approvals = {}
+        self.positions = {}
+        self.heap = []
+        self.prefetched = {}
+        self.logger = logging.getLogger()
+
+    def prefetch_logs(self, block_number: int):
+        """Reads the DS-Chief logs the next `update` to `block_number` needs, e.g. concurrently with other reads"""
+        if not self._rescans(block_number) and block_number > self.block:
+            self.prefetched[("logs", self.block + 1, block_number)] = self._get_logs(self.block + 1, block_number)
+
+    def prefetch_hat(self, block_number: int):
+        """Reads the hat the next `update` to `block_number` needs, e.g. concurrently with other reads"""
+        if not self._rescans(block_number) and block_number > self.block:
+            self.prefetched[("hat", block_number)] = self.reader.call_many([("hat", [])], block_number)[0]
+
+    def update(self, yays: List[str], block_number: int):
+        """Brings the index up to `block_number`; `yays` is the ordered list of all etched yays"""
+        prefetched, self.prefetched = self.prefetched, {}
+        if self.block is not None and block_number <= self.block:
+            return
+
+        if self._rescans(block_number):
+            self.rescan(yays, block_number)
+            return
+
+        logs = prefetched.get(("logs", self.block + 1, block_number))
+        if logs is None:
+            logs = self._get_logs(self.block + 1, block_number)
+
+        voters = set()
+        for log in logs:
+            topic = Web3.toHex(log["topics"][0]) if log["topics"] else None
+            if topic in VOTER_TOPICS:
+                voters.add(Web3.toChecksumAddress(Web3.toBytes(log["topics"][1])[-20:]))
+            elif topic not in NEUTRAL_TOPICS:
+                self.logger.info(f"Unrecognised DS-Chief log {topic}, rescanning all approvals")
+                self.rescan(yays, block_number)
+                return
+
+        self._index_positions(yays)
+        dirty = [yay for yay in yays if yay not in self.approvals]
+        if voters:
+            dirty += self._yays_of_voters(voters, self.block, block_number)
+
+        dirty = list(dict.fromkeys(dirty))
+        hat = prefetched.get(("hat", block_number))
+        calls = ([("hat", [])] if hat is None else []) + [("approvals", [yay]) for yay in dirty]
+        results = self.reader.call_many(calls, block_number) if calls else []
+        if hat is None:
+            hat, results = results[0], results[1:]
+
+        self.hat = hat
+        for yay, value in zip(dirty, results):
+            self._set(yay, Wad(value))
+        if self.hat not in self.approvals:
+            self._set(self.hat, Wad(self.reader.call_many([("approvals", [self.hat])], block_number)[0]))
+        self.block = block_number
+
+    def reset(self):
+        """Makes the next update rescan every yay, e.g. after a reorg replaced blocks the index was updated with"""
+        self.block = None
+
+    def rescan(self, yays: List[str], block_number: int):
+        """Re-reads the approvals of every yay and rebuilds the heap"""
+        self.hat, approvals = self.reader.read(yays, block_number)
+
+        drifted = [yay for yay, value in approvals.items() if yay in self.approvals and self.approvals[yay] != value]
+        if drifted:
+            self.logger.warning(f"Approval index drifted for {len(drifted)} yays, corrected by rescan")
+
+        self.positions = {}
+        self._index_positions(yays)
+        self.approvals = approvals
+        self.heap = [(-value.value, self.positions[yay], yay) for yay, value in approvals.items() if yay in self.positions]
+        heapq.heapify(self.heap)
+
+        self.block = block_number
+        self.last_rescan = block_number
+
+    def contender(self) -> Tuple[str, Wad]:
+        """Returns the yay with the most approvals if it has more than the hat, otherwise the hat"""
+        hat_approvals = self.approvals[self.hat]
+
+        while self.heap:
+            negative_approvals, position, yay = self.heap[0]
+            if self.positions.get(yay) == position and self.approvals[yay].value == -negative_approvals:
+                if -negative_approvals > hat_approvals.value:
+                    return yay, self.approvals[yay]
+                break
+            heapq.heappop(self.heap)
+
+        return self.hat, hat_approvals
+
+    def _rescans(self, block_number: int) -> bool:
+        return (self.block is None
+                or block_number - self.last_rescan >= self.reconcile_blocks
+                or block_number - self.block > self.max_log_range)
+
+    def _get_logs(self, from_block: int, to_block: int) -> list:
+        return self.web3.eth.getLogs({
+            "address": self.reader.ds_chief.address.address,
+            "fromBlock": from_block,
+            "toBlock": to_block
+        })
+
+    def _index_positions(self, yays: List[str]):
+        for yay in yays:
+            if yay not in self.positions:
+                self.positions[yay] = len(self.positions)
+                # A yay read through a slate before it was confirmed has approvals but no heap entry yet
+                if yay in self.approvals:
+                    heapq.heappush(self.heap, (-self.approvals[yay].value, self.positions[yay], yay))
+
+    def _set(self, yay: str, value: Wad):
+        if yay in self.approvals and self.approvals[yay] == value:
+            return
+
+        self.approvals[yay] = value
+        if yay in self.positions:
+            heapq.heappush(self.heap, (-value.value, self.positions[yay], yay))
+
+        # Stale entries are skipped lazily; compact once they outnumber live ones
+        if len(self.heap) > 2 * len(self.positions) + 16:
+            self.heap = [(-self.approvals[yay].value, position, yay) for yay, position in self.positions.items()
+                         if yay in self.approvals]
+            heapq.heapify(self.heap)
+
+    def _yays_of_voters(self, voters: Set[str], before_block: int, block_number: int) -> List[str]:
+        """Yays in the slates voters backed before and after the block range"""
+        calls = [("votes", [voter]) for voter in voters]
+        slates = set(self.reader.call_many(calls, before_block)) | set(self.reader.call_many(calls, block_number))
+        slates.discard(EMPTY_SLATE)
+
+        yays = []
+        for slate in slates:
+            yays += self.unpack_slate(slate)
+
+        return list(dict.fromkeys(yays))
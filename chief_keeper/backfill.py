@@ -0,0 +1,213 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from requests.exceptions import Timeout
+
+# Fragments of the errors providers return when an eth_getLogs range holds too many results or takes too long
+RANGE_TOO_LARGE_ERRORS = [
+    "too many",
+    "more than",
+    "limit exceeded",
+    "block range",
+    "range is too large",
+    "response size",
+    "query timeout",
+    "timed out",
+    "-32005",
+]
+
+
+def is_range_too_large(error: Exception) -> bool:
+    """True if `error` means the requested block range should be split into smaller ones"""
+    if isinstance(error, Timeout):
+        return True
+
+    message = str(error).lower()
+    return any(fragment in message for fragment in RANGE_TOO_LARGE_ERRORS)
+
+
+class Backfill:
+    """Runs a log query over a large block range as adaptive, concurrent chunks.
+
+    Chunks are fetched on a bounded worker pool. The chunk size halves whenever the provider
+    reports that a range is too large and doubles after successes, up to half the last rejected
+    size. That ceiling is raised again after a run of successes, so sparse stretches of the chain
+    are still fetched in large chunks. Every finished chunk is checkpointed to
+    `checkpoint_path`, so an interrupted backfill resumes where it stopped. Without a
+    `checkpoint_path`, e.g. for results that aren't JSON, nothing is checkpointed.
+
+    Duplicate results are dropped unless `unique` is False, which keeps results whose repetition
+    is meaningful, like a plan that is plotted again after being dropped.
+    """
+
+    def __init__(self, fetch: Callable[[int, int], List], checkpoint_path: Optional[str], workers: int = 4,
+                 chunk_size: int = 50000, min_chunk_size: int = 100, max_chunk_size: int = 1000000,
+                 max_retries: int = 3, progress_interval: float = 10.0, unique: bool = True):
+        assert callable(fetch)
+        assert workers > 0
+        assert 0 < min_chunk_size <= chunk_size <= max_chunk_size
+
+        self.fetch = fetch
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.unique = unique
+        self.ceiling = max_chunk_size
+        self.successes = 0
+        self.logger = logging.getLogger()
+
+    def run(self, from_block: int, to_block: int) -> List:
+        """Returns the results for [from_block, to_block] in block order"""
+        completed = self._load_checkpoint(from_block)
+        pending = self._missing_ranges(completed, from_block, to_block)
+
+        total = to_block - from_block + 1
+        done = sum(min(end, to_block) - start + 1 for start, (end, _) in completed.items() if start <= to_block)
+        if completed:
+            self.logger.info(f"Resuming backfill from checkpoint, {done} of {total} blocks already fetched")
+
+        started = time.time()
+        last_report = started
+        fetched = 0
+        retries = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = {}
+            while pending or in_flight:
+                while pending and len(in_flight) < self.workers:
+                    start, end = pending.pop(0)
+                    if end - start + 1 > self.chunk_size:
+                        pending.insert(0, (start + self.chunk_size, end))
+                        end = start + self.chunk_size - 1
+                    in_flight[executor.submit(self.fetch, start, end)] = (start, end)
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    start, end = in_flight.pop(future)
+                    try:
+                        completed[start] = (end, future.result())
+                    except Exception as e:
+                        pending[0:0] = self._reschedule(start, end, e, retries)
+                        continue
+
+                    fetched += end - start + 1
+                    self._grow()
+                    self._save_checkpoint(from_block, completed)
+
+                if time.time() - last_report >= self.progress_interval:
+                    last_report = time.time()
+                    self.logger.info(f"Backfilled {done + fetched} of {total} blocks "
+                                     f"({fetched / (last_report - started):.0f} blocks/s)")
+
+        elapsed = max(time.time() - started, 1e-9)
+        self.logger.info(f"Backfilled {fetched} blocks in {elapsed:.1f}s ({fetched / elapsed:.0f} blocks/s)")
+
+        results = []
+        for start in sorted(completed):
+            if start <= to_block:
+                results += completed[start][1]
+
+        self._remove_checkpoint()
+        return list(dict.fromkeys(results)) if self.unique else results
+
+    def _grow(self):
+        self.successes += 1
+        if self.successes >= 16 and self.ceiling < self.max_chunk_size:
+            self.ceiling = min(self.max_chunk_size, self.ceiling * 3 // 2)
+            self.successes = 0
+
+        self.chunk_size = max(self.min_chunk_size, min(self.ceiling, self.chunk_size * 2))
+
+    def _reschedule(self, start: int, end: int, error: Exception, retries: Dict) -> List[Tuple[int, int]]:
+        """Returns the ranges to fetch again after `error`, shrinking the chunk size if the range was too large"""
+        if is_range_too_large(error):
+            size = end - start + 1
+            if size <= self.min_chunk_size:
+                raise error
+
+            self.ceiling = max(self.min_chunk_size, min(self.ceiling, size // 2))
+            self.chunk_size = min(self.chunk_size, self.ceiling)
+            self.successes = 0
+            self.logger.info(f"Blocks {start}-{end} rejected by provider, chunk size reduced to {self.chunk_size}")
+            middle = start + size // 2
+            return [(start, middle - 1), (middle, end)]
+
+        retries[start] = retries.get(start, 0) + 1
+        if retries[start] > self.max_retries:
+            raise error
+
+        self.logger.warning(f"Error fetching blocks {start}-{end} (attempt {retries[start]}): {error}")
+        time.sleep(retries[start])
+        return [(start, end)]
+
+    @staticmethod
+    def _missing_ranges(completed: Dict, from_block: int, to_block: int) -> List[Tuple[int, int]]:
+        missing = []
+        cursor = from_block
+        for start in sorted(completed):
+            end = completed[start][0]
+            if start > cursor:
+                missing.append((cursor, min(start - 1, to_block)))
+            cursor = max(cursor, end + 1)
+            if cursor > to_block:
+                break
+
+        if cursor <= to_block:
+            missing.append((cursor, to_block))
+
+        return [(start, end) for start, end in missing if start <= end]
+
+    def _load_checkpoint(self, from_block: int) -> Dict:
+        if self.checkpoint_path is None or not os.path.isfile(self.checkpoint_path):
+            return {}
+
+        try:
+            with open(self.checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            self.logger.warning(f"Ignoring unreadable backfill checkpoint {self.checkpoint_path}")
+            return {}
+
+        if checkpoint.get("from_block") != from_block:
+            return {}
+
+        return {int(start): (end, results) for start, (end, results) in checkpoint["completed"].items()}
+
+    def _save_checkpoint(self, from_block: int, completed: Dict):
+        if self.checkpoint_path is None:
+            return
+
+        # Written to a temporary file first so an interruption can't leave a truncated checkpoint
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"from_block": from_block, "completed": completed}, f)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def _remove_checkpoint(self):
+        if self.checkpoint_path is not None and os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
@@ -19,7 +19,7 @@ import argparse
 import logging
 import sys
 import os
-import requests
+import threading
 import time
 import types
 
@@ -28,54 +28,58 @@ from web3.exceptions import TimeExhausted
 
 from urllib.parse import urlparse
 
+from chief_keeper.approvals import ApprovalIndex, ApprovalReader
+from chief_keeper.context import BlockContext
 from chief_keeper.database import SimpleDatabase
-from chief_keeper.spell import DSSSpell
+from chief_keeper.deployment import ChiefDeployment
+from chief_keeper.engine import AsyncEngine
+from chief_keeper.gas import BlocknativeTipSource, FeeHistoryTipSource, GasStrategyFactory, TipOracle
+from chief_keeper.heads import Head, HeadSubscription
+from chief_keeper.log import RATE_LIMITED, configure_logging, log_context
+from chief_keeper.rpc import rpc_metrics_middleware
+from chief_keeper.rpc_pool import ProviderPool
+from chief_keeper.sessions import http_session
+from chief_keeper.transactions import TransactionPipeline
 from chief_keeper.metrics import (
     MetricsServer, 
+    health,
     record_new_hat_event, 
     set_hat_validity, 
     record_schedule_called, 
     record_lift_called, 
-    record_invalid_lift_called
+    record_invalid_lift_called,
+    record_block_detected,
+    record_block_processed,
+    set_block_lag,
+    set_keeper_balance,
+    set_websocket_connected,
+    time_block_phase
 )
 
 from pymaker import Address, web3_via_http
-from pymaker.util import is_contract_at
-from pymaker.gas import GeometricGasPrice
 from pymaker.keys import register_keys
 from pymaker.lifecycle import Lifecycle
-from pymaker.deployment import DssDeployment
 
 HEALTHCHECK_FILE_PATH = "/tmp/health.log"
 BACKOFF_MAX_TIME = 120
-
-class ExitOnCritical(logging.StreamHandler):
-    """Custom class to terminate script execution once
-    log records with severity level ERROR or higher occurred"""
-
-    def emit(self, record):
-        super().emit(record)
-        if record.levelno > logging.ERROR:
-            sys.exit(1)
-
-
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(name)s - %(message)s",
-    datefmt="%Y-%m-%dT%H:%M:%S%z",
-    force=True,
-    handlers=[ExitOnCritical()],
+# Seconds a WebSocket head waits for the JSON-RPC node to reach it, before it is left to the next head or poll
+HEAD_WAIT_TIME = 2
+
+# LOG_QUEUE=1 writes logs from a background thread, LOG_FORMAT=json as JSON with the block and phase, and
+# LOG_RATE_LIMIT=<seconds> lets each steady-state line through once per interval
+configure_logging(
+    level=os.environ.get("LOG_LEVEL") or "INFO",
+    json_output=os.environ.get("LOG_FORMAT") == "json",
+    queued=os.environ.get("LOG_QUEUE", "") not in ["", "0"],
+    rate_limit=float(os.environ.get("LOG_RATE_LIMIT") or 0),
 )
 logger = logging.getLogger()
-log_level = logging.getLevelName(os.environ.get("LOG_LEVEL") or "INFO")
-logger.setLevel(log_level)
 
 
 def healthy(func):
     def wrapper(*args, **kwargs):
-        ts = int(time.time())
-        print(f"Health-check passed, timestamp: {ts}")
-        with open(HEALTHCHECK_FILE_PATH, "w") as f:
-            f.write(str(ts) + "\n")
+        # Kept in memory for /healthz, and written to the health file at most every --health-file-interval
+        health.beat()
         return func(*args, **kwargs)
 
     return wrapper
@@ -93,20 +97,49 @@ class ChiefKeeper:
         parser.add_argument("--rpc-primary-timeout", type=int, default=1200, help="Primary JSON-RPC timeout (in seconds, default: 1200)")
         parser.add_argument("--rpc-backup-url", type=str, required=True, help="Backup JSON-RPC host URL")
         parser.add_argument("--rpc-backup-timeout", type=int, default=1200, help="Backup JSON-RPC timeout (in seconds, default: 1200)")
+        parser.add_argument("--rpc-primary-ws-url", type=str, default=None, help="Primary WebSocket URL to subscribe to new heads on; blocks are polled over HTTP while it is down")
+        parser.add_argument("--rpc-backup-ws-url", type=str, default=None, help="Backup WebSocket URL to subscribe to new heads on")
         parser.add_argument("--network", type=str, required=True, help="Network that you're running the Keeper on (options, 'mainnet', 'kovan', 'testnet')")
         parser.add_argument("--eth-from", type=str, required=True, help="Ethereum address from which to send transactions; checksummed (e.g. '0x12AebC')")
         parser.add_argument("--eth-key", type=str, nargs="*", help="Ethereum private key(s) to use (e.g. 'key_file=/path/to/keystore.json,pass_file=/path/to/passphrase.txt')")
         parser.add_argument("--dss-deployment-file", type=str, required=False, help="Json description of all the system addresses (e.g. /Full/Path/To/configFile.json)")
+        parser.add_argument("--fast-start", dest="fast_start", action="store_true", help="Only load DS-Chief and DS-Pause from the deployment instead of the whole DssDeployment")
+        parser.add_argument("--snapshot", type=str, default=None, help="State snapshot to create a missing database from instead of backfilling it (see chief_keeper/snapshot.py)")
         parser.add_argument("--chief-deployment-block", type=int, required=False, default=0, help="Block that the Chief from dss-deployment-file was deployed at (e.g. 8836668")
         parser.add_argument("--max-errors", type=int, default=100, help="Maximum number of allowed errors before the keeper terminates (default: 100)")
         parser.add_argument("--debug", dest="debug", action="store_true", help="Enable debug output")
         parser.add_argument("--blocknative-api-key", type=str, default=None, help="Blocknative API key")
+        parser.add_argument("--gas-tip-source", type=str, nargs="+", choices=["blocknative", "fee_history"], default=None, help="Tip sources in order of preference, falling back to 1.5 gwei (default: blocknative with --blocknative-api-key, then fee_history)")
+        parser.add_argument("--gas-tip-refresh", type=float, default=12, help="Seconds between background tip refreshes; 0 fetches the tip only when a transaction is sent (default: 12)")
+        parser.add_argument("--gas-tip-ttl", type=float, default=60, help="Seconds a tip is used before it is refreshed on the spot (default: 60)")
+        parser.add_argument("--max-pending-transactions", type=int, default=4, help="Lift, schedule and cast transactions sent concurrently in the background (default: 4)")
+        parser.add_argument("--no-simulate", dest="simulate", action="store_false", help="Send lift, schedule and cast without first simulating them with eth_call against the pending block")
         parser.add_argument("--gas-initial-multiplier", type=float, default=1.0, help="gas multiplier")
         parser.add_argument("--gas-reactive-multiplier", type=float, default=2.25, help="gas strategy tuning")
         parser.add_argument("--gas-maximum", type=int, default=5000, help="gas strategy tuning")
+        parser.add_argument("--rpc-max-batch-size", type=int, default=500, help="Maximum number of calls sent in one JSON-RPC batch (default: 500)")
+        parser.add_argument("--db-backend", type=str, default="tinydb", choices=["tinydb", "sqlite"], help="Local database backend (default: tinydb); sqlite migrates an existing json database on first start")
+        parser.add_argument("--db-flush-interval", type=float, default=0, help="Seconds between background writes of the database to disk (default: 0, written at the end of every block)")
+        parser.add_argument("--confirmations", type=int, default=0, help="Blocks behind the head the yays and etas are indexed up to, so shallow reorgs never reach them (default: 0)")
+        parser.add_argument("--backfill-workers", type=int, default=4, help="Concurrent log queries when building the database from scratch (default: 4)")
+        parser.add_argument("--async", dest="async_mode", action="store_true", help="Read each block's independent state concurrently on an asyncio engine")
+        parser.add_argument("--rpc-max-in-flight", type=int, default=8, help="Maximum concurrent JSON-RPC requests in --async mode (default: 8)")
+        parser.add_argument("--rpc-connect-timeout", type=float, default=5, help="Seconds to wait for a connection to a JSON-RPC host or Blocknative, separately from the read timeouts (default: 5)")
+        parser.add_argument("--http-pool-size", type=int, default=10, help="Kept-alive connections per host for JSON-RPC and Blocknative requests (default: 10)")
+        parser.add_argument("--http2", dest="http2", action="store_true", help="Send JSON-RPC and Blocknative requests over HTTP/2 (requires httpx[http2])")
+        parser.add_argument("--rpc-pool", dest="rpc_pool", action="store_true", help="Send every request to the fastest healthy node of the primary, backup and extra URLs instead of failing over once at startup")
+        parser.add_argument("--rpc-extra-url", type=str, nargs="*", default=[], help="Further JSON-RPC host URLs for --rpc-pool, using the primary timeout")
+        parser.add_argument("--rpc-hedge-reads", dest="rpc_hedge_reads", action="store_true", help="With --rpc-pool, also send hat and approval reads to a second node when the first is slower than its p95 latency")
+        parser.add_argument("--rpc-max-head-lag", type=int, default=3, help="Blocks a node may fall behind the best node before --rpc-pool routes around it (default: 3)")
+        parser.add_argument("--health-max-age", type=float, default=900, help="Seconds without a block after which /healthz and /readyz of the metrics server fail (default: 900)")
+        parser.add_argument("--health-file", type=str, default=HEALTHCHECK_FILE_PATH, help=f"File the time of the latest block is written to for health-check.sh; empty to disable (default: {HEALTHCHECK_FILE_PATH})")
+        parser.add_argument("--health-file-interval", type=float, default=60, help="Minimum seconds between writes of --health-file (default: 60)")
+        parser.add_argument("--approval-reconcile-blocks", type=int, default=100, help="Blocks between full rescans of all yay approvals (default: 100)")
 
         parser.set_defaults(cageFacilitated=False)
         self.arguments = parser.parse_args(args)
+        if self.arguments.gas_tip_refresh < 0 or self.arguments.gas_tip_ttl < 0:
+            parser.error("--gas-tip-refresh and --gas-tip-ttl can't be negative")
 
         # Initialize logger before any method that uses it
         self.logger = logger
@@ -115,6 +148,7 @@ class ChiefKeeper:
 
         self.web3 = None
         self.node_type = None
+        self.http = self.http_session()
         self._initialize_blockchain_connection()
 
         # Set the Ethereum address and register keys
@@ -122,13 +156,20 @@ class ChiefKeeper:
         # register_keys(self.web3, self.arguments.eth_key)
         self.our_address = Address(self.arguments.eth_from)
 
+        if self.arguments.fast_start:
+            deployment = ChiefDeployment
+        else:
+            # Importing the whole deployment is a large part of the start-up time
+            from pymaker.deployment import DssDeployment
+            deployment = DssDeployment
+
         if self.arguments.dss_deployment_file:
-            self.dss = DssDeployment.from_json(
+            self.dss = deployment.from_json(
                 web3=self.web3,
                 conf=open(self.arguments.dss_deployment_file, "r").read(),
             )
         else:
-            self.dss = DssDeployment.from_network(
+            self.dss = deployment.from_network(
                 web3=self.web3, network=self.arguments.network
             )
             self.logger.info(f"DS-Chief: {self.dss.ds_chief.address}")
@@ -137,8 +178,26 @@ class ChiefKeeper:
         self.max_errors = self.arguments.max_errors
         self.errors = 0
 
-        self.confirmations = 0
+        self.confirmations = self.arguments.confirmations
+
+        self.database = None
+        self.heads = None
+        self.last_processed_block = None
+        self.block_lock = threading.Lock()
+
+        self.tip_oracle = TipOracle(self.tip_sources(), self.arguments.gas_tip_refresh, self.arguments.gas_tip_ttl)
+        self.gas_strategy = GasStrategyFactory(self.web3, self.tip_oracle)
+        self.transactions = TransactionPipeline(self.web3, self.our_address.address,
+                                                self.arguments.max_pending_transactions, self.arguments.simulate)
+
+        self.engine = None
+        if self.arguments.async_mode:
+            self.engine = AsyncEngine(self.web3.provider, self.arguments.rpc_max_in_flight)
         
+        self.connected = True
+        health.configure(self.arguments.health_max_age, self.arguments.health_file,
+                         self.arguments.health_file_interval, self.rpc_status)
+
         # Start the metrics server
         self.metrics_server = MetricsServer()
         self.metrics_server.start()
@@ -150,6 +209,11 @@ class ChiefKeeper:
 
     def _initialize_blockchain_connection(self):
         """Initialize connection with Ethereum node."""
+        if self.arguments.rpc_pool:
+            if not self._connect_to_pool():
+                self.logger.critical("Error: Couldn't connect to any of the Ethereum nodes.")
+            return
+
         if not self._connect_to_primary_node():
             self.logger.info("Switching to backup node.")
             if not self._connect_to_backup_node():
@@ -172,7 +236,7 @@ class ChiefKeeper:
     def _connect_to_node(self, rpc_url, rpc_timeout, node_type):
         """Connect to an Ethereum node"""
         try:
-            _web3 = Web3(HTTPProvider(rpc_url, {"timeout": rpc_timeout}))
+            _web3 = Web3(HTTPProvider(rpc_url, {"timeout": self.http_timeout(rpc_timeout)}, session=self.http_session()))
         except (TimeExhausted, Exception) as e:
             self.logger.error(f"Error connecting to Ethereum node: {e}")
             return False
@@ -183,11 +247,39 @@ class ChiefKeeper:
                 return self._configure_web3()
         return False
 
+    def _connect_to_pool(self):
+        """Connect to all Ethereum nodes through a provider pool"""
+        urls = [self.arguments.rpc_primary_url, self.arguments.rpc_backup_url] + self.arguments.rpc_extra_url
+        timeouts = [self.arguments.rpc_primary_timeout, self.arguments.rpc_backup_timeout] + \
+                   [self.arguments.rpc_primary_timeout] * len(self.arguments.rpc_extra_url)
+        pool = ProviderPool(urls, [self.http_timeout(timeout) for timeout in timeouts],
+                            hedge=self.arguments.rpc_hedge_reads, max_head_lag=self.arguments.rpc_max_head_lag,
+                            sessions=[self.http_session() for _ in urls])
+
+        _web3 = Web3(pool)
+        if not _web3.isConnected():
+            pool.stop()
+            return False
+
+        pool.start()
+        self.web3 = _web3
+        self.node_type = "pool"
+        return self._configure_web3()
+
+    def http_session(self):
+        """A pooled, kept-alive HTTP session for one host"""
+        return http_session(self.arguments.http_pool_size, self.arguments.http2)
+
+    def http_timeout(self, read_timeout: float) -> tuple:
+        """Separate connect and read timeouts, so an unreachable host fails fast"""
+        return min(self.arguments.rpc_connect_timeout, read_timeout), read_timeout
+
     def _configure_web3(self):
         """Configure Web3 connection with private key"""
         try:
             self.web3.eth.defaultAccount = self.arguments.eth_from
             register_keys(self.web3, self.arguments.eth_key)
+            self.web3.middleware_onion.add(rpc_metrics_middleware, "rpc_metrics")
         except Exception as e:
             self.logger.error(f"Error configuring Web3: {e}")
             return False
@@ -208,6 +300,21 @@ class ChiefKeeper:
             self.lifecycle = lifecycle
             lifecycle.on_startup(self.check_deployment)
             lifecycle.on_block(self.process_block)
+            lifecycle.on_shutdown(self.shutdown)
+
+    def shutdown(self):
+        """Writes outstanding database changes to disk before the keeper exits"""
+        self.tip_oracle.stop()
+        self.transactions.stop()
+        self.metrics_server.stop()
+        if self.heads is not None:
+            self.heads.stop()
+        if self.database is not None:
+            self.database.close()
+        if self.engine is not None:
+            self.engine.close()
+        if isinstance(self.web3.provider, ProviderPool):
+            self.web3.provider.stop()
 
     def check_deployment(self):
         self.logger.info("")
@@ -219,6 +326,13 @@ class ChiefKeeper:
         self.logger.info(f"DS-Pause: {self.dss.pause.address}")
         self.logger.info("")
         self.initial_query()
+        self.tip_oracle.start()
+
+        # Heads are only processed once the database exists; Lifecycle keeps polling alongside as a fallback
+        wsUrls = [url for url in [self.arguments.rpc_primary_ws_url, self.arguments.rpc_backup_ws_url] if url]
+        if wsUrls:
+            self.heads = HeadSubscription(wsUrls, self.process_head)
+            self.heads.start()
 
     def initial_query(self):
         """Updates a locally stored database with the DS-Chief state since its last update.
@@ -230,92 +344,213 @@ class ChiefKeeper:
         )
 
         self.database = SimpleDatabase(
-            self.web3, self.deployment_block, self.arguments.network, self.dss
+            self.web3,
+            self.deployment_block,
+            self.arguments.network,
+            self.dss,
+            self.arguments.backfill_workers,
+            self.arguments.db_backend,
+            self.arguments.db_flush_interval,
+            self.arguments.rpc_max_batch_size,
+            self.arguments.snapshot,
         )
         result = self.database.create()
 
         self.logger.info(result)
 
-    def get_initial_tip(self, arguments) -> int:
-        try:
-            result = requests.get(
-                url='https://api.blocknative.com/gasprices/blockprices',
-                headers={
-                    'Authorization': arguments.blocknative_api_key
-                },
-                timeout=15
-            )
-            if result.ok and result.content:
-                confidence_80_tip = result.json().get('blockPrices')[0]['estimatedPrices'][3]['maxPriorityFeePerGas']
-                self.logger.info(f"Using Blocknative 80% confidence tip {confidence_80_tip}")
-                self.logger.info(int(confidence_80_tip * GeometricGasPrice.GWEI))
-                return int(confidence_80_tip * GeometricGasPrice.GWEI)
-        except Exception as e:
-            logging.error(str(e))
-
-        return int(1.5 * GeometricGasPrice.GWEI)
+        self.approval_reader = ApprovalReader(
+            self.web3, self.dss.ds_chief, self.arguments.rpc_max_batch_size
+        )
+        self.approval_index = ApprovalIndex(
+            self.web3,
+            self.approval_reader,
+            self.database.get_slate_yays,
+            self.arguments.approval_reconcile_blocks,
+        )
 
+    def tip_sources(self) -> list:
+        names = self.arguments.gas_tip_source
+        if names is None:
+            names = ["blocknative", "fee_history"] if self.arguments.blocknative_api_key else ["fee_history"]
+
+        sources = {
+            "blocknative": lambda: BlocknativeTipSource(self.http, self.arguments.blocknative_api_key, self.http_timeout(15)),
+            "fee_history": lambda: FeeHistoryTipSource(self.web3),
+        }
+        return [sources[name]() for name in names]
+
+    def block_context(self, block_number: int = None) -> BlockContext:
+        """A read-only view of the chain at `block_number`, the current block by default"""
+        return BlockContext(self.web3, block_number, self.dss.ds_chief, self.database.spell_cache)
+
+    def rpc_status(self) -> tuple:
+        """Whether a JSON-RPC node is usable, and the state of each node for /readyz"""
+        if self.web3 is not None and isinstance(self.web3.provider, ProviderPool):
+            states = self.web3.provider.endpoint_states()
+            return any(state["healthy"] for state in states.values()), states
+        return self.web3 is not None and self.connected, {self.node_type or "node": {"healthy": self.connected}}
+
+    def chain_head(self) -> int:
+        """The latest block number, from the WebSocket subscription while it is connected"""
+        if self.heads is not None and self.heads.connected and self.heads.latest_number is not None:
+            return self.heads.latest_number
+        return self.web3.eth.blockNumber
+
+    def wait_for_block(self, block_number: int) -> bool:
+        """Whether the JSON-RPC node reaches `block_number` within `HEAD_WAIT_TIME` seconds, as a WebSocket head
+        can come from a node ahead of it"""
+        deadline = time.time() + HEAD_WAIT_TIME
+        while self.web3.eth.blockNumber < block_number:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def confirmed_block(self, block_number: int) -> int:
+        """The latest block the yays and etas are indexed up to while `block_number` is the head"""
+        return max(block_number - self.confirmations, 0)
+
+    def process_head(self, head: Head):
+        """Callback called on each head received over WebSocket"""
+        self.process_block(head)
 
     @healthy
-    def process_block(self):
-        """Callback called on each new block. If too many errors, terminate the keeper.
+    def process_block(self, head: Head = None):
+        """Callback called on each new block, either polled by the Lifecycle or received over WebSocket.
+        Each block is only processed once, by whichever arrives first. If too many errors, terminate the keeper.
         This is the entrypoint to the Keeper's monitoring logic
         """
-        try:
-            isConnected = self.web3.isConnected()
-            self.logger.info(f'web3 isConnected: {isConnected}')
-
-            if self.errors >= self.max_errors:
-                self.lifecycle.terminate()
-            else:
-                self.check_hat()
-                self.check_eta()
-        except (TimeExhausted, Exception) as e:
-            self.logger.error(f"Error processing block: {e}")
-            self.errors += 1
-
-    def check_hat(self):
+        with self.block_lock:
+            started = time.perf_counter()
+            try:
+                isConnected = self.web3.isConnected()
+                self.connected = isConnected
+                self.logger.info(f'web3 isConnected: {isConnected}', extra=RATE_LIMITED)
+
+                if self.errors >= self.max_errors:
+                    self.lifecycle.terminate()
+                    return
+
+                if head is not None and not self.wait_for_block(head.number):
+                    self.logger.debug(f"Node hasn't reached block {head.number} of the WebSocket head yet")
+                    return
+
+                # Both checks read the chain through one context pinned to this block
+                context = self.block_context(head.number if head is not None else None)
+                if self.last_processed_block is not None and context.number <= self.last_processed_block:
+                    self.logger.debug(f"Block {context.number} was already processed")
+                    return
+
+                if head is not None:
+                    context.prime(("timestamp",), head.timestamp)
+                    record_block_detected("ws", head.received_at - head.timestamp)
+                else:
+                    record_block_detected("poll", time.time() - context.timestamp())
+                if self.heads is not None:
+                    set_websocket_connected(self.heads.connected)
+
+                # Everything logged from here on carries the block number
+                with log_context(block=context.number):
+                    etched = self.prefetch(context) if self.engine is not None else None
+
+                    # Database writes of the whole block are committed together
+                    self.gas_strategy.begin_block()
+                    with self.database.transaction():
+                        if self.database.check_reorg(self.confirmed_block(context.number)) is not None:
+                            # The prefetched yays and the approvals may come from replaced blocks
+                            self.approval_index.reset()
+                            etched = None
+                        with log_context(phase="check_hat"):
+                            self.check_hat(context, etched)
+                        with log_context(phase="check_eta"):
+                            self.check_eta(context)
+                    self.gas_strategy.end_block()
+                    record_block_processed(time.perf_counter() - started)
+                    # Only a block that was processed in full is skipped when it arrives again
+                    self.last_processed_block = context.number
+
+                    # How far the chain has moved on while the block was processed
+                    blockLag = max(self.chain_head() - context.number, 0)
+                    set_block_lag(blockLag)
+                    health.block_processed(context.number, blockLag, context.number - self.database.last_block)
+            except (TimeExhausted, Exception) as e:
+                self.logger.error(f"Error processing block: {e}")
+                self.errors += 1
+
+    def prefetch(self, context: BlockContext):
+        """Reads the block's independent state concurrently and leaves it in `context`, the approval index and the
+        database caches.
+
+        Besides the block, balance, new etches and DS-Pause notes, this reads the DS-Chief logs and the hat the
+        approval index is updated from, and `done` of the spells whose eta has passed. Only the approvals those
+        logs show changed are read after it. Returns the yays etched since the database was last updated, or None
+        if they couldn't be read. A read that fails here is simply made again when it is needed.
+        """
+        engine = self.engine
+        database = self.database
+        block = hex(context.number)
+        confirmed = self.confirmed_block(context.number)
+        # Block timestamps trail the wall clock, so this may include a spell that only becomes due next block
+        due = [yay for yay, eta in database.get_db_etas().items() if eta <= time.time()]
+
+        reads = {
+            "block": lambda: engine.call("eth_getBlockByNumber", block, False),
+            "balance": lambda: engine.call("eth_getBalance", self.our_address.address, block),
+            "etched": lambda: engine.blocking(database.get_new_yays, confirmed),
+            "chief_logs": lambda: engine.blocking(self.approval_index.prefetch_logs, context.number),
+            "hat": lambda: engine.blocking(self.approval_index.prefetch_hat, context.number),
+        }
+        if database.etas_block is not None and database.etas_block < confirmed:
+            reads["pause"] = lambda: engine.blocking(database.pause_notes.get, database.etas_block + 1, confirmed)
+        if due:
+            reads["done"] = lambda: engine.blocking(context.prefetch_done, due, self.arguments.rpc_max_batch_size)
+
+        results = engine.gather(reads)
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                self.logger.debug(f"Prefetching {name} on block {context.number} failed: {result}")
+
+        if not isinstance(results["block"], Exception):
+            context.prime(("timestamp",), int(results["block"]["timestamp"], 16))
+        if not isinstance(results["balance"], Exception):
+            set_keeper_balance(int(results["balance"], 16) / 10**18)
+
+        return None if isinstance(results["etched"], Exception) else results["etched"]
+
+    def check_hat(self, context: BlockContext = None, etched: list = None):
         """Ensures the Hat is on the proposal (spell, EOA, multisig, etc) with the most approval.
 
         First, the local database is updated with proposal addresses (yays) that have been `etched` in DSChief between
-        the last block reviewed and the most recent block receieved. Next, it simply traverses through each address,
-        checking if its approval has surpased the current Hat. If it has, it will `lift` the hat.
+        the last block reviewed and the most recent block with `--confirmations` confirmations. Next, the approval index re-reads the approvals
+        that changed since the last block and returns the address with the most approval. If its approval has
+        surpased the current Hat, it will `lift` the hat in the background.
 
-        If the current or new hat hasn't been casted nor plotted in the pause, it will `schedule` the spell
+        If the current hat hasn't been casted nor plotted in the pause, it will `schedule` the spell
         """
-        blockNumber = self.web3.eth.blockNumber
-        self.logger.info(f"Checking Hat on block {blockNumber}")
+        context = context or self.block_context()
+        blockNumber = context.number
+        self.logger.info(f"Checking Hat on block {blockNumber}", extra=RATE_LIMITED)
 
         try:
-            self.database.update_db_yays(blockNumber)
+            with time_block_phase("db_yays"):
+                self.database.update_db_yays(self.confirmed_block(blockNumber), etched)
         except (TimeExhausted, Exception) as e:
             self.logger.error(f"Error updating database yays: {e}")
             self.errors += 1
             return
 
-        yays = self.database.db.get(doc_id=2)["yays"]
+        yays = self.database.get_db_yays()
 
-        hat = self.dss.ds_chief.get_hat().address
-        hatApprovals = self.dss.ds_chief.get_approvals(hat)
+        # Approvals are only re-read for yays touched by DS-Chief logs since the last block
+        with time_block_phase("approvals"):
+            self.approval_index.update(yays, blockNumber)
+            contender, highestApprovals = self.approval_index.contender()
+        hat = self.approval_index.hat
+        hatApprovals = self.approval_index.approvals[hat]
 
         # Check if hat is valid (has approvals)
         is_valid_hat = float(hatApprovals) > 0
         set_hat_validity(is_valid_hat, hat)
-        
-        contender, highestApprovals = hat, hatApprovals
-
-        gas_strategy = GeometricGasPrice(
-            web3=self.web3,
-            initial_price=None,
-            initial_tip=self.get_initial_tip(self.arguments),
-            every_secs=180
-        )
-
-        for yay in yays:
-            contenderApprovals = self.dss.ds_chief.get_approvals(yay)
-            if contenderApprovals > highestApprovals:
-                contender = yay
-                highestApprovals = contenderApprovals
 
         if contender != hat:
             self.logger.info(f"Lifting hat")
@@ -325,92 +560,88 @@ class ChiefKeeper:
             # Record lift attempt
             record_lift_called(hat, contender)
             
-            try:
-                self.dss.ds_chief.lift(Address(contender)).transact(
-                    gas_strategy=gas_strategy
-                )
-                # Record successful hat change
-                record_new_hat_event(hat, contender)
-            except Exception as e:
-                # Record invalid lift attempt
+            def lifted(receipt):
+                if receipt is not None and receipt.successful:
+                    # Record successful hat change
+                    record_new_hat_event(hat, contender)
+                    self.logger.info(f"Confirmed ({contender}) now has the hat")
+                else:
+                    # Record invalid lift attempt
+                    record_invalid_lift_called(hat, contender)
+                    self.logger.error(f"Error lifting hat to ({contender})")
+
+            # The lift is sent in the background; the new hat is scheduled on a block after it is included
+            with time_block_phase("transact"):
+                sent = self.transactions.submit(("lift", contender), lambda: self.dss.ds_chief.lift(Address(contender)),
+                                                self.gas_strategy, lifted, blockNumber)
+            if not sent and not self.transactions.is_pending(("lift", contender)):
+                # The lift would revert
                 record_invalid_lift_called(hat, contender)
-                self.logger.error(f"Error lifting hat: {e}")
-                raise
-        else:
-            self.logger.info(f"Current hat ({hat}) with Approvals {hatApprovals}")
+            return
 
-        # Read the hat; either is equivalent to the contender or old hat
-        hatNew = self.dss.ds_chief.get_hat().address
-        if hatNew != hat:
-            self.logger.info(f"Confirmed ({contender}) now has the hat")
+        self.logger.info(f"Current hat ({hat}) with Approvals {hatApprovals}", extra=RATE_LIMITED)
 
-        spell = (
-            DSSSpell(self.web3, Address(hatNew))
-            if is_contract_at(self.web3, Address(hatNew))
-            else None
-        )
+        spell = context.spell(hat) if context.is_contract(hat) else None
+        scheduled = spell is not None and (context.done(hat) or context.eta(hat) != 0)
 
         # Schedules spells that haven't been scheduled nor casted
         if spell is not None:
             # Functional with DSSSpells but not DSSpells (not compatiable with DSPause)
-            if spell.done() == False and self.database.get_eta_inUnix(spell) == 0:
-                self.logger.info(f"Scheduling spell ({yay})")
-                
+            if not scheduled:
+                self.logger.info(f"Scheduling spell ({hat})")
+
                 # Record schedule attempt
-                record_schedule_called(yay)
-                
-                spell.schedule().transact(gas_strategy=gas_strategy)
+                record_schedule_called(hat)
+
+                with time_block_phase("transact"):
+                    self.transactions.submit(("schedule", hat), spell.schedule, self.gas_strategy, block_number=blockNumber)
         else:
             self.logger.warning(
-                f"Spell is an EOA or 0x0, so keeper will not attempt to call schedule()"
+                f"Spell is an EOA or 0x0, so keeper will not attempt to call schedule()", extra=RATE_LIMITED
             )
 
-    def check_eta(self):
+    def check_eta(self, context: BlockContext = None):
         """Cast spells that meet their schedule.
 
         First, the local database is updated with spells that have been scheduled between the last block
-        reviewed and the most recent block receieved. Next, it simply traverses through each spell address,
-        checking if its schedule has been reached/passed. If it has, it attempts to `cast` the spell.
+        reviewed and the most recent block with `--confirmations` confirmations. Next, it gathers every spell whose schedule has been
+        reached/passed, checks whether they are `done` in one batch, and sends a `cast` for each that isn't.
         """
-        blockNumber = self.web3.eth.blockNumber
-        now = self.web3.eth.getBlock(blockNumber).timestamp
-        self.logger.info(f"Checking scheduled spells on block {blockNumber}")
-
-        self.database.update_db_etas(blockNumber)
-        etas = self.database.db.get(doc_id=3)["upcoming_etas"]
-
-        yays = list(etas.keys())
-
-        for yay in yays:
-            if etas[yay] <= now:
-                spell = (
-                    DSSSpell(self.web3, Address(yay))
-                    if is_contract_at(self.web3, Address(yay))
-                    else None
-                )
-
-                if spell is not None:
-                    gas_strategy = GeometricGasPrice(
-                        web3=self.web3,
-                        initial_price=None,
-                        initial_tip=self.get_initial_tip(self.arguments),
-                        every_secs=180
-                    )
-                    if spell.done() == False:
-                        self.logger.info(f"Casting spell ({spell.address.address})")
-                        receipt = spell.cast().transact(gas_strategy=gas_strategy)
-
-                        if receipt is None or receipt.successful == True:
-                            del etas[yay]
-                    else:
-                        del etas[yay]
-                else:
-                    self.logger.warning(
-                        f"Spell is an EOA or 0x0, so keeper will not attempt to call cast()"
-                    )
-                    del etas[yay]
+        context = context or self.block_context()
+        blockNumber = context.number
+        now = context.timestamp()
+        self.logger.info(f"Checking scheduled spells on block {blockNumber}", extra=RATE_LIMITED)
+
+        with time_block_phase("db_etas"):
+            self.database.update_db_etas(self.confirmed_block(blockNumber), context)
+        etas = self.database.get_db_etas()
+
+        # An eta is only dropped once its plan is executed or dropped on DS-Pause, or the spell is `done`, so a
+        # cast that couldn't be sent is sent again
+        for (action, *intent), receipt in self.transactions.pop_finished().items():
+            if action == "cast" and receipt is None and intent[0] in etas:
+                self.logger.warning(f"Cast of spell ({intent[0]}) failed, it will be sent again")
+
+        due = [yay for yay in etas if etas[yay] <= now]
+        for yay in [yay for yay in due if not context.is_contract(yay)]:
+            self.logger.warning(
+                f"Spell is an EOA or 0x0, so keeper will not attempt to call cast()"
+            )
+            del etas[yay]
+
+        # All due spells are checked for `done` together, and the casts are sent back-to-back with sequential nonces
+        spells = [yay for yay in due if yay in etas]
+        context.prefetch_done(spells, self.arguments.rpc_max_batch_size)
+        for yay in spells:
+            if context.done(yay) == False:
+                spell = context.spell(yay)
+                self.logger.info(f"Casting spell ({spell.address.address})")
+                with time_block_phase("transact"):
+                    self.transactions.submit(("cast", yay), spell.cast, self.gas_strategy, block_number=blockNumber)
+            else:
+                del etas[yay]
 
-        self.database.db.update({"upcoming_etas": etas}, doc_ids=[3])
+        self.database.set_db_etas(etas)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timezone
+from typing import Callable, List
+
+from web3 import Web3
+
+from chief_keeper.rpc import BatchUnavailable, batch_request, eth_call_params
+from chief_keeper.spell import DSSSpell
+from chief_keeper.spell_cache import SpellCache
+
+from pymaker import Address
+from pymaker.governance import DSChief
+
+
+DONE_SELECTOR = Web3.keccak(text="done()")[:4].hex()
+
+
+class BlockContext:
+    """Read-only view of the chain at a single block.
+
+    The block number is fixed when the context is created and every read made through it is pinned to that
+    block and memoized, so one `process_block` cycle sees consistent state and never repeats a call.
+    Transactions sent during the cycle are only observed by the next block's context.
+
+    With a `spell_cache`, code presence, `done` and `eta` are also looked up in the persistent cache,
+    unless the context is older than the cache.
+    """
+
+    def __init__(self, web3: Web3, block_number: int = None, ds_chief: DSChief = None,
+                 spell_cache: SpellCache = None):
+        assert isinstance(web3, Web3)
+
+        self.web3 = web3
+        self.ds_chief = ds_chief
+        self.number = web3.eth.blockNumber if block_number is None else block_number
+        self.spell_cache = spell_cache
+        self._cache = {}
+        self._spells = {}
+        self._synced = False
+
+    def memoize(self, key: tuple, read: Callable):
+        """Returns the value remembered for `key` in this block, reading it on first use"""
+        if key not in self._cache:
+            self._cache[key] = read()
+        return self._cache[key]
+
+    def prime(self, key: tuple, value):
+        """Remembers a value that was read ahead, e.g. concurrently by the async engine"""
+        self._cache[key] = value
+
+    def _use_spell_cache(self) -> bool:
+        if self.spell_cache is not None and not self._synced:
+            self.spell_cache.sync(self.number)
+            self._synced = True
+
+        return self.spell_cache is not None and self.number >= self.spell_cache.block
+
+    def _cached(self, field: str, address: str, read: Callable):
+        if not self._use_spell_cache():
+            return read()
+
+        return getattr(self.spell_cache, field)(address, read)
+
+    def timestamp(self) -> int:
+        return self.memoize(("timestamp",), lambda: self.web3.eth.getBlock(self.number).timestamp)
+
+    def hat(self) -> str:
+        assert self.ds_chief is not None
+        return self.memoize(("hat",), lambda: Web3.toChecksumAddress(
+            self.ds_chief._contract.functions.hat().call(block_identifier=self.number)))
+
+    def is_contract(self, address: str) -> bool:
+        def read():
+            code = self.web3.eth.getCode(Web3.toChecksumAddress(address), block_identifier=self.number)
+            return code is not None and len(code) > 0
+
+        return self.memoize(("is_contract", address), lambda: self._cached("is_contract", address, read))
+
+    def spell(self, address: str) -> DSSSpell:
+        if address not in self._spells:
+            self._spells[address] = DSSSpell(self.web3, Address(address))
+        return self._spells[address]
+
+    def done(self, address: str) -> bool:
+        def read():
+            return self.spell(address).done(block_identifier=self.number)
+
+        return self.memoize(("done", address), lambda: self._cached("done", address, read))
+
+    def prefetch_done(self, addresses: List[str], max_batch_size: int = 500):
+        """Reads `done` of all spells in `addresses` that aren't known yet with one JSON-RPC batch.
+
+        Where the node can't batch, or a call fails, `done()` reads the spell on its own later.
+        """
+        use_spell_cache = self._use_spell_cache()
+        missing = [address for address in addresses if ("done", address) not in self._cache
+                   and not (use_spell_cache and self.spell_cache.has(address, "done"))]
+        if not missing:
+            return
+
+        calls = [("eth_call", eth_call_params(address, DONE_SELECTOR, self.number)) for address in missing]
+        try:
+            results = batch_request(self.web3, calls, max_batch_size)
+        except BatchUnavailable:
+            return
+
+        for address, result in zip(missing, results):
+            if not isinstance(result, Exception):
+                value = int(result, 16) != 0
+                self.memoize(("done", address), lambda: self._cached("done", address, lambda: value))
+
+    def eta(self, address: str) -> float:
+        """The spell's eta in unix time, 0 if it hasn't been scheduled"""
+        def read():
+            eta = self.spell(address).eta(block_identifier=self.number)
+            return eta.replace(tzinfo=timezone.utc).timestamp()
+
+        return self.memoize(("eta", address), lambda: self._cached("eta", address, read))
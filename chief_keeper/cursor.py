@@ -0,0 +1,89 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from typing import Dict, Optional
+
+from web3 import Web3
+
+REORG_DEPTH = 128
+
+
+class BlockCursor:
+    """Hashes of the last `depth` blocks the keeper's indexes were brought up to, to notice when a reorg replaced them.
+
+    Each block `sync()` reads the block the indexes are about to move to. If it doesn't descend from the last
+    recorded block, the recorded blocks are compared with the chain, newest first, until one still matches;
+    the block after it is where the reorg starts. A reorg deeper than `depth` is reported at the oldest block
+    recorded.
+    """
+
+    def __init__(self, web3: Web3, depth: int = REORG_DEPTH):
+        assert isinstance(web3, Web3)
+        assert depth > 0
+
+        self.web3 = web3
+        self.depth = depth
+        self.hashes = {}
+        self.logger = logging.getLogger()
+
+    def load(self, hashes: Dict[int, str]):
+        self.hashes = {int(number): block_hash for number, block_hash in hashes.items()}
+
+    @property
+    def last_block(self) -> Optional[int]:
+        return max(self.hashes) if self.hashes else None
+
+    def sync(self, block_number: int) -> Optional[int]:
+        """Records the hash of `block_number` and returns the first block replaced by a reorg since the last
+        recorded one, or None if there was none"""
+        last = self.last_block
+        if last is not None and block_number <= last:
+            return None
+
+        block = self.web3.eth.getBlock(block_number)
+        fork = None
+        if last is not None:
+            if block_number == last + 1:
+                unchanged = Web3.toHex(block["parentHash"]) == self.hashes[last]
+            else:
+                unchanged = self._matches(last)
+            if not unchanged:
+                fork = self._find_fork(last)
+                self.rewind(fork - 1)
+
+        self.hashes[block_number] = Web3.toHex(block["hash"])
+        for number in sorted(self.hashes)[:-self.depth]:
+            del self.hashes[number]
+
+        return fork
+
+    def rewind(self, block_number: int):
+        """Forgets the blocks after `block_number`"""
+        self.hashes = {number: block_hash for number, block_hash in self.hashes.items() if number <= block_number}
+
+    def _matches(self, block_number: int) -> bool:
+        return Web3.toHex(self.web3.eth.getBlock(block_number)["hash"]) == self.hashes[block_number]
+
+    def _find_fork(self, last: int) -> int:
+        numbers = sorted(self.hashes, reverse=True)
+        for number in numbers[1:]:
+            if self._matches(number):
+                return number + 1
+
+        self.logger.warning(f"Reorg is deeper than the {len(numbers)} blocks recorded, rolling back to block {numbers[-1]}")
+        return numbers[-1]
@@ -16,28 +16,103 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import timezone
+import logging
 import os
-from typing import List
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from contextlib import contextmanager
 
-from tinydb import TinyDB, Query
 from web3 import Web3
-from web3.exceptions import TimeExhausted
+from web3.exceptions import ContractLogicError, TimeExhausted
 
+from chief_keeper.backfill import Backfill
+from chief_keeper.context import BlockContext
+from chief_keeper.cursor import REORG_DEPTH, BlockCursor
+from chief_keeper.pause import EXEC, PLOT, PauseNote, PauseNotes
+from chief_keeper.rpc import BatchUnavailable, batch_request
+from chief_keeper.snapshot import SnapshotError, read_snapshot
 from chief_keeper.spell import DSSSpell
+from chief_keeper.spell_cache import SpellCache
+from chief_keeper.storage import SQLiteStore, TinyDBStore, migrate
+
+if TYPE_CHECKING:
+    # Building a full deployment is slow to import, the keeper may only have a `ChiefDeployment`
+    from pymaker.deployment import DssDeployment
+
+# Errors of reading past the end of a slate: DS-Chief predates solc 0.8, so besides reverting a node may report
+# the INVALID opcode of the failed bounds check (geth "invalid opcode: INVALID", Parity "Bad instruction fe")
+SLATE_END_ERRORS = ["revert", "invalid opcode", "bad instruction"]
 
-from pymaker import Address
-from pymaker.util import is_contract_at
-from pymaker.deployment import DssDeployment
+# Longer gaps than this, e.g. after a snapshot load or a long downtime, are caught up on through `Backfill`
+CATCH_UP_BLOCKS = 1000
 
 
 class SimpleDatabase:
-    """Wraps around the logic to create, update, and query the Keeper's local database"""
+    """Wraps around the logic to create, update, and query the Keeper's local database.
+
+    Upcoming etas are kept from the `plot`, `drop` and `exec` notes DS-Pause logs, rather than by polling
+    every yay.
+
+    The last checked block, the yays and the etas are held in memory once the database is created, and
+    per-block work only reads that model. A missing database is created from the `snapshot` file if there is a
+    usable one, and otherwise backfilled from the DS-Chief deployment block. Changes made inside `transaction()` are written back to the store
+    when it exits, or every `flush_interval` seconds from a background thread if one is set. Changes made
+    outside of a transaction are written back immediately.
+
+    Slates are immutable, so the yays of each one are unpacked once, in a single batch of `slates` reads,
+    and kept by slate hash in the store with the rest of the database.
+
+    A `BlockCursor` records the hashes of the blocks the yays and etas were brought up to. Every update is
+    journaled in memory, so when `check_reorg()` finds that a reorg replaced some of those blocks, only the
+    updates of the replaced range are undone, and the next update scans that range again.
+    """
+
+    def __init__(self, web3: Web3, block: int, network: str, deployment: "DssDeployment", backfill_workers: int = 4,
+                 backend: str = "tinydb", flush_interval: float = 0, max_batch_size: int = 500, snapshot: str = None):
+        assert backend in ["tinydb", "sqlite"]
+        assert flush_interval >= 0
 
-    def __init__(self, web3: Web3, block: int, network: str, deployment: DssDeployment):
         self.web3 = web3
         self.deployment_block = block
         self.network = network
         self.dss = deployment
+        self.backfill_workers = backfill_workers
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.snapshot = snapshot
+        self.batching = True
+        self.store = None
+        self.pause_notes = None
+        self.catch_up_path = None
+        self.spell_cache = None
+        self.cursor = None
+        self.logger = logging.getLogger()
+
+        self.last_block = None
+        self.yays = []
+        self.etas = {}
+        self.etas_block = None
+        self.plans = {}
+        self.slates = {}
+        self._max_yays = None
+        self._new_slates = {}
+        self.journal = {}
+        self._new_yays = []
+        self._removed_yays = []
+        self._dirty = set()
+        self._depth = 0
+        self._lock = threading.RLock()
+        # Slates are unpacked from Backfill workers while a block transaction holds `_lock`, so they have their own
+        self._slate_lock = threading.Lock()
+        self._stop_flushing = threading.Event()
+        self._flusher = None
+
+    @property
+    def db(self):
+        """The backend's underlying database (the TinyDB instance with the default backend)"""
+        return self.store.db
 
     def create(self):
         """Updates a locally stored database with the DS-Chief state since its last update.
@@ -48,65 +123,339 @@ class SimpleDatabase:
             os.path.join(parentpath, "database", "db_" + self.network + ".json")
         )
 
-        if os.path.isfile(filepath) and os.access(filepath, os.R_OK):
+        if self.backend == "sqlite":
+            sqlitepath = os.path.splitext(filepath)[0] + ".sqlite"
+            if not os.path.isfile(sqlitepath) and os.path.isfile(filepath):
+                migrate(filepath, sqlitepath)
+            self.store = SQLiteStore(sqlitepath)
+        else:
+            self.store = TinyDBStore(filepath)
+
+        # Code presence and spell state that never changes is cached next to the database
+        self.pause_notes = PauseNotes(self.web3, self.dss.pause.address.address, workers=self.backfill_workers)
+        self.catch_up_path = filepath + ".catchup"
+        self.spell_cache = SpellCache(os.path.splitext(filepath)[0] + ".spells.json", self.pause_notes)
+        self.spell_cache.load(self.web3.eth.blockNumber)
+        self.cursor = BlockCursor(self.web3)
+
+        if self.store.exists():
             # checks if file exists
             result = "Simple database exists and is readable"
-            self.db = TinyDB(filepath)
+            self.store.open()
+        elif self.create_from_snapshot():
+            result = f"Simple database created from snapshot {self.snapshot}"
         else:
             result = (
                 "Either file is missing or is not readable, creating simple database"
             )
-            self.db = TinyDB(filepath)
-
             blockNumber = self.web3.eth.blockNumber
-            self.db.insert({"last_block_checked_for_yays": blockNumber})
-
-            yays = self.get_yays(self.deployment_block, blockNumber)
-            self.db.insert({"yays": yays})
 
+            # Backfill progress is checkpointed next to the database file, so an interrupted bootstrap resumes
+            backfill = Backfill(self.get_yays, filepath + ".backfill", workers=self.backfill_workers)
+            yays = backfill.run(self.deployment_block, blockNumber)
             etas = self.get_etas(yays, blockNumber)
-            self.db.insert({"upcoming_etas": etas})
+
+            # Only create the file once the backfill is complete, so a partial database is never left behind
+            with self._slate_lock:
+                slates, self._new_slates = self._new_slates, {}
+            self.store.initialize(blockNumber, yays, etas, blockNumber, slates)
+
+        self.load()
 
         return result
 
+    def create_from_snapshot(self) -> bool:
+        """Initializes the store with the state of the snapshot file, if there is a usable one"""
+        if self.snapshot is None:
+            return False
+
+        try:
+            state = read_snapshot(self.snapshot, self.network, self.dss.ds_chief.address.address)
+        except SnapshotError as e:
+            self.logger.warning(f"Not starting from snapshot: {e}")
+            return False
+
+        # Blocks since the snapshot are caught up with on the first block, like after any restart
+        self.store.initialize(state["last_block"], state["yays"], state["etas"], state["etas_block"], state["slates"])
+        self.store.set_block_hashes(state["block_hashes"])
+        return True
+
+    def load(self):
+        """Reads the store into the in-memory model and starts the background flushes"""
+        with self._lock:
+            self.last_block = self.store.get_last_block()
+            self.yays = list(self.store.get_yays())
+            self.etas = dict(self.store.get_etas())
+            self.etas_block = self.store.get_etas_block()
+            with self._slate_lock:
+                self.slates.update(self.store.get_slates())
+            if self.cursor is not None:
+                self.cursor.load(self.store.get_block_hashes())
+            self.journal = {}
+            self._new_yays = []
+            self._removed_yays = []
+            self._dirty = set()
+
+        if self.flush_interval > 0 and self._flusher is None:
+            self._stop_flushing.clear()
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
     def get_eta_inUnix(self, spell: DSSSpell) -> int:
         eta = spell.eta()
         etaInUnix = eta.replace(tzinfo=timezone.utc).timestamp()
 
         return etaInUnix
 
-    def update_db_etas(self, blockNumber: int):
-        """Add yays with upcoming etas"""
-        yays = self.db.get(doc_id=2)["yays"]
-        etas = self.get_etas(yays, blockNumber)
+    @contextmanager
+    def transaction(self):
+        """Applies every database change made inside the block together, or none if it raises"""
+        with self._lock:
+            if self._depth == 0:
+                snapshot = (self.last_block, list(self.yays), dict(self.etas), self.etas_block, dict(self.plans),
+                            dict(self.journal), list(self._new_yays), list(self._removed_yays), set(self._dirty))
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    (self.last_block, self.yays, self.etas, self.etas_block, self.plans,
+                     self.journal, self._new_yays, self._removed_yays, self._dirty) = snapshot
+                raise
+            finally:
+                self._depth -= 1
+
+            if self._depth == 0 and self.flush_interval == 0:
+                self.flush()
+
+    def flush(self):
+        """Writes the changes of the in-memory model back to the store in one store transaction"""
+        with self._lock:
+            if self.spell_cache is not None:
+                self.spell_cache.save()
+
+            # Unpacked slates stay valid when a block is rolled back, so they are written regardless
+            with self._slate_lock:
+                new_slates = dict(self._new_slates)
+            if not (self._dirty or new_slates):
+                return
+
+            with self.store.transaction():
+                if new_slates:
+                    self.store.add_slates(new_slates)
+                if "yays" in self._dirty:
+                    self.store.remove_yays(self._removed_yays)
+                    self.store.add_yays(self._new_yays)
+                if "last_block" in self._dirty:
+                    self.store.set_last_block(self.last_block)
+                if "etas" in self._dirty:
+                    self.store.set_etas(self.etas)
+                if "etas_block" in self._dirty:
+                    self.store.set_etas_block(self.etas_block)
+                if "block_hashes" in self._dirty:
+                    self.store.set_block_hashes(self.cursor.hashes)
+
+            self._new_yays = []
+            self._removed_yays = []
+            self._dirty = set()
+            with self._slate_lock:
+                for key in new_slates:
+                    del self._new_slates[key]
+
+    def close(self):
+        """Stops the background flushes, writes back outstanding changes and closes the store"""
+        self._stop_flushing.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+
+        if self.store is not None:
+            self.flush()
+            self.store.close()
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error writing database back to disk: {e}")
+
+    def _changed(self, field: str):
+        self._dirty.add(field)
+        if self._depth == 0 and self.flush_interval == 0:
+            self.flush()
+
+    def get_db_yays(self) -> List:
+        with self._lock:
+            return list(self.yays)
+
+    def get_db_etas(self) -> dict:
+        with self._lock:
+            return dict(self.etas)
+
+    def set_db_etas(self, etas: dict):
+        with self._lock:
+            if etas != self.etas:
+                self.etas = dict(etas)
+                self._changed("etas")
+
+    def check_reorg(self, blockNumber: int) -> Optional[int]:
+        """Moves the block cursor to `blockNumber`, rolling the yays and etas back first if a reorg replaced
+        blocks they were brought up to. Returns the first replaced block, or None.
+        """
+        with self.transaction():
+            fork = self.cursor.sync(blockNumber)
+            self._changed("block_hashes")
+
+            if fork is not None:
+                self.logger.warning(f"Reorg replaced the blocks from {fork}, rolling the database back to block {fork - 1}")
+                self.rollback(fork - 1)
+
+            return fork
+
+    def rollback(self, blockNumber: int):
+        """Undoes the yay and eta updates journaled after `blockNumber`.
+
+        Updates made before the keeper started aren't journaled: their yays stay, and the etas are polled
+        again on the next update.
+        """
+        with self.transaction():
+            undone = [self.journal.pop(number) for number in sorted(self.journal) if number > blockNumber]
+
+            yayUpdates = [entry["yays"] for entry in undone if "yays" in entry]
+            phantomYays = {yay for update in yayUpdates for yay in update["yays"]}
+            if phantomYays:
+                self.yays = [yay for yay in self.yays if yay not in phantomYays]
+                self._new_yays = [yay for yay in self._new_yays if yay not in phantomYays]
+                self._removed_yays += list(phantomYays)
+                self._changed("yays")
+
+            previousBlock = min(yayUpdates[0]["last_block"], blockNumber) if yayUpdates else blockNumber
+            if self.last_block is not None and self.last_block > previousBlock:
+                self.last_block = previousBlock
+                self._changed("last_block")
+
+            etaUpdates = [entry["etas"] for entry in undone if "etas" in entry]
+            if etaUpdates and etaUpdates[0]["etas_block"] <= blockNumber:
+                self.set_db_etas(etaUpdates[0]["etas"])
+                self.plans = etaUpdates[0]["plans"]
+                self.etas_block = etaUpdates[0]["etas_block"]
+                self._changed("etas_block")
+            elif self.etas_block is not None and self.etas_block > blockNumber:
+                self.etas_block = None
+                self._changed("etas_block")
+
+            if self.pause_notes is not None:
+                self.pause_notes.rewind(blockNumber)
+            if self.spell_cache is not None:
+                # Spells may have been scheduled or cast in the replaced blocks only
+                self.spell_cache.invalidate_unsettled()
+
+    def _journal(self, blockNumber: int, field: str, undo: dict):
+        """Keeps what undoes the first update of `field` up to `blockNumber`"""
+        entry = self.journal.get(blockNumber, {})
+        if field not in entry:
+            # Entries are replaced rather than changed, so `transaction()` can restore the journal
+            self.journal[blockNumber] = {**entry, field: undo}
+
+        for number in sorted(self.journal)[:-REORG_DEPTH]:
+            del self.journal[number]
+
+    def update_db_etas(self, blockNumber: int, context: BlockContext = None):
+        """Add yays with upcoming etas, from the DS-Pause notes logged since the last update"""
+        with self.transaction():
+            if self.etas_block is not None and blockNumber > self.etas_block:
+                self._journal(blockNumber, "etas", {"etas": self.get_db_etas(), "plans": dict(self.plans),
+                                                    "etas_block": self.etas_block})
+
+            if self.etas_block is None:
+                # Databases written before etas were kept from logs are polled once
+                etas = self.get_etas(self.get_db_yays(), blockNumber, context)
+            elif blockNumber > self.etas_block:
+                etas = self.apply_pause_notes(self.get_db_etas(), self.pause_notes.get(self.etas_block + 1, blockNumber))
+            else:
+                return
+
+            self.set_db_etas(etas)
+            self.etas_block = blockNumber
+            self._changed("etas_block")
+
+    def apply_pause_notes(self, etas: Dict[str, float], notes: List[PauseNote]) -> Dict[str, float]:
+        """Adds the yays that scheduled themselves and removes the plans that were dropped or executed"""
+        yays = set(self.yays)
+        for note in notes:
+            plan = (note.usr, note.tag, note.eta)
+            if note.action == PLOT:
+                # A DSSSpell plots its own plan, so `guy` is the spell
+                if note.guy in yays:
+                    etas[note.guy] = float(note.eta)
+                    self.plans[plan] = note.guy
+                continue
+
+            spell = self.plans.pop(plan, None)
+            if spell is None and note.action == EXEC and note.guy in etas:
+                spell = note.guy
+            if spell is None:
+                # Plans plotted before a restart are only known by their eta
+                planned = set(self.plans.values())
+                candidates = [yay for yay, eta in etas.items() if eta == note.eta and yay not in planned]
+                spell = candidates[0] if len(candidates) == 1 else None
+
+            if spell is not None:
+                etas.pop(spell, None)
+                outcome = "executed" if note.action == EXEC else "dropped"
+                self.logger.info(f"Plan of spell ({spell}) was {outcome} on block {note.block_number}")
+
+        return etas
 
-        self.db.update({"upcoming_etas": etas}, doc_ids=[3])
+    def get_etas(self, yays, blockNumber: int, context: BlockContext = None):
+        """Get all upcoming etas, read at `blockNumber`"""
+        if context is None or context.number != blockNumber:
+            context = BlockContext(self.web3, blockNumber, spell_cache=self.spell_cache)
 
-    def get_etas(self, yays, blockNumber: int):
-        """Get all upcoming etas"""
         etas = {}
         for yay in yays:
             # Check if yay is an address to an EOA or a contract
-            if is_contract_at(self.web3, Address(yay)):
-                spell = DSSSpell(self.web3, Address(yay))
-                eta = self.get_eta_inUnix(spell)
+            if context.is_contract(yay):
+                eta = context.eta(yay)
 
-                if (eta > 0) and (spell.done() == False):
-                    etas[spell.address.address] = eta
+                if (eta > 0) and (context.done(yay) == False):
+                    etas[context.spell(yay).address.address] = eta
 
         return etas
 
-    def update_db_yays(self, currentBlockNumber: int):
-        """Store yays that have been `etched` in DS-Chief since the last update"""
-        DBblockNumber = self.db.get(doc_id=1)["last_block_checked_for_yays"]
-        currentYays = self.get_yays(DBblockNumber, currentBlockNumber)
-        oldYays = self.db.get(doc_id=2)["yays"]
+    def update_db_yays(self, currentBlockNumber: int, etched: List = None):
+        """Store yays that have been `etched` in DS-Chief since the last update.
+        `etched` are the yays of that range if they were already fetched.
+        """
+        DBblockNumber = self.last_block
+        if currentBlockNumber < DBblockNumber:
+            return
+        currentYays = self.get_new_yays(currentBlockNumber) if etched is None else etched
+
+        # Yays and the block they were checked up to are written together, duplicates are taken out
+        with self.transaction():
+            known = set(self.yays)
+            newYays = [yay for yay in dict.fromkeys(currentYays) if yay not in known]
+            if currentBlockNumber > DBblockNumber:
+                self._journal(currentBlockNumber, "yays", {"yays": newYays, "last_block": DBblockNumber})
+            if newYays:
+                self.yays += newYays
+                self._new_yays += newYays
+                self._changed("yays")
 
-        # Take out any duplicates
-        newYays = list(dict.fromkeys(oldYays + currentYays))
+            self.last_block = currentBlockNumber
+            self._changed("last_block")
 
-        self.db.update({"yays": newYays}, doc_ids=[2])
-        self.db.update({"last_block_checked_for_yays": currentBlockNumber}, doc_ids=[1])
+    def get_new_yays(self, endBlock: int) -> List[str]:
+        """Get the yays `etched` since the last update, in adaptive chunks when catching up on many blocks"""
+        beginBlock = self.last_block
+        if endBlock - beginBlock + 1 <= CATCH_UP_BLOCKS:
+            return self.get_yays(beginBlock, endBlock)
+
+        self.logger.info(f"Catching up on {endBlock - beginBlock} blocks of etches")
+        backfill = Backfill(self.get_yays, self.catch_up_path, workers=self.backfill_workers)
+        return backfill.run(beginBlock, endBlock)
 
     def get_yays(self, beginBlock: int, endBlock: int):
         """Get all `etched` yays within a given block range"""
@@ -117,26 +466,84 @@ class SimpleDatabase:
             if hasattr(etch, 'yays') and etch.yays:
                 # Use direct yays extraction (new method)
                 yays.extend(etch.yays)
+                self._add_slate(Web3.toHex(etch.slate), list(etch.yays))
             else:
                 # Fallback to slate unpacking (old method)
-                maxYays = self.dss.ds_chief.get_max_yays()
-                yays.extend(self.unpack_slate(etch.slate, maxYays))
+                yays.extend(self.get_slate_yays(etch.slate))
         
         return yays
 
+    def get_max_yays(self) -> int:
+        """DS-Chief's MAX_YAYS, read once per run"""
+        if self._max_yays is None:
+            self._max_yays = self.dss.ds_chief.get_max_yays()
+        return self._max_yays
+
+    def get_slate_yays(self, slate) -> List:
+        """Get the yays of an etched slate, unpacking it only the first time it is seen"""
+        key = Web3.toHex(slate)
+        with self._slate_lock:
+            if key in self.slates:
+                return list(self.slates[key])
+
+        yays = self.unpack_slate(slate, self.get_max_yays())
+        self._add_slate(key, yays)
+        return list(yays)
+
+    def _add_slate(self, key: str, yays: List[str]):
+        with self._slate_lock:
+            if key not in self.slates:
+                self.slates[key] = yays
+                self._new_slates[key] = yays
+
     def unpack_slate(self, slate, maxYays: int) -> List:
         """Unpack the slate into its yay constituents"""
-        yays = []
+        if self.batching:
+            try:
+                return self._unpack_slate_batched(slate, maxYays)
+            except BatchUnavailable as e:
+                self.logger.warning(f"Batched slate reads unavailable, using one call per yay: {e}")
+                self.batching = False
+            except Exception as e:
+                self.logger.warning(f"Batched slate read failed, using one call per yay: {e}")
 
+        yays = []
         for i in range(0, maxYays):
             try:
-                yay = [self.dss.ds_chief.get_yay(slate, i)]
-            except ValueError:
+                yays.append(self.dss.ds_chief.get_yay(slate, i))
+            except ValueError as e:
+                # Reading past the end of the slate fails, any other failure leaves it unknown
+                if not self._is_end_of_slate(e):
+                    raise
                 break
-            yays = yays + yay
 
         return yays
 
+    def _unpack_slate_batched(self, slate, maxYays: int) -> List:
+        chief = self.dss.ds_chief.address.address
+        contract = self.dss.ds_chief._contract
+
+        requests = [
+            ("eth_call", [{"to": chief, "data": contract.encodeABI(fn_name="slates", args=[slate, i])}, "latest"])
+            for i in range(0, maxYays)
+        ]
+        results = batch_request(self.web3, requests, self.max_batch_size)
+
+        yays = []
+        for result in results:
+            if isinstance(result, Exception):
+                if not self._is_end_of_slate(result):
+                    raise result
+                break
+            yays.append(Web3.toChecksumAddress(self.web3.codec.decode_single("address", Web3.toBytes(hexstr=result))))
+
+        return yays
+
+    @staticmethod
+    def _is_end_of_slate(e: Exception) -> bool:
+        message = str(e).lower()
+        return isinstance(e, ContractLogicError) or any(error in message for error in SLATE_END_ERRORS)
+
     # TODO: When time is available, incorporate this recursion
     # inspiration -> https://github.com/makerdao/dai-plugin-governance/blob/master/src/ChiefService.js#L153
     # def unpack_slate(self, slate, i = 0):
@@ -0,0 +1,53 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from web3 import Web3
+
+import pymaker
+from pymaker import Address
+from pymaker.governance import DSChief, DSPause
+
+
+class ChiefDeployment:
+    """The two contracts of a `DssDeployment` the keeper uses, DS-Chief and DS-Pause.
+
+    Reads the same address files as `DssDeployment`, but only builds these two contract objects, so the rest
+    of the deployment and its ABIs are never imported.
+    """
+
+    def __init__(self, ds_chief: DSChief, pause: DSPause):
+        assert isinstance(ds_chief, DSChief)
+        assert isinstance(pause, DSPause)
+
+        self.ds_chief = ds_chief
+        self.pause = pause
+
+    @staticmethod
+    def from_json(web3: Web3, conf: str) -> "ChiefDeployment":
+        addresses = json.loads(conf)
+        return ChiefDeployment(DSChief(web3, Address(addresses["MCD_ADM"])), DSPause(web3, Address(addresses["MCD_PAUSE"])))
+
+    @staticmethod
+    def from_network(web3: Web3, network: str) -> "ChiefDeployment":
+        # pymaker keeps the address files of each network next to its package
+        addresses_path = os.path.join(os.path.dirname(os.path.realpath(pymaker.__file__)), "..", "config",
+                                      f"{network}-addresses.json")
+        with open(addresses_path, "r") as f:
+            return ChiefDeployment.from_json(web3, f.read())
@@ -0,0 +1,88 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict
+
+from web3.providers.base import BaseProvider
+
+from chief_keeper.metrics import record_rpc_request
+
+
+class AsyncEngine:
+    """Runs the independent reads of a block concurrently on an asyncio event loop.
+
+    JSON-RPC requests are sent through the keeper's own web3 provider, so they get the failover and hedging of
+    a `ProviderPool` and reuse the pooled HTTP sessions. They and blocking functions (pymaker calls, HTTP APIs)
+    run on a thread pool, and a semaphore bounds the number in flight, so a block costs about as long as its
+    slowest read rather than the sum of all of them.
+    """
+
+    def __init__(self, provider: BaseProvider, max_in_flight: int = 8):
+        assert isinstance(provider, BaseProvider)
+        assert max_in_flight > 0
+
+        self.provider = provider
+        self.max_in_flight = max_in_flight
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="chief-keeper-engine")
+        self.logger = logging.getLogger()
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created on first use so it belongs to the engine's loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def call(self, method: str, *params) -> Any:
+        return await self.blocking(self._request, method, list(params))
+
+    async def blocking(self, function: Callable, *args) -> Any:
+        async with self.semaphore:
+            return await self.loop.run_in_executor(self.executor, function, *args)
+
+    def gather(self, reads: Dict[str, Callable[[], Awaitable]]) -> Dict[str, Any]:
+        """Runs `reads` concurrently and returns their results by name; a failed read's result is its exception"""
+        async def run():
+            names = list(reads)
+            results = await asyncio.gather(*[reads[name]() for name in names], return_exceptions=True)
+            return dict(zip(names, results))
+
+        return self.loop.run_until_complete(run())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.loop.close()
+
+    def _request(self, method: str, params: list) -> Any:
+        # Sent to the provider directly, past web3's middlewares, so the request is recorded here
+        started = time.perf_counter()
+        try:
+            response = self.provider.make_request(method, params)
+        except Exception:
+            record_rpc_request(method, time.perf_counter() - started, failed=True)
+            raise
+
+        record_rpc_request(method, time.perf_counter() - started, failed="error" in response)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
@@ -0,0 +1,190 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from statistics import median
+from typing import List, Optional
+
+import requests
+from web3 import Web3
+
+from pymaker.gas import GeometricGasPrice
+
+from chief_keeper.log import RATE_LIMITED
+from chief_keeper.metrics import record_gas_fetch_avoided, set_gas_tip, time_block_phase
+
+GWEI = 1000000000
+
+
+class TipSource:
+    """Where a priority fee (tip) in wei comes from; `fetch()` returns None when it has no estimate"""
+    name = None
+
+    def fetch(self) -> Optional[int]:
+        raise NotImplementedError()
+
+
+class BlocknativeTipSource(TipSource):
+    """The 80% confidence tip of Blocknative's next-block estimate"""
+    name = "blocknative"
+
+    def __init__(self, session: requests.Session, api_key: str, timeout=15):
+        self.session = session
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def fetch(self) -> Optional[int]:
+        result = self.session.get(
+            url='https://api.blocknative.com/gasprices/blockprices',
+            headers={'Authorization': self.api_key},
+            timeout=self.timeout
+        )
+        if not (result.ok and result.content):
+            return None
+
+        confidence_80_tip = result.json().get('blockPrices')[0]['estimatedPrices'][3]['maxPriorityFeePerGas']
+        return int(confidence_80_tip * GWEI)
+
+
+class FeeHistoryTipSource(TipSource):
+    """The median, over the last `blocks` blocks, of the `percentile`th percentile tip paid, from `eth_feeHistory`"""
+    name = "fee_history"
+
+    def __init__(self, web3: Web3, percentile: float = 80, blocks: int = 10):
+        assert isinstance(web3, Web3)
+        assert 0 <= percentile <= 100
+
+        self.web3 = web3
+        self.percentile = percentile
+        self.blocks = blocks
+
+    def fetch(self) -> Optional[int]:
+        history = self.web3.eth.fee_history(self.blocks, "latest", [self.percentile])
+        # Empty blocks report a zero reward, which says nothing about the tip needed to get in
+        rewards = [reward[0] for reward in history["reward"] if reward and reward[0] > 0]
+        return int(median(rewards)) if rewards else None
+
+
+class StaticTipSource(TipSource):
+    name = "static"
+
+    def __init__(self, tip: int):
+        self.tip = tip
+
+    def fetch(self) -> Optional[int]:
+        return self.tip
+
+
+class TipOracle:
+    """Serves the latest priority fee estimate, refreshed in the background.
+
+    Every `refresh_interval` seconds the `sources` are asked in order and the first estimate is kept. `tip()`
+    returns it without blocking while it is at most `ttl` seconds old; past that the sources are asked on the
+    spot, ending with `fallback_tip` if none of them has an estimate. With a `refresh_interval` of 0 there is
+    no background refresh, and the tip is only fetched when `tip()` needs it. A `ttl` shorter than the
+    refresh interval is raised to it, as the tip would otherwise go stale between two refreshes.
+    """
+
+    def __init__(self, sources: List[TipSource], refresh_interval: float = 12, ttl: float = 60,
+                 fallback_tip: int = int(1.5 * GWEI)):
+        assert refresh_interval >= 0
+        assert ttl >= 0
+
+        self.logger = logging.getLogger()
+        if ttl < refresh_interval:
+            self.logger.warning(f"Tip TTL of {ttl}s is shorter than the refresh interval, using {refresh_interval}s")
+            ttl = refresh_interval
+
+        self.sources = sources + [StaticTipSource(fallback_tip)]
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+
+        self.value = None
+        self.source = None
+        self.updated_at = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.refresh_interval == 0:
+            return
+        self._thread = threading.Thread(target=self._refresh_periodically, name="chief-keeper-tip", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def refresh(self) -> int:
+        for source in self.sources:
+            try:
+                tip = source.fetch()
+            except Exception as e:
+                self.logger.warning(f"Couldn't read the tip from {source.name}: {e}", extra=RATE_LIMITED)
+                continue
+            if tip is None:
+                continue
+
+            with self._lock:
+                self.value, self.source, self.updated_at = tip, source.name, time.monotonic()
+            set_gas_tip(source.name, tip / GWEI)
+            self.logger.debug(f"Using {source.name} tip of {tip / GWEI} gwei")
+            return tip
+
+    def tip(self) -> int:
+        with self._lock:
+            if self.updated_at is not None and time.monotonic() - self.updated_at <= self.ttl:
+                return self.value
+        return self.refresh()
+
+    def _refresh_periodically(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self.refresh_interval)
+
+
+class GasStrategyFactory:
+    """Builds the keeper's gas strategy, and reads the tip it starts from, only when a transaction is sent.
+
+    Calling the factory returns a fresh `GeometricGasPrice`. Blocks are bracketed with `begin_block()` and
+    `end_block()`, and every block that ends without a strategy having been built counts as an avoided tip
+    fetch in `chief_gas_fetches_avoided`.
+    """
+
+    def __init__(self, web3: Web3, oracle: TipOracle, every_secs: int = 180):
+        assert isinstance(web3, Web3)
+        assert isinstance(oracle, TipOracle)
+
+        self.web3 = web3
+        self.oracle = oracle
+        self.every_secs = every_secs
+        self.built = 0
+
+    def __call__(self) -> GeometricGasPrice:
+        self.built += 1
+        with time_block_phase("tip_fetch"):
+            tip = self.oracle.tip()
+        return GeometricGasPrice(web3=self.web3, initial_price=None, initial_tip=tip, every_secs=self.every_secs)
+
+    def begin_block(self):
+        self.built = 0
+
+    def end_block(self):
+        if self.built == 0:
+            record_gas_fetch_avoided()
@@ -0,0 +1,136 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import Callable, List, NamedTuple
+
+
+class Head(NamedTuple):
+    number: int
+    timestamp: int
+    received_at: float
+
+
+class HeadSubscription:
+    """Subscribes to `newHeads` over WebSocket and hands every new head to `callback`.
+
+    The socket is read on a background thread and the callback runs on a second one, which is only ever
+    given the most recent head, so slow block processing never backs up the socket. When the connection
+    drops the next URL in `urls` is tried, cycling through all of them every `reconnect_delay` seconds.
+    `connected` tells whether heads are currently being received.
+    """
+
+    def __init__(self, urls: List[str], callback: Callable[[Head], None], reconnect_delay: float = 5.0):
+        assert len(urls) > 0
+        assert callable(callback)
+
+        self.urls = urls
+        self.callback = callback
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self.logger = logging.getLogger()
+
+        self._latest = None
+        self._last_number = None
+        self._new_head = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def latest_number(self):
+        """Number of the newest head received, None before the first"""
+        return self._last_number
+
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._receive, name="chief-keeper-heads", daemon=True),
+            threading.Thread(target=self._dispatch, name="chief-keeper-heads-dispatch", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._new_head:
+            self._new_head.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=self.reconnect_delay + 1)
+
+    def _receive(self):
+        loop = asyncio.new_event_loop()
+        attempt = 0
+        while not self._stopped.is_set():
+            url = self.urls[attempt % len(self.urls)]
+            try:
+                loop.run_until_complete(self._subscribe(url))
+            except Exception as e:
+                self.logger.warning(f"WebSocket subscription to {url} failed, falling back to polling: {e}")
+            self.connected = False
+            attempt += 1
+
+            # Every URL is tried once before waiting
+            if attempt % len(self.urls) == 0:
+                self._stopped.wait(self.reconnect_delay)
+        loop.close()
+
+    async def _subscribe(self, url: str):
+        import websockets
+
+        async with websockets.connect(url, ping_interval=20, ping_timeout=20, close_timeout=1) as socket:
+            await socket.send(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]}))
+            response = json.loads(await socket.recv())
+            if "error" in response:
+                raise ValueError(response["error"])
+
+            self.connected = True
+            self.logger.info(f"Subscribed to new heads at {url}")
+            while not self._stopped.is_set():
+                try:
+                    message = json.loads(await asyncio.wait_for(socket.recv(), timeout=1))
+                except asyncio.TimeoutError:
+                    continue
+
+                header = message.get("params", {}).get("result")
+                if header is None:
+                    continue
+
+                head = Head(int(header["number"], 16), int(header["timestamp"], 16), time.time())
+                with self._new_head:
+                    if self._last_number is None or head.number > self._last_number:
+                        self._latest = head
+                        self._last_number = head.number
+                        self._new_head.notify()
+
+    def _dispatch(self):
+        while not self._stopped.is_set():
+            with self._new_head:
+                while self._latest is None and not self._stopped.is_set():
+                    self._new_head.wait()
+                head, self._latest = self._latest, None
+
+            if head is None:
+                continue
+
+            try:
+                self.callback(head)
+            except Exception as e:
+                self.logger.error(f"Error handling new head {head.number}: {e}")
@@ -0,0 +1,181 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s - %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+# `extra` of the steady-state lines logged every block, which `RateLimitFilter` may limit
+RATE_LIMITED = {"rate_limited": True}
+
+# Fields of the block being processed, added to every record logged while it is
+_fields = ContextVar("chief_keeper_log_fields", default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """Adds `fields` (e.g. `block`, `phase`) to the records logged by the enclosed code"""
+    token = _fields.set({**_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+
+class ExitOnCritical(logging.StreamHandler):
+    """Custom class to terminate script execution once
+    log records with severity level ERROR or higher occurred"""
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno > logging.ERROR:
+            sys.exit(1)
+
+
+class ContextFilter(logging.Filter):
+    """Sets the `log_context` fields on each record, as attributes that default to None"""
+
+    def __init__(self, fields=("block", "phase")):
+        super().__init__()
+        self.fields = fields
+
+    def filter(self, record):
+        values = _fields.get()
+        for field in self.fields:
+            setattr(record, field, values.get(field))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets a record from each logging call site through at most once every `interval` seconds.
+
+    Only records logged with `extra=RATE_LIMITED`, the steady-state lines repeated every block, are limited,
+    and never at ERROR and above. The next record let through from a call site carries the number of records
+    dropped before it in `suppressed`.
+    """
+
+    def __init__(self, interval, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self.sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        record.suppressed = 0
+        if record.levelno >= logging.ERROR or not getattr(record, "rate_limited", False):
+            return True
+
+        site = (record.pathname, record.lineno)
+        now = self.clock()
+        with self._lock:
+            last, suppressed = self.sites.get(site, (None, 0))
+            if last is not None and now - last < self.interval:
+                self.sites[site] = (last, suppressed + 1)
+                return False
+            self.sites[site] = (now, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the `log_context` fields and any suppressed count"""
+
+    def __init__(self):
+        super().__init__(datefmt=LOG_DATE_FORMAT)
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ["block", "phase"]:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class ExitOnCriticalQueueHandler(QueueHandler):
+    """Hands records to a `QueueListener` thread, and on a CRITICAL record writes out everything queued
+    before exiting from the thread that logged it, as `ExitOnCritical` does"""
+
+    def __init__(self, log_queue, listener=None):
+        super().__init__(log_queue)
+        self.listener = listener
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno > logging.ERROR:
+            if self.listener is not None:
+                stop_listener(self.listener)
+            sys.exit(1)
+
+
+def stop_listener(listener):
+    """Writes out the queued records and stops the listener thread, if it is still running"""
+    if listener._thread is not None:
+        listener.stop()
+
+
+def configure_logging(level="INFO", json_output=False, queued=False, rate_limit=0, stream=None):
+    """Sets up the root logger.
+
+    By default records are written synchronously by an `ExitOnCritical` handler. With `queued`, they are
+    written by a listener thread instead, so logging never waits for the output. `json_output` formats them
+    as JSON with the block and phase they were logged in, and `rate_limit` only lets a steady-state line logged
+    from the same place through once every so many seconds. Returns the `QueueListener`, if any.
+    """
+    formatter = JsonFormatter() if json_output else logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+    filters = [ContextFilter()] + ([RateLimitFilter(rate_limit)] if rate_limit > 0 else [])
+
+    listener = None
+    if queued:
+        output = logging.StreamHandler(stream)
+        output.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, output)
+        handler = ExitOnCriticalQueueHandler(log_queue, listener)
+        # Only the message is rendered on the logging thread, the listener's formatter does the rest
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        listener.start()
+        atexit.register(stop_listener, listener)
+    else:
+        handler = ExitOnCritical(stream)
+        handler.setFormatter(formatter)
+
+    for log_filter in filters:
+        handler.addFilter(log_filter)
+
+    logging.basicConfig(force=True, handlers=[handler])
+    logging.getLogger().setLevel(logging.getLevelName(level))
+    return listener
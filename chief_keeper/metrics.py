@@ -1,29 +1,243 @@
 import os
+import json
 import time
 import logging
 import threading
-from prometheus_client import Counter, Gauge, start_http_server
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+from prometheus_client import Counter, Gauge, Histogram, Info, MetricsHandler
+
+from chief_keeper.log import RATE_LIMITED, log_context
 
 logger = logging.getLogger(__name__)
 
+
+class AddressLabels:
+    """Keeps the number of distinct address label values, and so of series, bounded.
+
+    Up to `capacity` addresses are used as label values. A new address past that evicts the least recently
+    seen one, removing every series labelled with it, so the most recently active addresses keep their own
+    series. The addresses of one call are never evicted by each other. Addresses unseen for `ttl` seconds are evicted as well, even before the capacity is reached.
+    """
+
+    def __init__(self, capacity=32, ttl=7 * 24 * 3600, clock=time.monotonic):
+        assert capacity > 0
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.last_seen = OrderedDict()
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def labels(self, metric, **labels):
+        """`metric.labels(**labels)` with every address label value bounded"""
+        with self._lock:
+            self._expire()
+            values = {name: self._label(value) if name.endswith('_address') else value for name, value in labels.items()}
+            child = metric.labels(**values)
+            label_values = tuple(values[name] for name in metric._labelnames)
+            addresses = {value for name, value in values.items() if name.endswith('_address')}
+            for address in addresses:
+                self.series[address].add((metric, label_values))
+
+            # Only evicted once this call's series are recorded, so a series is never left without an address
+            evictable = [address for address in self.last_seen if address not in addresses]
+            for address in evictable[:max(len(self.last_seen) - self.capacity, 0)]:
+                self._evict(address)
+            return child
+
+    def _expire(self):
+        now = self.clock()
+        while self.last_seen and now - next(iter(self.last_seen.values())) >= self.ttl:
+            self._evict(next(iter(self.last_seen)))
+
+    def _label(self, address):
+        address = str(address)
+        if address in self.last_seen:
+            self.last_seen[address] = self.clock()
+            self.last_seen.move_to_end(address)
+            return address
+
+        self.last_seen[address] = self.clock()
+        self.series[address] = set()
+        return address
+
+    def _evict(self, address):
+        del self.last_seen[address]
+        for metric, label_values in self.series.pop(address):
+            try:
+                metric.remove(*label_values)
+            except KeyError:
+                pass
+
+
+address_labels = AddressLabels(int(os.environ.get('METRICS_MAX_ADDRESSES', 32)),
+                               float(os.environ.get('METRICS_ADDRESS_TTL', 7 * 24 * 3600)))
+
 # Initialize Prometheus metrics with labels
 chief_new_hat_event = Counter('chief_new_hat_event', 'Counter for new hat events', 
                              ['old_hat_address', 'new_hat_address'])
-chief_valid_hat = Gauge('chief_valid_hat', 'Gauge for valid hat status (1=valid, 0=invalid)',
-                       ['hat_address'])
+chief_valid_hat = Gauge('chief_valid_hat', 'Gauge for valid hat status of the current hat (1=valid, 0=invalid)',
+                        ['hat_address'])
+chief_hat = Info('chief_hat', 'The current hat')
 chief_schedule_called = Counter('chief_schedule_called', 'Counter for schedule function calls',
                               ['spell_address'])
 chief_lift_called = Counter('chief_lift_called', 'Counter for lift function calls',
                           ['old_hat_address', 'new_hat_address'])
 chief_invalid_lift_called = Counter('chief_invalid_lift_called', 'Counter for invalid lift attempts',
                                   ['old_hat_address', 'attempted_address'])
+_valid_hat_address = None
+
+chief_keeper_balance = Gauge('chief_keeper_balance', 'ETH balance of the keeper account')
+chief_block_detection_seconds = Histogram('chief_block_detection_seconds',
+                                          'Seconds between a block\'s timestamp and the keeper starting to process it',
+                                          ['source'], buckets=(0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24, 36, 60))
+chief_websocket_connected = Gauge('chief_websocket_connected', 'Whether new heads are received over WebSocket (1) or polled (0)')
+chief_gas_tip_gwei = Gauge('chief_gas_tip_gwei', 'Latest priority fee estimate, by the source it came from', ['source'])
+chief_gas_fetches_avoided = Counter('chief_gas_fetches_avoided', 'Blocks processed without building a gas strategy or reading the tip')
+chief_transaction_inclusion_seconds = Histogram('chief_transaction_inclusion_seconds', 'Seconds from submitting a transaction to its receipt, by action',
+                                                ['action'], buckets=(6, 12, 24, 36, 60, 120, 180, 300, 600, 1200, 3600))
+chief_transactions_pending = Gauge('chief_transactions_pending', 'Transactions submitted and not yet included')
+chief_transactions_deduplicated = Counter('chief_transactions_deduplicated', 'Transactions not sent because the same one was pending, by action',
+                                          ['action'])
+chief_transactions_simulated = Counter('chief_transactions_simulated', 'Transactions simulated before sending, by action and outcome (ok or revert)',
+                                       ['action', 'outcome'])
+chief_http_request_seconds = Histogram('chief_http_request_seconds', 'Latency of outbound HTTP requests, including connection setup',
+                                       ['host'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+chief_rpc_latency_seconds = Gauge('chief_rpc_latency_seconds', 'Moving average of the JSON-RPC latency of each node',
+                                  ['endpoint'])
+chief_rpc_error_rate = Gauge('chief_rpc_error_rate', 'Share of the recent JSON-RPC requests to each node that failed',
+                             ['endpoint'])
+chief_rpc_head_lag_blocks = Gauge('chief_rpc_head_lag_blocks', 'Blocks each node\'s head is behind the best node',
+                                  ['endpoint'])
+chief_rpc_hedged_requests = Counter('chief_rpc_hedged_requests', 'Reads also sent to a second node because the first was slow',
+                                    ['endpoint'])
+chief_block_processing_seconds = Histogram('chief_block_processing_seconds', 'Seconds spent processing a block',
+                                           buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 12, 24, 60))
+chief_block_phase_seconds = Histogram('chief_block_phase_seconds', 'Seconds spent in each phase of processing a block',
+                                      ['phase'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 12))
+chief_block_lag_blocks = Gauge('chief_block_lag_blocks', 'Blocks between the head and the last block the keeper processed')
+chief_rpc_requests = Counter('chief_rpc_requests', 'JSON-RPC calls sent, by method, including those sent in batches',
+                             ['method'])
+chief_rpc_request_errors = Counter('chief_rpc_request_errors', 'JSON-RPC calls that failed or returned an error, by method',
+                                   ['method'])
+chief_rpc_request_seconds = Histogram('chief_rpc_request_seconds', 'Latency of JSON-RPC requests, by method; batches as `batch`',
+                                      ['method'], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+class Health:
+    """In-memory liveness and readiness of the keeper, served by the `MetricsServer`.
+
+    `beat()` is called whenever a block callback starts and `block_processed()` when a block was processed.
+    The keeper is live while it has beaten (or, before the first block, started) within `max_age` seconds,
+    and ready while it is live, has processed a block within `max_age` seconds and `rpc_status()` reports a
+    usable node. With `file_path`, every beat also writes its timestamp to that file for `health-check.sh`,
+    at most once every `file_interval` seconds.
+    """
+
+    def __init__(self, max_age=900, file_path=None, file_interval=60, clock=time.time):
+        self.max_age = max_age
+        self.file_path = file_path
+        self.file_interval = file_interval
+        self.clock = clock
+        self.rpc_status = lambda: (True, {})
+
+        self.started_at = clock()
+        self.last_beat = None
+        self.last_file_write = None
+        self.last_block = None
+        self.last_block_at = None
+        self.block_lag = None
+        self.db_cursor_age = None
+        self._lock = threading.Lock()
+
+    def configure(self, max_age, file_path, file_interval, rpc_status):
+        self.max_age = max_age
+        self.file_path = file_path
+        self.file_interval = file_interval
+        self.rpc_status = rpc_status
+
+    def beat(self):
+        now = self.clock()
+        with self._lock:
+            self.last_beat = now
+            if not self.file_path or (self.last_file_write is not None and now - self.last_file_write < self.file_interval):
+                return
+            self.last_file_write = now
+
+        try:
+            with open(self.file_path, "w") as f:
+                f.write(str(int(now)) + "\n")
+        except OSError as e:
+            logger.warning(f"Couldn't write the health file {self.file_path}: {e}")
+
+    def block_processed(self, block_number, block_lag, db_cursor_age):
+        with self._lock:
+            self.last_block = block_number
+            self.last_block_at = self.clock()
+            self.block_lag = block_lag
+            self.db_cursor_age = db_cursor_age
+
+    def liveness(self):
+        """Whether the keeper is live, and the state it was judged on"""
+        now = self.clock()
+        with self._lock:
+            since = self.last_beat if self.last_beat is not None else self.started_at
+            status = {
+                "seconds_since_beat": None if self.last_beat is None else round(now - self.last_beat, 3),
+                "last_processed_block": self.last_block,
+                "seconds_since_last_block": None if self.last_block_at is None else round(now - self.last_block_at, 3),
+                "block_lag": self.block_lag,
+                "db_cursor_age_blocks": self.db_cursor_age,
+            }
+        return now - since <= self.max_age, status
+
+    def readiness(self):
+        """Whether the keeper is ready, and the state it was judged on"""
+        live, status = self.liveness()
+        try:
+            rpc_ok, rpc = self.rpc_status()
+        except Exception as e:
+            rpc_ok, rpc = False, {"error": str(e)}
+        status["rpc"] = rpc
+
+        processed = status["seconds_since_last_block"] is not None and status["seconds_since_last_block"] <= self.max_age
+        return live and processed and rpc_ok, status
+
+
+health = Health()
+
+
+class HealthMetricsHandler(MetricsHandler):
+    """Serves `/healthz` and `/readyz` from `health`, and the Prometheus metrics on every other path"""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/healthz':
+            self.send_health(*health.liveness())
+        elif path == '/readyz':
+            self.send_health(*health.readiness())
+        else:
+            super().do_GET()
+
+    def send_health(self, ok, status):
+        body = json.dumps({"ok": ok, **status}).encode("utf-8")
+        self.send_response(200 if ok else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 
 class MetricsServer:
-    """Prometheus metrics server for the Chief Keeper"""
+    """Prometheus metrics server for the Chief Keeper, also serving its liveness and readiness"""
     
     def __init__(self, host='0.0.0.0', port=9090):
         self.host = host
         self.port = int(os.environ.get('METRICS_PORT', port))
+        self.server = None
         self.server_thread = None
         self.is_running = False
         
@@ -31,38 +245,143 @@ class MetricsServer:
         """Start the metrics server in a separate thread"""
         if self.is_running:
             return
-            
-        def run_server():
-            logger.info(f"Starting Prometheus metrics server on {self.host}:{self.port}")
-            start_http_server(self.port, self.host)
-            self.is_running = True
-            
-        self.server_thread = threading.Thread(target=run_server)
+
+        logger.info(f"Starting Prometheus metrics server on {self.host}:{self.port}")
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), HealthMetricsHandler)
+        except OSError as e:
+            # As before, the keeper keeps running without its metrics
+            logger.error(f"Couldn't start the metrics server on {self.host}:{self.port}: {e}")
+            return
+        self.server.daemon_threads = True
+        # With port 0, the port the server was given
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name="chief-keeper-metrics")
         self.server_thread.daemon = True
         self.server_thread.start()
-        
+        self.is_running = True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.is_running = False
+
 def record_new_hat_event(old_hat_address, new_hat_address):
     """Record a new hat event"""
-    chief_new_hat_event.labels(old_hat_address=old_hat_address, new_hat_address=new_hat_address).inc()
+    address_labels.labels(chief_new_hat_event, old_hat_address=old_hat_address, new_hat_address=new_hat_address).inc()
     logger.info(f"METRIC: New hat event recorded - Old hat: {old_hat_address}, New hat: {new_hat_address}")
     
 def set_hat_validity(is_valid, hat_address):
     """Set the hat validity (1 for valid, 0 for invalid)"""
+    global _valid_hat_address
     value = 1 if is_valid else 0
-    chief_valid_hat.labels(hat_address=hat_address).set(value)
-    logger.info(f"METRIC: Hat validity set to {value} for address {hat_address}")
+    # Only the current hat keeps a series, the previous hat's is removed when it changes
+    if _valid_hat_address is not None and _valid_hat_address != str(hat_address):
+        chief_valid_hat.remove(_valid_hat_address)
+    _valid_hat_address = str(hat_address)
+    chief_valid_hat.labels(hat_address=_valid_hat_address).set(value)
+    chief_hat.info({'hat_address': str(hat_address)})
+    logger.info(f"METRIC: Hat validity set to {value} for address {hat_address}", extra=RATE_LIMITED)
     
 def record_schedule_called(spell_address):
     """Record a schedule function call"""
-    chief_schedule_called.labels(spell_address=spell_address).inc()
+    address_labels.labels(chief_schedule_called, spell_address=spell_address).inc()
     logger.info(f"METRIC: Schedule function call recorded for spell {spell_address}")
     
 def record_lift_called(old_hat_address, new_hat_address):
     """Record a lift function call"""
-    chief_lift_called.labels(old_hat_address=old_hat_address, new_hat_address=new_hat_address).inc()
+    address_labels.labels(chief_lift_called, old_hat_address=old_hat_address, new_hat_address=new_hat_address).inc()
     logger.info(f"METRIC: Lift function call recorded - Old hat: {old_hat_address}, New hat: {new_hat_address}")
     
 def record_invalid_lift_called(old_hat_address, attempted_address):
     """Record an invalid lift attempt"""
-    chief_invalid_lift_called.labels(old_hat_address=old_hat_address, attempted_address=attempted_address).inc()
+    address_labels.labels(chief_invalid_lift_called, old_hat_address=old_hat_address, attempted_address=attempted_address).inc()
     logger.info(f"METRIC: Invalid lift attempt recorded - Old hat: {old_hat_address}, Attempted: {attempted_address}")
+
+def set_keeper_balance(balance_eth):
+    """Set the ETH balance of the keeper account"""
+    chief_keeper_balance.set(balance_eth)
+
+def record_block_detected(source, seconds):
+    """Record how long after its timestamp a block was picked up, by `ws` or `poll`"""
+    chief_block_detection_seconds.labels(source=source).observe(max(seconds, 0))
+
+def set_websocket_connected(connected):
+    """Set whether new heads are received over WebSocket"""
+    chief_websocket_connected.set(1 if connected else 0)
+
+def set_rpc_endpoint_state(endpoint, latency, error_rate, head_lag):
+    """Set the latency, error rate and head lag of a JSON-RPC node"""
+    chief_rpc_latency_seconds.labels(endpoint=endpoint).set(latency)
+    chief_rpc_error_rate.labels(endpoint=endpoint).set(error_rate)
+    chief_rpc_head_lag_blocks.labels(endpoint=endpoint).set(head_lag)
+
+def record_rpc_hedged(endpoint):
+    """Record a read hedged to a second node"""
+    chief_rpc_hedged_requests.labels(endpoint=endpoint).inc()
+
+def record_http_request(host, seconds):
+    """Record the latency of an outbound HTTP request to `host`"""
+    chief_http_request_seconds.labels(host=host).observe(seconds)
+
+def set_gas_tip(source, tip_gwei):
+    """Set the latest priority fee estimate of a tip source"""
+    chief_gas_tip_gwei.labels(source=source).set(tip_gwei)
+
+def record_gas_fetch_avoided():
+    """Record a block that needed no gas strategy"""
+    chief_gas_fetches_avoided.inc()
+
+def record_transaction_included(action, seconds):
+    """Record how long a `lift`, `schedule` or `cast` took to be included"""
+    chief_transaction_inclusion_seconds.labels(action=action).observe(seconds)
+
+def set_transactions_pending(count):
+    """Set the number of transactions waiting to be included"""
+    chief_transactions_pending.set(count)
+
+def record_transaction_deduplicated(action):
+    """Record a transaction skipped because the same one was pending"""
+    chief_transactions_deduplicated.labels(action=action).inc()
+
+def record_transaction_simulated(action, outcome):
+    """Record the simulated outcome of a transaction, `ok` or `revert`"""
+    chief_transactions_simulated.labels(action=action, outcome=outcome).inc()
+
+def record_block_processed(seconds):
+    """Record how long a block took to process"""
+    chief_block_processing_seconds.observe(seconds)
+
+def record_block_phase(phase, seconds):
+    """Record how long a phase of a block (`db_yays`, `approvals`, `db_etas`, `tip_fetch`, `transact`) took"""
+    chief_block_phase_seconds.labels(phase=phase).observe(seconds)
+
+@contextmanager
+def time_block_phase(phase):
+    """Times the enclosed code as a phase of the block, whether or not it raises, and logs it with the phase"""
+    started = time.perf_counter()
+    try:
+        with log_context(phase=phase):
+            yield
+    finally:
+        record_block_phase(phase, time.perf_counter() - started)
+
+def set_block_lag(blocks):
+    """Set how many blocks the head is ahead of the last processed block"""
+    chief_block_lag_blocks.set(max(blocks, 0))
+
+def record_rpc_request(method, seconds, failed=False):
+    """Record a single JSON-RPC request"""
+    chief_rpc_requests.labels(method=method).inc()
+    chief_rpc_request_seconds.labels(method=method).observe(seconds)
+    if failed:
+        chief_rpc_request_errors.labels(method=method).inc()
+
+def record_rpc_batch(methods, seconds, failed_methods=()):
+    """Record a JSON-RPC batch: every call by its method, the round-trip as `batch`"""
+    for method in methods:
+        chief_rpc_requests.labels(method=method).inc()
+    for method in failed_methods:
+        chief_rpc_request_errors.labels(method=method).inc()
+    chief_rpc_request_seconds.labels(method="batch").observe(seconds)
@@ -0,0 +1,152 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from typing import List, NamedTuple
+
+from eth_abi import decode_abi
+from hexbytes import HexBytes
+from web3 import Web3
+
+from chief_keeper.approvals import note_topic
+from chief_keeper.backfill import Backfill
+
+PLOT = "plot"
+DROP = "drop"
+EXEC = "exec"
+
+# DS-Pause functions that change a plan, all logged with ds-note's `LogNote`
+PAUSE_TOPICS = {
+    note_topic("plot(address,bytes32,bytes,uint256)"): PLOT,
+    note_topic("drop(address,bytes32,bytes,uint256)"): DROP,
+    note_topic("exec(address,bytes32,bytes,uint256)"): EXEC,
+}
+
+
+class PauseNote(NamedTuple):
+    """A DS-Pause `plot`, `drop` or `exec` call.
+
+    `guy` is the caller, which is the spell itself when a DSSSpell schedules or casts itself.
+    `usr`, `tag`, `fax` and `eta` identify the plan.
+    """
+    action: str
+    guy: str
+    usr: str
+    tag: bytes
+    fax: bytes
+    eta: int
+    block_number: int
+
+
+def _to_bytes(value) -> bytes:
+    return bytes(HexBytes(value))
+
+
+def parse_pause_note(log: dict) -> PauseNote:
+    topics = [_to_bytes(topic) for topic in log["topics"]]
+    action = PAUSE_TOPICS["0x" + topics[0].hex()]
+
+    # LogNote data is (wad, fax), where fax is the calldata of the call
+    _, calldata = decode_abi(["uint256", "bytes"], _to_bytes(log["data"]))
+    usr, tag, fax, eta = decode_abi(["address", "bytes32", "bytes", "uint256"], calldata[4:])
+
+    return PauseNote(
+        action=action,
+        guy=Web3.toChecksumAddress(topics[1][12:]),
+        usr=Web3.toChecksumAddress(usr),
+        tag=tag,
+        fax=fax,
+        eta=eta,
+        block_number=log["blockNumber"],
+    )
+
+
+def get_pause_notes(web3: Web3, pause_address: str, from_block: int, to_block: int) -> List[PauseNote]:
+    """All `plot`, `drop` and `exec` calls on DS-Pause within a block range, in chain order"""
+    logs = web3.eth.getLogs({
+        "address": pause_address,
+        "fromBlock": from_block,
+        "toBlock": to_block,
+        "topics": [list(PAUSE_TOPICS)],
+    })
+
+    return [parse_pause_note(log) for log in logs]
+
+
+class PauseNotes:
+    """Fetches DS-Pause notes for several consumers with a single `eth_getLogs` per block.
+
+    Each consumer tracks the block it has processed up to and asks for the range it is missing. Notes of the
+    last `keep_blocks` fetched blocks are kept, so a range that was already fetched is answered from memory
+    and only the blocks beyond it are queried. A range longer than `catch_up_blocks`, e.g. after a long
+    downtime, is fetched in adaptive chunks through `Backfill`.
+    """
+
+    def __init__(self, web3: Web3, pause_address: str, keep_blocks: int = 256, catch_up_blocks: int = 1000,
+                 workers: int = 4):
+        assert isinstance(web3, Web3)
+        assert keep_blocks > 0
+        assert catch_up_blocks > 0
+
+        self.web3 = web3
+        self.pause_address = pause_address
+        self.keep_blocks = keep_blocks
+        self.catch_up_blocks = catch_up_blocks
+        self.workers = workers
+        self.from_block = None
+        self.to_block = None
+        self.notes = []
+        self._lock = threading.Lock()
+
+    def get(self, from_block: int, to_block: int) -> List[PauseNote]:
+        with self._lock:
+            if self.from_block is None or not self.from_block <= from_block <= self.to_block + 1:
+                self.notes = self._fetch(from_block, to_block)
+                self.from_block, self.to_block = from_block, to_block
+            elif to_block > self.to_block:
+                self.notes += self._fetch(self.to_block + 1, to_block)
+                self.to_block = to_block
+
+            notes = [note for note in self.notes if from_block <= note.block_number <= to_block]
+
+            oldest = self.to_block - self.keep_blocks + 1
+            if self.from_block < oldest:
+                self.notes = [note for note in self.notes if note.block_number >= oldest]
+                self.from_block = oldest
+
+            return notes
+
+    def _fetch(self, from_block: int, to_block: int) -> List[PauseNote]:
+        def fetch(start: int, end: int) -> List[PauseNote]:
+            return get_pause_notes(self.web3, self.pause_address, start, end)
+
+        if to_block - from_block + 1 <= self.catch_up_blocks:
+            return fetch(from_block, to_block)
+
+        # Notes aren't JSON, and the consumers only advance once the whole range is in, so nothing is checkpointed
+        return Backfill(fetch, None, workers=self.workers, unique=False).run(from_block, to_block)
+
+    def rewind(self, block_number: int):
+        """Forgets the notes after `block_number`, e.g. when a reorg replaced those blocks"""
+        with self._lock:
+            if self.from_block is None:
+                return
+            if block_number < self.from_block:
+                self.from_block, self.to_block, self.notes = None, None, []
+            elif block_number < self.to_block:
+                self.notes = [note for note in self.notes if note.block_number <= block_number]
+                self.to_block = block_number
@@ -0,0 +1,106 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from typing import Any, Callable, List, Tuple
+
+from web3 import Web3, HTTPProvider
+from web3._utils.request import make_post_request
+from web3.types import RPCEndpoint, RPCResponse
+
+from chief_keeper.metrics import record_rpc_batch, record_rpc_request
+
+
+class BatchUnavailable(Exception):
+    """Raised when the connected node or provider can't serve JSON-RPC batch requests"""
+    pass
+
+
+def eth_call_params(to: str, data: str, block_number: int) -> list:
+    """Builds the params of an `eth_call` pinned to `block_number`"""
+    return [{"to": to, "data": data}, hex(block_number)]
+
+
+def rpc_metrics_middleware(make_request: Callable[[RPCEndpoint, Any], RPCResponse], web3: Web3) -> Callable:
+    """web3 middleware counting every JSON-RPC request by method, with its latency and whether it failed"""
+    def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+        started = time.perf_counter()
+        try:
+            response = make_request(method, params)
+        except Exception:
+            record_rpc_request(method, time.perf_counter() - started, failed=True)
+            raise
+        record_rpc_request(method, time.perf_counter() - started, failed="error" in response)
+        return response
+
+    return middleware
+
+
+def batch_request(web3: Web3, calls: List[Tuple[str, list]], max_batch_size: int = 500) -> List[Any]:
+    """Sends `calls` ((method, params) pairs) to the node as JSON-RPC batches.
+
+    Returns one entry per call, in order: either the raw `result` or a `ValueError` carrying the
+    node's `error` object, mirroring what web3 raises for a failed single request.
+    """
+    assert isinstance(web3, Web3)
+    assert max_batch_size > 0
+
+    provider = web3.provider
+    if hasattr(provider, "make_batch_request"):
+        send = provider.make_batch_request
+    elif isinstance(provider, HTTPProvider):
+        def send(payload: list) -> Any:
+            raw_response = make_post_request(provider.endpoint_uri, json.dumps(payload).encode("utf-8"),
+                                             **provider.get_request_kwargs())
+            return json.loads(raw_response)
+    else:
+        raise BatchUnavailable(f"{type(provider).__name__} does not support batch requests")
+
+    results = []
+    for start in range(0, len(calls), max_batch_size):
+        chunk = calls[start:start + max_batch_size]
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": i}
+            for i, (method, params) in enumerate(chunk)
+        ]
+        methods = [method for method, _ in chunk]
+        started = time.perf_counter()
+        try:
+            response = send(payload)
+        except Exception:
+            record_rpc_batch(methods, time.perf_counter() - started, methods)
+            raise
+
+        # Nodes without batch support answer with a single error object instead of a list
+        if not isinstance(response, list):
+            record_rpc_batch(methods, time.perf_counter() - started, methods)
+            raise BatchUnavailable(f"Node rejected batch request: {response.get('error', response)}")
+
+        by_id = {item.get("id"): item for item in response}
+        record_rpc_batch(methods, time.perf_counter() - started,
+                         [method for i, method in enumerate(methods) if "error" in by_id.get(i, {"error": None})])
+        for i in range(len(chunk)):
+            item = by_id.get(i)
+            if item is None:
+                results.append(ValueError({"message": "Missing response in batch"}))
+            elif "error" in item:
+                results.append(ValueError(item["error"]))
+            else:
+                results.append(item["result"])
+
+    return results
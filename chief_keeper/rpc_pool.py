@@ -0,0 +1,304 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, List
+from urllib.parse import urlparse
+
+from eth_utils import function_signature_to_4byte_selector
+from web3 import HTTPProvider
+from web3._utils.request import make_post_request
+from web3.providers.base import BaseProvider
+
+from chief_keeper.metrics import record_rpc_hedged, set_rpc_endpoint_state
+
+# DS-Chief reads that decide a lift, `hat()` and `approvals(address)`, which are worth sending to a second node
+# when the first is slow
+HEDGED_SELECTORS = {"0x" + function_signature_to_4byte_selector(signature).hex()
+                    for signature in ["hat()", "approvals(address)"]}
+
+# Filters only exist on the node that created them
+NEW_FILTER_METHODS = {"eth_newBlockFilter", "eth_newFilter", "eth_newPendingTransactionFilter"}
+FILTER_METHODS = {"eth_getFilterChanges", "eth_getFilterLogs", "eth_uninstallFilter"}
+
+# Block hashes returned by block filters that are remembered, to read those blocks from the same node
+KEEP_BLOCK_HASHES = 256
+
+# Errors of a node that hasn't caught up with the block a read is pinned to
+LAGGING_NODE_ERRORS = ["header not found", "unknown block", "missing trie node", "block not found"]
+
+
+def endpoint_names(urls: List[str]) -> List[str]:
+    """Metric-safe endpoint names: the URL's host, which leaves API keys in paths out of the labels"""
+    names = []
+    for url in urls:
+        name = urlparse(url).hostname or url
+        names.append(name if name not in names else f"{name}-{len(names)}")
+    return names
+
+
+class Endpoint:
+    """One JSON-RPC node of a `ProviderPool`, with its recent latency, error rate and head"""
+
+    def __init__(self, name: str, provider: HTTPProvider, window: int = 100):
+        self.name = name
+        self.provider = provider
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.latency = 0.0
+        self.head = None
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint_uri(self) -> str:
+        return self.provider.endpoint_uri
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self.latencies.append(latency)
+            self.outcomes.append(ok)
+            # Exponentially weighted, so a node that slows down is routed around within a few requests
+            self.latency = latency if len(self.latencies) == 1 else 0.8 * self.latency + 0.2 * latency
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            return 0.0 if not self.outcomes else self.outcomes.count(False) / len(self.outcomes)
+
+    def p95(self, default: float) -> float:
+        with self._lock:
+            if len(self.latencies) < 10:
+                return default
+            latencies = sorted(self.latencies)
+            return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+class ProviderPool(BaseProvider):
+    """web3 provider over several JSON-RPC nodes that sends each request to the fastest healthy one.
+
+    A node is healthy while its recent error rate is at most `max_error_rate` and its head is at most
+    `max_head_lag` blocks behind the best node; heads are refreshed every `head_interval` seconds. Requests
+    that fail in transport, or because the node hasn't reached the block they are pinned to, are retried on
+    the next node. With `hedge`, the DS-Chief hat and approval reads (`HEDGED_SELECTORS`), alone or in a batch
+    of only those, are also sent to the second node if the first hasn't answered within its p95 latency, and
+    the first answer wins.
+
+    Filters are read and uninstalled on the node that created them, and a block whose hash a block filter
+    returned is read from that node first.
+    """
+
+    def __init__(self, urls: List[str], timeouts: list, hedge: bool = False, max_head_lag: int = 3,
+                 max_error_rate: float = 0.5, head_interval: float = 5.0, hedge_delay: float = 0.25,
+                 sessions: list = None):
+        assert len(urls) > 0
+        assert len(urls) == len(timeouts)
+        assert sessions is None or len(sessions) == len(urls)
+
+        super().__init__()
+        self.endpoints = [Endpoint(name, HTTPProvider(url, {"timeout": timeout}, session=session))
+                          for name, url, timeout, session in zip(endpoint_names(urls), urls, timeouts,
+                                                                 sessions or [None] * len(urls))]
+        self.hedge = hedge
+        self.max_head_lag = max_head_lag
+        self.max_error_rate = max_error_rate
+        self.head_interval = head_interval
+        self.hedge_delay = hedge_delay
+        self.logger = logging.getLogger()
+
+        self._filters = {}
+        self._block_hashes = OrderedDict()
+        self._pin_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(self.endpoints), thread_name_prefix="chief-keeper-rpc")
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def endpoint_uri(self) -> str:
+        return self.ranked()[0].endpoint_uri
+
+    def start(self):
+        """Starts refreshing the heads of all nodes in the background"""
+        self.refresh_heads()
+        self._thread = threading.Thread(target=self._refresh_periodically, name="chief-keeper-rpc-heads", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=False)
+
+    def head_lag(self, endpoint: Endpoint) -> int:
+        heads = [e.head for e in self.endpoints if e.head is not None]
+        if endpoint.head is None or not heads:
+            return 0
+        return max(heads) - endpoint.head
+
+    def is_healthy(self, endpoint: Endpoint) -> bool:
+        return endpoint.error_rate <= self.max_error_rate and self.head_lag(endpoint) <= self.max_head_lag
+
+    def ranked(self) -> List[Endpoint]:
+        """Endpoints in the order requests should try them: healthy ones by latency, then the rest"""
+        healthy = [e for e in self.endpoints if self.is_healthy(e)]
+        unhealthy = [e for e in self.endpoints if e not in healthy]
+
+        return sorted(healthy, key=lambda e: e.latency) + sorted(unhealthy, key=lambda e: (e.error_rate, e.latency))
+
+    def endpoint_states(self) -> dict:
+        """The health, latency, error rate and head lag of each node, by name"""
+        return {e.name: {"healthy": self.is_healthy(e), "latency": round(e.latency, 4),
+                         "error_rate": round(e.error_rate, 4), "head_lag": self.head_lag(e)} for e in self.endpoints}
+
+    def refresh_heads(self):
+        for endpoint in self.endpoints:
+            try:
+                response = self._timed(endpoint, lambda e: e.provider.make_request("eth_blockNumber", []))
+                if "result" in response:
+                    endpoint.head = int(response["result"], 16)
+            except Exception as e:
+                self.logger.debug(f"Couldn't read the head of {endpoint.name}: {e}")
+
+        for endpoint in self.endpoints:
+            set_rpc_endpoint_state(endpoint.name, endpoint.latency, endpoint.error_rate, self.head_lag(endpoint))
+
+    def make_request(self, method: str, params: Any) -> dict:
+        def send(endpoint: Endpoint):
+            response = endpoint.provider.make_request(method, params)
+            if "result" in response:
+                self._seen_response(endpoint, method, params, response["result"])
+            return response
+
+        if method in FILTER_METHODS:
+            with self._pin_lock:
+                endpoint = self._filters.get(params[0])
+            if endpoint is not None:
+                # A filter lives on one node, so there's nowhere else to retry it
+                return self._timed(endpoint, send)
+
+        ranked = None
+        if method == "eth_getBlockByHash":
+            with self._pin_lock:
+                source = self._block_hashes.get(params[0])
+            if source is not None:
+                ranked = [source] + [e for e in self.ranked() if e is not source]
+
+        return self._send(send, self.hedge and self._is_hedged(method, params), ranked)
+
+    def make_batch_request(self, payload: list) -> Any:
+        """Sends a JSON-RPC batch and returns the decoded response, a list unless the node rejected it"""
+        def send(endpoint: Endpoint):
+            raw_response = make_post_request(endpoint.endpoint_uri, json.dumps(payload).encode("utf-8"),
+                                             **endpoint.provider.get_request_kwargs())
+            return json.loads(raw_response)
+
+        hedged = self.hedge and all(self._is_hedged(request["method"], request["params"]) for request in payload)
+        return self._send(send, hedged)
+
+    def isConnected(self) -> bool:
+        try:
+            return "result" in self.make_request("web3_clientVersion", [])
+        except Exception:
+            return False
+
+    def _seen_response(self, endpoint: Endpoint, method: str, params: Any, result: Any):
+        if method == "eth_blockNumber":
+            endpoint.head = max(endpoint.head or 0, int(result, 16))
+        elif method in NEW_FILTER_METHODS:
+            with self._pin_lock:
+                self._filters[result] = endpoint
+        elif method == "eth_uninstallFilter":
+            with self._pin_lock:
+                self._filters.pop(params[0], None)
+        elif method == "eth_getFilterChanges" and isinstance(result, list):
+            with self._pin_lock:
+                for block_hash in result:
+                    if isinstance(block_hash, str):
+                        self._block_hashes[block_hash] = endpoint
+                while len(self._block_hashes) > KEEP_BLOCK_HASHES:
+                    self._block_hashes.popitem(last=False)
+
+    @staticmethod
+    def _is_hedged(method: str, params: Any) -> bool:
+        return method == "eth_call" and str(params[0].get("data", ""))[:10] in HEDGED_SELECTORS
+
+    @staticmethod
+    def _is_lagging(response: Any) -> bool:
+        responses = response if isinstance(response, list) else [response]
+        for item in responses:
+            message = str(item.get("error", {}).get("message", "")).lower() if isinstance(item, dict) else ""
+            if any(error in message for error in LAGGING_NODE_ERRORS):
+                return True
+        return False
+
+    def _timed(self, endpoint: Endpoint, send: Callable[[Endpoint], Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            response = send(endpoint)
+        except Exception:
+            endpoint.record(time.perf_counter() - started, False)
+            raise
+
+        endpoint.record(time.perf_counter() - started, not self._is_lagging(response))
+        return response
+
+    def _send(self, send: Callable[[Endpoint], Any], hedge: bool, ranked: List[Endpoint] = None) -> Any:
+        ranked = ranked or self.ranked()
+        last_response, last_error = None, None
+
+        if hedge and len(ranked) > 1:
+            first, second = ranked[0], ranked[1]
+            futures = {self._executor.submit(self._timed, first, send): first}
+            done, _ = wait(futures, timeout=first.p95(self.hedge_delay))
+            if not done:
+                record_rpc_hedged(second.name)
+                futures[self._executor.submit(self._timed, second, send)] = second
+
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if not self._is_lagging(response):
+                        return response
+                    last_response = response
+            ranked = [e for e in ranked if e not in futures.values()]
+
+        for endpoint in ranked:
+            try:
+                response = self._timed(endpoint, send)
+            except Exception as e:
+                self.logger.warning(f"JSON-RPC request to {endpoint.name} failed, trying the next node: {e}")
+                last_error = e
+                continue
+            if not self._is_lagging(response):
+                return response
+            last_response = response
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self.head_interval):
+            self.refresh_heads()
@@ -0,0 +1,106 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection
+
+from chief_keeper.metrics import record_http_request
+
+# Probes idle pooled connections so a NAT or load balancer dropping them is noticed before the next request
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+] + ([
+    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+    (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+] if hasattr(socket, "TCP_KEEPIDLE") else [])
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter with a connection pool of `pool_size` per host and TCP keep-alive on every connection"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+class HTTP2Adapter(BaseAdapter):
+    """Sends requests of a requests session over HTTP/2 with httpx, multiplexing them on one connection per host"""
+
+    def __init__(self, pool_size: int):
+        import httpx
+
+        super().__init__()
+        self.httpx = httpx
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                    max_keepalive_connections=pool_size))
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        try:
+            result = self.client.request(request.method, request.url, headers=dict(request.headers), content=request.body,
+                                         timeout=self.httpx.Timeout(read_timeout, connect=connect_timeout))
+        except self.httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request)
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        # httpx has already decoded the body, so requests must not decode it again
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.headers = CaseInsensitiveDict(result.headers)
+        response.headers.pop("Content-Encoding", None)
+        response._content = result.content
+        response.encoding = result.encoding
+        response.reason = result.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.elapsed = result.elapsed
+        response.connection = self
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+def _record_latency(response: requests.Response, *args, **kwargs):
+    record_http_request(urlparse(response.url).hostname, response.elapsed.total_seconds())
+
+
+def http_session(pool_size: int = 10, http2: bool = False) -> requests.Session:
+    """A requests session for the keeper's outbound calls.
+
+    Connections are kept alive and reused from a pool of `pool_size` per host, responses are accepted
+    gzip-compressed, and the latency of every request is recorded by host in `chief_http_request_seconds`.
+    With `http2`, requests go over HTTP/2 through httpx, which must be installed with its `http2` extra.
+    """
+    assert pool_size > 0
+
+    session = requests.Session()
+    adapter = HTTP2Adapter(pool_size) if http2 else KeepAliveAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    session.hooks["response"].append(_record_latency)
+    return session
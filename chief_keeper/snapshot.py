@@ -0,0 +1,95 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from chief_keeper.storage import SQLiteStore, Store, TinyDBStore
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot can't be used: unreadable, of another version, network or DS-Chief, or corrupted"""
+    pass
+
+
+def checksum(state: dict) -> str:
+    return hashlib.sha256(json.dumps(state, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def write_snapshot(store: Store, path: str, network: str, chief: str):
+    """Writes the state of an open `store` (yays, etas, slates and block cursor) to a snapshot file"""
+    state = {
+        "last_block": store.get_last_block(),
+        "yays": store.get_yays(),
+        "etas": store.get_etas(),
+        "etas_block": store.get_etas_block(),
+        "slates": store.get_slates(),
+        # JSON objects only have string keys
+        "block_hashes": {str(number): block_hash for number, block_hash in store.get_block_hashes().items()},
+    }
+    snapshot = {"version": SNAPSHOT_VERSION, "network": network, "chief": chief, "state": state,
+                "checksum": checksum(state)}
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path: str, network: str, chief: str) -> dict:
+    """Returns the state of a snapshot taken for `network` and `chief`, raising `SnapshotError` if it can't be used"""
+    try:
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Couldn't read snapshot {path}: {e}")
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Snapshot {path} is version {snapshot.get('version')}, expected {SNAPSHOT_VERSION}")
+    if snapshot.get("network") != network or str(snapshot.get("chief")).lower() != chief.lower():
+        raise SnapshotError(f"Snapshot {path} was taken for {snapshot.get('network')} DS-Chief {snapshot.get('chief')}")
+
+    state = snapshot.get("state")
+    if not isinstance(state, dict) or snapshot.get("checksum") != checksum(state):
+        raise SnapshotError(f"Snapshot {path} doesn't match its checksum")
+
+    state["block_hashes"] = {int(number): block_hash for number, block_hash in state["block_hashes"].items()}
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("chief-keeper-snapshot")
+    parser.add_argument("database_path", type=str, help="Existing database (e.g. chief_keeper/database/db_mainnet.json or .sqlite)")
+    parser.add_argument("snapshot_path", type=str, help="Snapshot file to write")
+    parser.add_argument("--network", type=str, required=True, help="Network the database was built on (e.g. 'mainnet')")
+    parser.add_argument("--chief", type=str, required=True, help="Address of the DS-Chief the database indexes")
+    arguments = parser.parse_args(sys.argv[1:])
+
+    store = SQLiteStore(arguments.database_path) if arguments.database_path.endswith(".sqlite") \
+        else TinyDBStore(arguments.database_path)
+    if not store.exists():
+        raise FileNotFoundError(arguments.database_path)
+
+    store.open(read_only=True)
+    write_snapshot(store, arguments.snapshot_path, arguments.network, arguments.chief)
+    store.close()
+    print(f"Wrote snapshot of {arguments.database_path} to {arguments.snapshot_path}")
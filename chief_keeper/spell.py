@@ -44,12 +44,12 @@ class DSSSpell(Contract):
         self.address = address
         self._contract = self._get_contract(web3, self.abi, address)
 
-    def done(self) -> bool:
-        return self._contract.functions.done().call()
+    def done(self, block_identifier="latest") -> bool:
+        return self._contract.functions.done().call(block_identifier=block_identifier)
 
-    def eta(self) -> datetime:
+    def eta(self, block_identifier="latest") -> datetime:
         try:
-            timestamp = self._contract.functions.eta().call()
+            timestamp = self._contract.functions.eta().call(block_identifier=block_identifier)
         except ValueError:
             timestamp = 0
 
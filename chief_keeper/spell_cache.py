@@ -0,0 +1,154 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import threading
+from typing import Callable, List
+
+from chief_keeper.pause import DROP, PauseNote, PauseNotes
+
+
+class SpellCache:
+    """Persistent cache of address -> {is_contract, done, eta}.
+
+    Settled facts are never read again: whether an address holds code, and that a spell is done.
+    The `done` and `eta` of other spells are kept until DS-Pause logs a `plot` or `exec` by that spell,
+    or any `drop`, as a drop doesn't name the spell. The cache is brought up to a block with `sync()`
+    and saved as JSON next to the keeper's database, so it survives restarts. The entries are only
+    rewritten when they change; the block they are synced to is kept in a small file of its own.
+    """
+
+    def __init__(self, path: str, pause_notes: PauseNotes):
+        assert isinstance(pause_notes, PauseNotes)
+
+        self.path = path
+        self.block_path = os.path.splitext(path)[0] + ".block"
+        self.pause_notes = pause_notes
+        self.pause_address = pause_notes.pause_address
+        self.block = None
+        self.saved_block = None
+        self.entries = {}
+        self.dirty = False
+        self.logger = logging.getLogger()
+        self._lock = threading.RLock()
+
+    def load(self, block_number: int):
+        """Reads the cache file, or starts an empty cache at `block_number` if there is none"""
+        with self._lock:
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        content = json.load(f)
+                    if content.get("pause") == self.pause_address:
+                        self.block = max(content["block"], self._load_block())
+                        self.saved_block = self.block
+                        self.entries = content["entries"]
+                        return
+                except ValueError:
+                    self.logger.warning(f"Ignoring unreadable spell cache {self.path}")
+
+            self.block = block_number
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        with self._lock:
+            if self.dirty:
+                self._write(self.path, {"pause": self.pause_address, "block": self.block, "entries": self.entries})
+                self.dirty = False
+            elif self.block != self.saved_block:
+                # The entries on disk are up to date, only the block they are synced to moved. Losing this
+                # write only means the notes since the previous one are applied again on the next start.
+                self._write(self.block_path, {"pause": self.pause_address, "block": self.block}, sync=False)
+            self.saved_block = self.block
+
+    def _load_block(self) -> int:
+        """The block the entries were last synced to without changing, or 0"""
+        try:
+            with open(self.block_path, "r") as f:
+                content = json.load(f)
+            return content["block"] if content.get("pause") == self.pause_address else 0
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    @staticmethod
+    def _write(path: str, content: dict, sync: bool = True):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(content, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    def sync(self, block_number: int):
+        """Invalidates the entries touched by DS-Pause since the last synced block"""
+        with self._lock:
+            if block_number <= self.block:
+                return
+
+            self.apply(self.pause_notes.get(self.block + 1, block_number), block_number)
+
+    def apply(self, notes: List[PauseNote], block_number: int):
+        with self._lock:
+            for note in notes:
+                if note.action == DROP:
+                    self.invalidate_unsettled()
+                else:
+                    self.invalidate(note.guy)
+
+            self.block = block_number
+
+    def invalidate(self, address: str):
+        with self._lock:
+            entry = self.entries.get(address)
+            if entry is not None and not entry.get("done"):
+                entry.pop("done", None)
+                entry.pop("eta", None)
+                self.dirty = True
+
+    def invalidate_unsettled(self):
+        with self._lock:
+            for address in list(self.entries):
+                self.invalidate(address)
+
+    def has(self, address: str, field: str) -> bool:
+        with self._lock:
+            return field in self.entries.get(address, {})
+
+    def is_contract(self, address: str, read: Callable[[], bool]) -> bool:
+        return self._get(address, "is_contract", read)
+
+    def done(self, address: str, read: Callable[[], bool]) -> bool:
+        return self._get(address, "done", read)
+
+    def eta(self, address: str, read: Callable[[], float]) -> float:
+        return self._get(address, "eta", read)
+
+    def _get(self, address: str, field: str, read: Callable):
+        with self._lock:
+            entry = self.entries.get(address, {})
+            if field in entry:
+                return entry[field]
+
+        value = read()
+        with self._lock:
+            self.entries.setdefault(address, {})[field] = value
+            self.dirty = True
+        return value
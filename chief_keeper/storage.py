@@ -0,0 +1,465 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from tinydb import TinyDB
+from tinydb.database import Document
+from tinydb.storages import Storage
+
+LAST_BLOCK_DOC_ID = 1
+YAYS_DOC_ID = 2
+ETAS_DOC_ID = 3
+SLATES_DOC_ID = 4
+
+# Fields of the TinyDB documents that move on every block, rather than when the yays, etas or slates change
+POSITION_FIELDS = {
+    (LAST_BLOCK_DOC_ID, "last_block_checked_for_yays"),
+    (LAST_BLOCK_DOC_ID, "recent_block_hashes"),
+    (ETAS_DOC_ID, "last_block_checked_for_etas"),
+}
+
+
+def write_json(path: str, data, sync: bool = True):
+    """Replaces the JSON file at `path` atomically, fsyncing it first unless `sync` is False"""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(data, f)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class AtomicJSONStorage(Storage):
+    """TinyDB storage that replaces the JSON file atomically, so a crash never leaves it truncated"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def read(self):
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return None
+
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def write(self, data):
+        write_json(self.path, data)
+
+    def close(self):
+        pass
+
+
+class Store:
+    """Storage backend of the keeper's database: the last block checked for yays, the yays, their etas, the
+    last block checked for etas, the yays of every DS-Chief slate unpacked so far and the hashes of the
+    blocks they were last brought up to.
+
+    Writes made inside `transaction()` are applied together when it exits, or not at all if it
+    raises. Outside of a transaction every write is applied immediately.
+    """
+
+    def exists(self) -> bool:
+        raise NotImplementedError()
+
+    def initialize(self, last_block: int, yays: List[str], etas: Dict[str, float], etas_block: int = None,
+                   slates: Dict[str, List[str]] = None):
+        raise NotImplementedError()
+
+    def get_last_block(self) -> int:
+        raise NotImplementedError()
+
+    def get_etas_block(self) -> Optional[int]:
+        """The block `etas` were last brought up to, None for databases written before it was stored"""
+        raise NotImplementedError()
+
+    def get_yays(self) -> List[str]:
+        raise NotImplementedError()
+
+    def get_etas(self) -> Dict[str, float]:
+        raise NotImplementedError()
+
+    def get_slates(self) -> Dict[str, List[str]]:
+        """Yays by slate hash; slates never change once etched, so entries are only ever added"""
+        raise NotImplementedError()
+
+    def get_block_hashes(self) -> Dict[int, str]:
+        """Hashes of the recent blocks the database was brought up to, by block number"""
+        raise NotImplementedError()
+
+    def set_last_block(self, block: int):
+        raise NotImplementedError()
+
+    def add_yays(self, yays: List[str]):
+        raise NotImplementedError()
+
+    def remove_yays(self, yays: List[str]):
+        raise NotImplementedError()
+
+    def set_etas(self, etas: Dict[str, float]):
+        raise NotImplementedError()
+
+    def set_etas_block(self, block: int):
+        raise NotImplementedError()
+
+    def add_slates(self, slates: Dict[str, List[str]]):
+        raise NotImplementedError()
+
+    def set_block_hashes(self, hashes: Dict[int, str]):
+        raise NotImplementedError()
+
+    @contextmanager
+    def transaction(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class TinyDBStore(Store):
+    """The original `db_<network>.json` layout: TinyDB documents holding the last block, yays and etas,
+    followed by a fourth one holding the unpacked slates.
+
+    Inside a transaction writes are buffered and flushed as one rewrite of the file. A transaction that only
+    moves the `POSITION_FIELDS` (the last checked blocks and the recent block hashes), as most blocks do, is
+    written to a small `.positions.json` file next to it instead of rewriting the whole database; the next
+    full rewrite folds them back in and removes that file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.positions_path = os.path.splitext(path)[0] + ".positions.json"
+        self.db = None
+        self.positions = {}
+        self._pending = None
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path) and os.access(self.path, os.R_OK)
+
+    def open(self, read_only: bool = False):
+        """Opens the database; `read_only` leaves the file as it is, without the schema upgrade of older files"""
+        self.db = TinyDB(self.path, storage=AtomicJSONStorage)
+        self.positions = self._read_positions()
+
+        # Databases written before slates were kept only have the first three documents
+        if len(self.db) == ETAS_DOC_ID and not read_only:
+            self.db.insert({"slates": {}})
+
+    def initialize(self, last_block: int, yays: List[str], etas: Dict[str, float], etas_block: int = None,
+                   slates: Dict[str, List[str]] = None):
+        # Positions left by an earlier database at this path don't belong to this one
+        if os.path.isfile(self.positions_path):
+            os.remove(self.positions_path)
+        self.open()
+        self.db.insert_multiple([
+            {"last_block_checked_for_yays": last_block},
+            {"yays": list(yays)},
+            {"upcoming_etas": dict(etas), "last_block_checked_for_etas": etas_block},
+            {"slates": dict(slates or {})},
+        ])
+
+    def get_last_block(self) -> int:
+        return self._get(LAST_BLOCK_DOC_ID, "last_block_checked_for_yays")
+
+    def get_yays(self) -> List[str]:
+        return self._get(YAYS_DOC_ID, "yays")
+
+    def get_etas(self) -> Dict[str, float]:
+        return self._get(ETAS_DOC_ID, "upcoming_etas")
+
+    def get_etas_block(self) -> Optional[int]:
+        return self._get(ETAS_DOC_ID, "last_block_checked_for_etas")
+
+    def get_slates(self) -> Dict[str, List[str]]:
+        return self._get(SLATES_DOC_ID, "slates") or {}
+
+    def get_block_hashes(self) -> Dict[int, str]:
+        hashes = self._get(LAST_BLOCK_DOC_ID, "recent_block_hashes") or {}
+        return {int(number): block_hash for number, block_hash in hashes.items()}
+
+    def set_last_block(self, block: int):
+        self._set(LAST_BLOCK_DOC_ID, "last_block_checked_for_yays", block)
+
+    def add_yays(self, yays: List[str]):
+        self._set(YAYS_DOC_ID, "yays", list(dict.fromkeys(self.get_yays() + yays)))
+
+    def remove_yays(self, yays: List[str]):
+        removed = set(yays)
+        self._set(YAYS_DOC_ID, "yays", [yay for yay in self.get_yays() if yay not in removed])
+
+    def set_etas(self, etas: Dict[str, float]):
+        self._set(ETAS_DOC_ID, "upcoming_etas", dict(etas))
+
+    def set_etas_block(self, block: int):
+        self._set(ETAS_DOC_ID, "last_block_checked_for_etas", block)
+
+    def add_slates(self, slates: Dict[str, List[str]]):
+        self._set(SLATES_DOC_ID, "slates", {**slates, **self.get_slates()})
+
+    def set_block_hashes(self, hashes: Dict[int, str]):
+        # JSON objects only have string keys
+        self._set(LAST_BLOCK_DOC_ID, "recent_block_hashes", {str(number): block_hash for number, block_hash in hashes.items()})
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._depth == 0:
+                self._pending = {}
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    self._pending = None
+                raise
+            else:
+                if self._depth == 1 and self._pending:
+                    self._write(self._pending)
+                    self._pending = None
+            finally:
+                self._depth -= 1
+
+    def _write(self, changes: Dict[int, dict]):
+        fields = {(doc_id, field) for doc_id, document in changes.items() for field in document}
+        if fields <= POSITION_FIELDS:
+            for doc_id, document in changes.items():
+                self.positions.setdefault(doc_id, {}).update(document)
+            # Not fsynced: positions lost in a crash are older ones, which only means blocks are checked again
+            write_json(self.positions_path, {str(doc_id): document for doc_id, document in self.positions.items()},
+                       sync=False)
+            return
+
+        # Positions written to their own file since the last rewrite are folded back into the database
+        merged = {doc_id: dict(document) for doc_id, document in self.positions.items()}
+        for doc_id, document in changes.items():
+            merged.setdefault(doc_id, {}).update(document)
+
+        doc_ids = sorted(merged)
+        documents = []
+        for doc_id in doc_ids:
+            document = dict(self.db.get(doc_id=doc_id))
+            document.update(merged[doc_id])
+            documents.append(Document(document, doc_id))
+        self.db.write_back(documents, doc_ids)
+
+        self.positions = {}
+        if os.path.isfile(self.positions_path):
+            os.remove(self.positions_path)
+
+    def _read_positions(self) -> Dict[int, dict]:
+        try:
+            with open(self.positions_path, "r") as f:
+                return {int(doc_id): document for doc_id, document in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _get(self, doc_id: int, field: str):
+        with self._lock:
+            if self._pending is not None and field in self._pending.get(doc_id, {}):
+                return self._pending[doc_id][field]
+            if field in self.positions.get(doc_id, {}):
+                return self.positions[doc_id][field]
+            document = self.db.get(doc_id=doc_id)
+            return None if document is None else document.get(field)
+
+    def _set(self, doc_id: int, field: str, value):
+        with self.transaction():
+            self._pending.setdefault(doc_id, {})[field] = value
+
+
+class SQLiteStore(Store):
+    """SQLite database in WAL mode with indexed yay and eta tables, and the yays of each slate as a JSON list"""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS yays (position INTEGER PRIMARY KEY AUTOINCREMENT, address TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS etas (address TEXT PRIMARY KEY, eta REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS etas_by_eta ON etas (eta)",
+        "CREATE TABLE IF NOT EXISTS slates (slate TEXT PRIMARY KEY, yays TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS block_hashes (number INTEGER PRIMARY KEY, hash TEXT NOT NULL)",
+    ]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def exists(self) -> bool:
+        if not (os.path.isfile(self.path) and os.access(self.path, os.R_OK)):
+            return False
+
+        # A file without the last checked block was never fully initialized
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute("SELECT 1 FROM meta WHERE key = 'last_block_checked_for_yays'").fetchone() is not None
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            db.close()
+
+    def open(self, read_only: bool = False):
+        """Opens the database, creating its tables; `read_only` opens an existing one without changing it"""
+        if read_only:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, isolation_level=None,
+                                      check_same_thread=False)
+            return
+
+        # Blocks are processed on a Lifecycle thread, so access is serialised by `_lock` instead
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+    def initialize(self, last_block: int, yays: List[str], etas: Dict[str, float], etas_block: int = None,
+                   slates: Dict[str, List[str]] = None):
+        self.open()
+        with self.transaction():
+            self.set_last_block(last_block)
+            self.add_yays(yays)
+            self.set_etas(etas)
+            if etas_block is not None:
+                self.set_etas_block(etas_block)
+            self.add_slates(slates or {})
+
+    def get_last_block(self) -> int:
+        return self._get_meta("last_block_checked_for_yays")
+
+    def get_etas_block(self) -> Optional[int]:
+        return self._get_meta("last_block_checked_for_etas")
+
+    def _get_meta(self, key: str) -> Optional[int]:
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return None if row is None else row[0]
+
+    def _set_meta(self, key: str, value: int):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_yays(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT address FROM yays ORDER BY position")]
+
+    def get_etas(self) -> Dict[str, float]:
+        with self._lock:
+            return {address: eta for address, eta in self.db.execute("SELECT address, eta FROM etas ORDER BY eta")}
+
+    def get_slates(self) -> Dict[str, List[str]]:
+        with self._lock:
+            return {slate: json.loads(yays) for slate, yays in self.db.execute("SELECT slate, yays FROM slates")}
+
+    def get_block_hashes(self) -> Dict[int, str]:
+        with self._lock:
+            return {number: block_hash for number, block_hash in self.db.execute("SELECT number, hash FROM block_hashes")}
+
+    def set_last_block(self, block: int):
+        self._set_meta("last_block_checked_for_yays", block)
+
+    def set_etas_block(self, block: int):
+        self._set_meta("last_block_checked_for_etas", block)
+
+    def add_yays(self, yays: List[str]):
+        with self.transaction():
+            self.db.executemany("INSERT OR IGNORE INTO yays (address) VALUES (?)", [(yay,) for yay in yays])
+
+    def remove_yays(self, yays: List[str]):
+        with self.transaction():
+            self.db.executemany("DELETE FROM yays WHERE address = ?", [(yay,) for yay in yays])
+
+    def set_etas(self, etas: Dict[str, float]):
+        with self.transaction():
+            self.db.execute("DELETE FROM etas")
+            self.db.executemany("INSERT INTO etas (address, eta) VALUES (?, ?)", list(etas.items()))
+
+    def add_slates(self, slates: Dict[str, List[str]]):
+        with self.transaction():
+            self.db.executemany("INSERT OR IGNORE INTO slates (slate, yays) VALUES (?, ?)",
+                                [(slate, json.dumps(yays)) for slate, yays in slates.items()])
+
+    def set_block_hashes(self, hashes: Dict[int, str]):
+        # Only the blocks that left or joined the window are written
+        with self.transaction():
+            current = self.get_block_hashes()
+            self.db.executemany("DELETE FROM block_hashes WHERE number = ?",
+                                [(number,) for number in current if hashes.get(number) != current[number]])
+            self.db.executemany("INSERT INTO block_hashes (number, hash) VALUES (?, ?)",
+                                [(number, block_hash) for number, block_hash in hashes.items()
+                                 if current.get(number) != block_hash])
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._depth == 0:
+                self.db.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._depth == 1:
+                    self.db.execute("ROLLBACK")
+                raise
+            else:
+                if self._depth == 1:
+                    self.db.execute("COMMIT")
+            finally:
+                self._depth -= 1
+
+    def close(self):
+        if self.db is not None:
+            # synchronous=NORMAL may leave the last commits only in the WAL, checkpoint them into the database
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+            self.db = None
+
+
+def migrate(json_path: str, sqlite_path: str):
+    """One-shot copy of a `db_<network>.json` TinyDB database into a new SQLite database"""
+    source = TinyDBStore(json_path)
+    if not source.exists():
+        raise FileNotFoundError(json_path)
+    if os.path.exists(sqlite_path):
+        raise FileExistsError(sqlite_path)
+
+    source.open(read_only=True)
+    target = SQLiteStore(sqlite_path)
+    target.initialize(source.get_last_block(), source.get_yays(), source.get_etas(), source.get_etas_block(),
+                      source.get_slates())
+    target.set_block_hashes(source.get_block_hashes())
+    target.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("chief-keeper-migrate")
+    parser.add_argument("json_path", type=str, help="Existing TinyDB database (e.g. chief_keeper/database/db_mainnet.json)")
+    parser.add_argument("sqlite_path", type=str, help="SQLite database to create (e.g. chief_keeper/database/db_mainnet.sqlite)")
+    arguments = parser.parse_args(sys.argv[1:])
+
+    migrate(arguments.json_path, arguments.sqlite_path)
+    print(f"Migrated {arguments.json_path} to {arguments.sqlite_path}")
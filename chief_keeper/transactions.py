@@ -0,0 +1,222 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+from web3 import Web3
+from web3.exceptions import ContractLogicError
+
+from chief_keeper.metrics import (
+    record_transaction_deduplicated,
+    record_transaction_included,
+    record_transaction_simulated,
+    set_transactions_pending
+)
+
+
+class NonceManager:
+    """Hands out the nonces of an account locally, so concurrent transactions never share one.
+
+    The next nonce is the higher of the local counter and the account's pending transaction count. A nonce
+    that was never broadcast is handed back with `release()`, which resyncs with the chain if later nonces
+    are already out.
+    """
+
+    def __init__(self, web3: Web3, address: str):
+        assert isinstance(web3, Web3)
+
+        self.web3 = web3
+        self.address = address
+        self.next_nonce = None
+        self._lock = threading.Lock()
+
+    def reserve(self) -> int:
+        with self._lock:
+            pending = self.web3.eth.getTransactionCount(self.address, "pending")
+            nonce = pending if self.next_nonce is None else max(self.next_nonce, pending)
+            self.next_nonce = nonce + 1
+            return nonce
+
+    def release(self, nonce: int):
+        with self._lock:
+            if self.next_nonce == nonce + 1:
+                self.next_nonce = nonce
+            else:
+                self.next_nonce = None
+
+
+class TransactionSimulator:
+    """Tells whether a transaction would revert by running it with `eth_call` against the pending block.
+
+    Outcomes are remembered per (action, target, block), so an intent that is retried within a block is
+    simulated once. A simulation that fails for any reason other than a revert counts as a success, so a
+    flaky node never holds a transaction back.
+    """
+
+    def __init__(self, web3: Web3, address: str):
+        assert isinstance(web3, Web3)
+
+        self.web3 = web3
+        self.address = address
+        self.outcomes = {}
+        self.logger = logging.getLogger()
+
+    def would_succeed(self, key: Tuple, transact, block_number: int) -> bool:
+        cache_key = (key[0], key[1], block_number)
+        if cache_key not in self.outcomes:
+            # Outcomes of older blocks can't be asked for again
+            self.outcomes = {k: v for k, v in self.outcomes.items() if k[2] >= block_number}
+            self.outcomes[cache_key] = self._simulate(key, transact)
+        return self.outcomes[cache_key]
+
+    def _simulate(self, key: Tuple, transact) -> bool:
+        data = transact.contract.encodeABI(fn_name=transact.function_name, args=transact.parameters)
+        try:
+            self.web3.eth.call({"from": self.address, "to": transact.address.address, "data": data}, "pending")
+        except Exception as e:
+            if isinstance(e, ContractLogicError) or "revert" in str(e).lower():
+                self.logger.warning(f"Not sending {key[0]} for {key[1:]}, it would revert: {e}")
+                record_transaction_simulated(key[0], "revert")
+                return False
+            self.logger.debug(f"Couldn't simulate {key[0]} for {key[1:]}: {e}")
+
+        record_transaction_simulated(key[0], "ok")
+        return True
+
+
+class TransactionPipeline:
+    """Sends the keeper's transactions in the background, so blocks keep being processed while they are pending.
+
+    Each transaction is an intent identified by a key such as `("cast", spell)`; submitting an intent whose key
+    is still pending does nothing. Intents are sent on up to `max_pending` worker threads, with nonces
+    from the `NonceManager` in the order they were submitted, and pymaker replaces a pending transaction with a higher gas price as its gas
+    strategy escalates. When a transaction is included, or fails, `on_done` is called with its receipt (None
+    on failure) and the outcome is kept until `pop_finished()`. With `simulate`, intents submitted with a block
+    number are only sent if the `TransactionSimulator` expects them to succeed.
+    """
+
+    def __init__(self, web3: Web3, address: str, max_pending: int = 4, simulate: bool = True):
+        assert isinstance(web3, Web3)
+        assert max_pending > 0
+
+        self.nonces = NonceManager(web3, address)
+        self.simulator = TransactionSimulator(web3, address) if simulate else None
+        self.logger = logging.getLogger()
+        self.executor = ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix="chief-keeper-tx")
+        self.pending = {}
+        self.finished = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._local = threading.local()
+
+    def submit(self, key: Tuple, build: Callable, gas_strategy: Callable, on_done: Callable = None,
+               block_number: int = None) -> bool:
+        """Sends the transaction `build()` returns with the strategy `gas_strategy()` returns, unless `key` is pending
+        or, simulated on `block_number`, it would revert.
+
+        `gas_strategy` is only called for an intent that is actually sent. Returns whether it was.
+        """
+        with self._lock:
+            if key in self.pending:
+                record_transaction_deduplicated(key[0])
+                self.logger.info(f"Not sending {key[0]} for {key[1:]}, one is already pending")
+                return False
+            self.pending[key] = time.time()
+            set_transactions_pending(len(self.pending))
+
+        try:
+            transact = build()
+            if self.simulator is not None and block_number is not None \
+                    and not self.simulator.would_succeed(key, transact, block_number):
+                self._abandon(key)
+                return False
+
+            strategy = gas_strategy()
+            # Nonces are reserved in the order intents are submitted, so transactions sent together are sequential
+            nonce = self.nonces.reserve()
+        except Exception:
+            self._finish(key, None)
+            raise
+
+        self.executor.submit(self._send, key, transact, strategy, nonce, on_done)
+        return True
+
+    def is_pending(self, key: Tuple) -> bool:
+        with self._lock:
+            return key in self.pending
+
+    def pop_finished(self) -> Dict[Tuple, Optional[object]]:
+        """The receipts of the intents finished since the last call, by key; None for those that failed"""
+        with self._lock:
+            finished, self.finished = self.finished, {}
+            return finished
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits until no intent is pending; returns False if `timeout` seconds passed first"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.pending, timeout)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+
+    def _loop(self) -> asyncio.AbstractEventLoop:
+        # pymaker's transact() runs on the thread's event loop, which worker threads don't have
+        if getattr(self._local, "loop", None) is None:
+            self._local.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._local.loop)
+        return self._local.loop
+
+    def _send(self, key: Tuple, transact, gas_strategy, nonce: int, on_done: Callable):
+        receipt = None
+        try:
+            self._loop()
+            # pymaker only reads the pending transaction count when a Transact has no nonce yet
+            transact.nonce = nonce
+            receipt = transact.transact(gas_strategy=gas_strategy)
+            if receipt is None:
+                self.nonces.release(nonce)
+        except Exception as e:
+            self.logger.error(f"Error sending {key[0]} for {key[1:]}: {e}")
+            self.nonces.release(nonce)
+
+        if on_done is not None:
+            try:
+                on_done(receipt)
+            except Exception as e:
+                self.logger.error(f"Error handling the outcome of {key[0]} for {key[1:]}: {e}")
+        self._finish(key, receipt)
+
+    def _abandon(self, key: Tuple):
+        with self._lock:
+            self.pending.pop(key, None)
+            set_transactions_pending(len(self.pending))
+            self._idle.notify_all()
+
+    def _finish(self, key: Tuple, receipt):
+        with self._lock:
+            submitted_at = self.pending.pop(key, None)
+            self.finished[key] = receipt
+            set_transactions_pending(len(self.pending))
+            self._idle.notify_all()
+
+        if receipt is not None and submitted_at is not None:
+            record_transaction_included(key[0], time.time() - submitted_at)
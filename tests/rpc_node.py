@@ -0,0 +1,405 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2020 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode_abi, encode_abi, encode_single
+from eth_utils import event_signature_to_log_topic, function_signature_to_4byte_selector, keccak, to_checksum_address
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+
+def selector(signature: str) -> str:
+    return "0x" + function_signature_to_4byte_selector(signature).hex()
+
+
+def topic(signature: str) -> str:
+    return "0x" + event_signature_to_log_topic(signature).hex()
+
+
+class RpcError(Exception):
+    """Raised by a handler to answer a request with a JSON-RPC error object"""
+    def __init__(self, message: str, code: int = -32000):
+        super().__init__(message)
+        self.code = code
+
+
+class StandInNode:
+    """A local JSON-RPC node serving canned handlers over HTTP.
+
+    Handlers are plain functions of the request params, registered per method. The node counts HTTP
+    round-trips and individual calls so tests can assert how chatty the keeper is. `latency` holds the seconds
+    each method takes to answer, with `"*"` for all others; a batch takes as long as its slowest call.
+    """
+
+    def __init__(self, batch_support: bool = True):
+        self.batch_support = batch_support
+        self.handlers = {}
+        self.contracts = {}
+        self.round_trips = 0
+        self.connections = 0
+        self.calls = Counter()
+        self.call_blocks = []
+        self.latency = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+        self.handlers["eth_call"] = self._eth_call
+        self.handlers["eth_getCode"] = lambda params: "0x60" if params[0].lower() in self.contracts else "0x"
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def add_contract(self, address: str, functions: dict):
+        """Registers a contract as {signature: fn(block, *args) -> (type, value)}"""
+        self.contracts[address.lower()] = {selector(signature): (signature, fn) for signature, fn in functions.items()}
+
+    def reset_counters(self):
+        with self._lock:
+            self.round_trips = 0
+            self.connections = 0
+            self.calls.clear()
+            self.call_blocks.clear()
+
+    def start(self) -> "StandInNode":
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; with Nagle's algorithm each response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with node._lock:
+                    node.connections += 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with node._lock:
+                    node.round_trips += 1
+
+                requests = body if isinstance(body, list) else [body]
+                delay = max([node.latency.get(request.get("method"), node.latency.get("*", 0)) for request in requests] or [0])
+                if delay > 0:
+                    time.sleep(delay)
+
+                if isinstance(body, list):
+                    if node.batch_support:
+                        response = [node._dispatch(request) for request in body]
+                    else:
+                        response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "batch requests are not supported"}}
+                else:
+                    response = node._dispatch(body)
+
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _dispatch(self, request: dict) -> dict:
+        method, params = request["method"], request.get("params", [])
+        with self._lock:
+            self.calls[method] += 1
+
+        try:
+            if method not in self.handlers:
+                raise RpcError(f"the method {method} does not exist", -32601)
+            return {"jsonrpc": "2.0", "id": request.get("id"), "result": self.handlers[method](params)}
+        except RpcError as e:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": e.code, "message": str(e)}}
+
+    def _eth_call(self, params: list) -> str:
+        transaction, block = params[0], params[1] if len(params) > 1 else "latest"
+        with self._lock:
+            self.call_blocks.append(block)
+
+        functions = self.contracts.get(transaction["to"].lower(), {})
+        data = transaction.get("data") or transaction.get("input")
+        if data[:10] not in functions:
+            raise RpcError("execution reverted")
+
+        signature, fn = functions[data[:10]]
+        arg_types = signature[signature.index("(") + 1:-1]
+        args = decode_abi(arg_types.split(","), bytes.fromhex(data[10:])) if arg_types else ()
+        output_type, value = fn(int(block, 16) if block.startswith("0x") else block, *args)
+        return "0x" + encode_single(output_type, value).hex()
+
+
+class FakeChief:
+    """DS-Chief model served by a `StandInNode`.
+
+    Answers `hat`, `approvals`, `votes`, `slates` and `MAX_YAYS` and emits `Etch`/`Lock`/`Free`/`Vote`
+    logs at the current block. `votes` honours the block the call is pinned to, the rest reads
+    current state.
+    """
+
+    def __init__(self, node: StandInNode, address: str, block: int = 1, max_yays: int = 5):
+        self.node = node
+        self.address = to_checksum_address(address)
+        self.block = block
+        self.max_yays = max_yays
+        self.hat = ZERO_ADDRESS
+        self.deposits = {}
+        self.approvals = {}
+        self.slates = {}
+        self.vote_history = {}
+        self.logs = []
+
+        node.add_contract(self.address, {
+            "hat()": lambda block: ("address", self.hat),
+            "approvals(address)": lambda block, yay: ("uint256", self.approvals.get(to_checksum_address(yay), 0)),
+            "votes(address)": lambda block, voter: ("bytes32", self.votes(to_checksum_address(voter), block)),
+            "slates(bytes32,uint256)": self._slates,
+            "MAX_YAYS()": lambda block: ("uint256", self.max_yays),
+            "lift(address)": self._lift,
+        })
+        node.handlers["eth_blockNumber"] = lambda params: hex(self.block)
+        node.handlers["eth_getLogs"] = self._get_logs
+
+    def mine(self, blocks: int = 1):
+        self.block += blocks
+
+    def votes(self, voter: str, block="latest") -> bytes:
+        slate = bytes(32)
+        for vote_block, vote_slate in self.vote_history.get(voter, []):
+            if block == "latest" or vote_block <= block:
+                slate = vote_slate
+        return slate
+
+    def etch(self, yays: list) -> bytes:
+        yays = [to_checksum_address(yay) for yay in yays]
+        slate = keccak(encode_abi(["address[]"], [yays]))
+        self.slates[slate] = yays
+        self._log(topic("Etch(bytes32,address[])"), [slate], encode_abi(["address[]"], [yays]))
+        return slate
+
+    def lock(self, voter: str, wad: int):
+        self.deposits[voter] = self.deposits.get(voter, 0) + wad
+        self._add_weight(self.votes(voter), wad)
+        self._log(topic("Lock(address,uint256)"), [bytes(12) + bytes.fromhex(voter[2:])], encode_single("uint256", wad))
+
+    def free(self, voter: str, wad: int):
+        self.deposits[voter] -= wad
+        self._add_weight(self.votes(voter), -wad)
+        self._log(topic("Free(address,uint256)"), [bytes(12) + bytes.fromhex(voter[2:])], encode_single("uint256", wad))
+
+    def vote(self, voter: str, yays: list) -> bytes:
+        slate = self.etch(yays)
+        weight = self.deposits.get(voter, 0)
+        self._add_weight(self.votes(voter), -weight)
+        self._add_weight(slate, weight)
+        self.vote_history.setdefault(voter, []).append((self.block, slate))
+        self._log(topic("Vote(address,bytes32)"), [bytes(12) + bytes.fromhex(voter[2:]), slate], b"")
+        return slate
+
+    def lift(self, whom: str):
+        self.hat = to_checksum_address(whom)
+        self._log(topic("Lift(address)"), [bytes(12) + bytes.fromhex(self.hat[2:])], b"")
+
+    def _add_weight(self, slate: bytes, wad: int):
+        for yay in self.slates.get(slate, []):
+            self.approvals[yay] = self.approvals.get(yay, 0) + wad
+
+    def _lift(self, block, whom: str):
+        # DS-Chief only lets a yay with more approvals than the hat take it
+        if self.approvals.get(to_checksum_address(whom), 0) <= self.approvals.get(self.hat, 0):
+            raise RpcError("execution reverted")
+        return "bool", True
+
+    def _slates(self, block, slate: bytes, index: int):
+        yays = self.slates.get(slate, [])
+        if index >= len(yays):
+            raise RpcError("execution reverted")
+        return "address", yays[index]
+
+    def _log(self, first_topic: str, topics: list, data: bytes):
+        self.logs.append({
+            "address": self.address,
+            "blockHash": "0x" + keccak(self.block.to_bytes(32, "big")).hex(),
+            "blockNumber": hex(self.block),
+            "data": "0x" + data.hex(),
+            "logIndex": hex(len(self.logs)),
+            "removed": False,
+            "topics": [first_topic] + ["0x" + t.hex() for t in topics],
+            "transactionHash": "0x" + keccak(len(self.logs).to_bytes(32, "big")).hex(),
+            "transactionIndex": "0x0",
+        })
+
+    def _get_logs(self, params: list) -> list:
+        query = params[0]
+        addresses = query["address"] if isinstance(query["address"], list) else [query["address"]]
+        addresses = [address.lower() for address in addresses]
+        from_block, to_block = int(query["fromBlock"], 16), int(query["toBlock"], 16)
+        return [
+            log for log in self.logs
+            if log["address"].lower() in addresses and from_block <= int(log["blockNumber"], 16) <= to_block
+        ]
+
+
+class FakePause:
+    """DS-Pause model served by a `StandInNode`, with the DSSSpells it schedules.
+
+    Spells answer `done()` and `eta()` from current state. `plot` and `exec` are logged with the spell as
+    `guy`, as when a DSSSpell schedules or casts itself, `drop` with the caller. Logs are served alongside
+    those of any DS-Chief model already registered on the node.
+    """
+
+    def __init__(self, node: StandInNode, address: str, block: int = 1):
+        self.node = node
+        self.address = to_checksum_address(address)
+        self.block = block
+        self.spells = {}
+        self.logs = []
+
+        chief_logs = node.handlers.get("eth_getLogs", lambda params: [])
+        node.handlers["eth_getLogs"] = lambda params: sorted(chief_logs(params) + self._get_logs(params),
+                                                             key=lambda log: int(log["blockNumber"], 16))
+        node.handlers.setdefault("eth_blockNumber", lambda params: hex(self.block))
+
+    def mine(self, blocks: int = 1):
+        self.block += blocks
+
+    def deploy(self, spell: str, action: str) -> str:
+        spell = to_checksum_address(spell)
+        self.spells[spell] = {"action": to_checksum_address(action), "tag": keccak(bytes.fromhex(action[2:])),
+                              "eta": 0, "done": False}
+        self.node.add_contract(spell, {
+            "done()": lambda block: ("bool", self.spells[spell]["done"]),
+            "eta()": lambda block: ("uint256", self.spells[spell]["eta"]),
+            "schedule()": lambda block: self._simulate(self.spells[spell]["eta"] == 0),
+            "cast()": lambda block: self._simulate(self.spells[spell]["eta"] != 0 and not self.spells[spell]["done"]),
+        })
+        return spell
+
+    def plot(self, spell: str, eta: int):
+        self.spells[spell]["eta"] = eta
+        self._note("plot", spell, spell)
+
+    def exec(self, spell: str):
+        self.spells[spell]["done"] = True
+        self._note("exec", spell, spell)
+
+    def drop(self, spell: str, guy: str):
+        self._note("drop", guy, spell)
+
+    def _simulate(self, succeeds: bool):
+        if not succeeds:
+            raise RpcError("execution reverted")
+        return "bool", True
+
+    def _note(self, name: str, guy: str, spell: str):
+        plan = self.spells[spell]
+        signature = f"{name}(address,bytes32,bytes,uint256)"
+        args = [plan["action"], plan["tag"], b"", plan["eta"]]
+        calldata = bytes.fromhex(selector(signature)[2:]) + encode_abi(["address", "bytes32", "bytes", "uint256"], args)
+        self.logs.append({
+            "address": self.address,
+            "blockHash": "0x" + keccak(self.block.to_bytes(32, "big")).hex(),
+            "blockNumber": hex(self.block),
+            "data": "0x" + encode_abi(["uint256", "bytes"], [0, calldata]).hex(),
+            "logIndex": hex(len(self.logs)),
+            "removed": False,
+            "topics": [
+                selector(signature).ljust(66, "0"),
+                "0x" + (bytes(12) + bytes.fromhex(guy[2:])).hex(),
+                "0x" + (bytes(12) + bytes.fromhex(plan["action"][2:])).hex(),
+                "0x" + plan["tag"].hex(),
+            ],
+            "transactionHash": "0x" + keccak(b"pause" + len(self.logs).to_bytes(32, "big")).hex(),
+            "transactionIndex": "0x0",
+        })
+
+    def _get_logs(self, params: list) -> list:
+        query = params[0]
+        addresses = query["address"] if isinstance(query["address"], list) else [query["address"]]
+        if self.address.lower() not in [address.lower() for address in addresses]:
+            return []
+
+        from_block, to_block = int(query["fromBlock"], 16), int(query["toBlock"], 16)
+        topics = (query.get("topics") or [None])[0]
+        return [
+            log for log in self.logs
+            if from_block <= int(log["blockNumber"], 16) <= to_block and (topics is None or log["topics"][0] in topics)
+        ]
+
+
+class FakeChain:
+    """A DS-Chief and a DS-Pause model served by a `StandInNode`, with the blocks, balance, nonce and fees around
+    them, so a whole keeper can run against it.
+
+    Both models are mined together. Blocks are `block_time` seconds apart from `genesis_time` and their hashes
+    are derived from their number.
+    """
+
+    def __init__(self, node: StandInNode, chief: str, pause: str, block: int = 1, genesis_time: int = 1600000000,
+                 block_time: int = 12):
+        self.node = node
+        self.chief = FakeChief(node, chief, block)
+        self.pause = FakePause(node, pause, block)
+        self.genesis_time = genesis_time
+        self.block_time = block_time
+
+        node.handlers.update({
+            "eth_getBlockByNumber": self._get_block,
+            "eth_getBalance": lambda params: hex(10**18),
+            "eth_getTransactionCount": lambda params: hex(0),
+            "eth_chainId": lambda params: hex(1),
+            "net_version": lambda params: "1",
+            "web3_clientVersion": lambda params: "StandInNode",
+            "eth_feeHistory": lambda params: {"oldestBlock": hex(self.block), "baseFeePerGas": [hex(10**10)] * 2,
+                                              "gasUsedRatio": [0.5], "reward": [[hex(10**9)]]},
+        })
+
+    @property
+    def block(self) -> int:
+        return self.chief.block
+
+    def mine(self, blocks: int = 1):
+        self.chief.mine(blocks)
+        self.pause.mine(blocks)
+
+    def timestamp(self, block: int = None) -> int:
+        return self.genesis_time + (self.block if block is None else block) * self.block_time
+
+    def _get_block(self, params: list) -> dict:
+        number = self.block if params[0] in ["latest", "pending"] else int(params[0], 16)
+        return {
+            "number": hex(number),
+            "hash": "0x" + keccak(number.to_bytes(32, "big")).hex(),
+            "parentHash": "0x" + keccak(max(number - 1, 0).to_bytes(32, "big")).hex(),
+            "timestamp": hex(self.timestamp(number)),
+            "baseFeePerGas": hex(10**10),
+        }
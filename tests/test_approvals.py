@@ -0,0 +1,324 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from web3 import Web3, HTTPProvider
+
+from chief_keeper.approvals import ApprovalIndex, ApprovalReader
+from chief_keeper.database import SimpleDatabase
+
+from pymaker import Address
+from pymaker.governance import DSChief
+from pymaker.numeric import Wad
+
+from rpc_node import FakeChief, RpcError, StandInNode
+
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+BLOCK = 17000000
+
+
+def yay_address(i: int) -> str:
+    return Web3.toChecksumAddress("0x" + f"{i + 1:040x}")
+
+
+@pytest.fixture()
+def node() -> StandInNode:
+    node = StandInNode()
+    yays = [yay_address(i) for i in range(150)]
+    approvals = {yay.lower(): i * 10**18 for i, yay in enumerate(yays)}
+
+    node.add_contract(CHIEF, {
+        "hat()": lambda block: ("address", yays[10]),
+        "approvals(address)": lambda block, yay: ("uint256", approvals.get(yay.lower(), 0)),
+    })
+    node.yays = yays
+    node.start()
+    yield node
+    node.stop()
+
+
+def reader_for(node: StandInNode) -> ApprovalReader:
+    web3 = Web3(HTTPProvider(node.url))
+    ds_chief = DSChief(web3, Address(CHIEF))
+    node.reset_counters()
+    return ApprovalReader(web3, ds_chief)
+
+
+class TestApprovalReader:
+
+    def test_batched_read_is_one_round_trip(self, node: StandInNode):
+        reader = reader_for(node)
+
+        hat, approvals = reader.read(node.yays, BLOCK)
+
+        assert node.round_trips == 1
+        assert node.calls["eth_call"] == 151
+        assert hat == node.yays[10]
+        assert approvals[node.yays[149]] == Wad.from_number(149)
+        assert len(approvals) == 150
+
+    def test_reads_are_pinned_to_block(self, node: StandInNode):
+        reader = reader_for(node)
+
+        reader.read(node.yays, BLOCK)
+
+        assert set(node.call_blocks) == {hex(BLOCK)}
+
+    def test_batch_size_limit(self, node: StandInNode):
+        reader = reader_for(node)
+        reader.max_batch_size = 100
+
+        reader.read(node.yays, BLOCK)
+
+        assert node.round_trips == 2
+
+    def test_falls_back_to_per_yay_calls(self, node: StandInNode):
+        node.batch_support = False
+        reader = reader_for(node)
+
+        hat, approvals = reader.read(node.yays, BLOCK)
+
+        # One rejected batch, then the hat and every yay on its own
+        assert node.round_trips == 1 + 1 + 150
+        assert reader.batching is False
+        assert hat == node.yays[10]
+        assert approvals[node.yays[149]] == Wad.from_number(149)
+        assert set(node.call_blocks) == {hex(BLOCK)}
+
+        # Batching isn't retried once the node has rejected it
+        node.reset_counters()
+        reader.read(node.yays, BLOCK)
+        assert node.round_trips == 1 + 150
+
+
+@pytest.fixture()
+def chief() -> FakeChief:
+    node = StandInNode().start()
+    chief = FakeChief(node, CHIEF, block=BLOCK)
+    chief.voters = [yay_address(1000 + i) for i in range(20)]
+    chief.yays = [yay_address(i) for i in range(50)]
+
+    for i, voter in enumerate(chief.voters):
+        chief.lock(voter, (i + 1) * 10**18)
+        chief.vote(voter, chief.yays[i:i + 3])
+    chief.lift(chief.yays[0])
+    chief.mine()
+
+    yield chief
+    node.stop()
+
+
+def index_for(chief: FakeChief, reconcile_blocks: int = 100) -> ApprovalIndex:
+    reader = reader_for(chief.node)
+    return ApprovalIndex(reader.web3, reader, lambda slate: list(chief.slates[slate]), reconcile_blocks)
+
+
+def full_scan_contender(chief: FakeChief):
+    """The contender as picked by walking every yay"""
+    contender, highest = chief.hat, chief.approvals.get(chief.hat, 0)
+    for yay in chief.yays:
+        if chief.approvals.get(yay, 0) > highest:
+            contender, highest = yay, chief.approvals[yay]
+    return contender, Wad(highest)
+
+
+class TestApprovalIndex:
+
+    def test_seed_matches_full_scan(self, chief: FakeChief):
+        index = index_for(chief)
+
+        index.update(chief.yays, chief.block)
+
+        assert index.hat == chief.yays[0]
+        assert index.contender() == full_scan_contender(chief)
+
+    def test_quiet_block_reads_only_the_hat(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+        chief.node.reset_counters()
+
+        chief.mine()
+        index.update(chief.yays, chief.block)
+
+        assert chief.node.calls["eth_getLogs"] == 1
+        assert chief.node.calls["eth_call"] == 1
+        assert chief.node.round_trips == 2
+
+    def test_prefetched_reads_are_used(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+
+        chief.mine()
+        chief.vote(chief.voters[19], [chief.yays[40]])
+        index.prefetch_logs(chief.block)
+        index.prefetch_hat(chief.block)
+        chief.node.reset_counters()
+        index.update(chief.yays, chief.block)
+
+        # Only the approvals the prefetched logs show changed are left to read
+        assert chief.node.calls["eth_getLogs"] == 0
+        assert chief.node.round_trips == 3
+        assert index.contender() == full_scan_contender(chief)
+
+    def test_vote_moves_approvals(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+
+        # The heaviest voter moves from yays 19-21 to yay 40
+        chief.mine()
+        chief.vote(chief.voters[19], [chief.yays[40]])
+        index.update(chief.yays, chief.block)
+
+        assert index.approvals[chief.yays[21]] == Wad(chief.approvals[chief.yays[21]])
+        assert index.approvals[chief.yays[40]] == Wad(20 * 10**18)
+        assert index.contender() == full_scan_contender(chief)
+
+    def test_new_yays_are_read(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+
+        chief.mine()
+        newcomer = yay_address(500)
+        chief.lock(chief.voters[0], 100 * 10**18)
+        chief.vote(chief.voters[0], [newcomer])
+        chief.yays.append(newcomer)
+        index.update(chief.yays, chief.block)
+
+        assert index.contender() == (newcomer, Wad(101 * 10**18))
+
+    def test_yay_voted_for_before_confirmation(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+
+        # With a confirmations lag the newcomer's approvals are read through the slate before it is a known yay
+        chief.mine()
+        newcomer = yay_address(500)
+        chief.lock(chief.voters[0], 100 * 10**18)
+        chief.vote(chief.voters[0], [newcomer])
+        index.update(chief.yays, chief.block)
+        assert index.contender() == full_scan_contender(chief)
+
+        chief.mine()
+        chief.yays.append(newcomer)
+        index.update(chief.yays, chief.block)
+
+        assert index.contender() == (newcomer, Wad(101 * 10**18))
+
+    def test_unrecognised_log_rescans(self, chief: FakeChief):
+        index = index_for(chief)
+        index.update(chief.yays, chief.block)
+        chief.node.reset_counters()
+
+        chief.mine()
+        chief._log("0x" + "ab" * 32, [], b"")
+        index.update(chief.yays, chief.block)
+
+        assert chief.node.calls["eth_call"] == 1 + len(chief.yays)
+        assert index.last_rescan == chief.block
+
+    def test_periodic_reconciliation(self, chief: FakeChief):
+        index = index_for(chief, reconcile_blocks=5)
+        index.update(chief.yays, chief.block)
+        seeded = chief.block
+
+        # Drift the model behind the index's back, no logs emitted
+        chief.approvals[chief.yays[45]] = 10**24
+        for _ in range(5):
+            chief.mine()
+            index.update(chief.yays, chief.block)
+
+        assert index.last_rescan == seeded + 5
+        assert index.contender() == (chief.yays[45], Wad(10**24))
+
+    def test_matches_full_scan_under_random_activity(self, chief: FakeChief):
+        index = index_for(chief, reconcile_blocks=10**6)
+        index.update(chief.yays, chief.block)
+        rng = random.Random(42)
+
+        for _ in range(60):
+            chief.mine()
+            for _ in range(rng.randint(0, 3)):
+                voter = rng.choice(chief.voters)
+                action = rng.choice(["lock", "free", "vote"])
+                if action == "lock":
+                    chief.lock(voter, rng.randint(1, 50) * 10**18)
+                elif action == "free" and chief.deposits[voter] > 0:
+                    chief.free(voter, chief.deposits[voter] // 2)
+                else:
+                    chief.vote(voter, rng.sample(chief.yays, rng.randint(1, 3)))
+            if rng.random() < 0.1:
+                chief.lift(full_scan_contender(chief)[0])
+
+            index.update(chief.yays, chief.block)
+            assert index.hat == chief.hat
+            assert index.contender() == full_scan_contender(chief)
+
+
+class TestSlateUnpacking:
+
+    def test_failed_batch_falls_back_to_per_yay_calls(self):
+        node = StandInNode()
+        chief = FakeChief(node, CHIEF)
+        slate = chief.etch([yay_address(i) for i in range(3)])
+        node.start()
+        try:
+            web3 = Web3(HTTPProvider(node.url))
+            database = SimpleDatabase(web3, 0, "testnet", SimpleNamespace(ds_chief=DSChief(web3, Address(CHIEF))))
+
+            eth_call = node.handlers["eth_call"]
+            failures = [RpcError("internal error")]
+
+            def flaky_call(params):
+                if failures:
+                    raise failures.pop()
+                return eth_call(params)
+
+            # The first read of the batch fails for a reason other than reading past the end of the slate
+            node.handlers["eth_call"] = flaky_call
+
+            assert database.unpack_slate(slate, 5) == [yay_address(i) for i in range(3)]
+            assert database.batching is True
+        finally:
+            node.stop()
+
+    @pytest.mark.parametrize("batch_support", [True, False])
+    @pytest.mark.parametrize("error", ["invalid opcode: INVALID", "Bad instruction fe"])
+    def test_slate_ends_on_invalid_opcode(self, batch_support: bool, error: str):
+        node = StandInNode(batch_support=batch_support)
+        chief = FakeChief(node, CHIEF)
+        slate = chief.etch([yay_address(i) for i in range(3)])
+
+        # Reading past the end hits the INVALID opcode of a pre-0.8 bounds check instead of reverting
+        def slates(block, slate: bytes, index: int):
+            if index >= len(chief.slates[slate]):
+                raise RpcError(error)
+            return "address", chief.slates[slate][index]
+
+        node.add_contract(CHIEF, {"slates(bytes32,uint256)": slates, "MAX_YAYS()": lambda block: ("uint256", 5)})
+        node.start()
+        try:
+            web3 = Web3(HTTPProvider(node.url))
+            database = SimpleDatabase(web3, 0, "testnet", SimpleNamespace(ds_chief=DSChief(web3, Address(CHIEF))))
+
+            assert database.get_slate_yays(slate) == [yay_address(i) for i in range(3)]
+        finally:
+            node.stop()
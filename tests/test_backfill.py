@@ -0,0 +1,161 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from chief_keeper.backfill import Backfill
+from chief_keeper.database import SimpleDatabase
+from chief_keeper.storage import TinyDBStore
+
+
+class FakeLogs:
+    """An etch every 10 blocks; ranges spanning more than `max_range` blocks are rejected"""
+
+    def __init__(self, max_range: int = 10**9, fail_after: int = None):
+        self.max_range = max_range
+        self.fail_after = fail_after
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def __call__(self, from_block: int, to_block: int):
+        with self._lock:
+            if self.fail_after is not None and len(self.ranges) >= self.fail_after:
+                raise KeyboardInterrupt()
+            self.ranges.append((from_block, to_block))
+
+        if to_block - from_block + 1 > self.max_range:
+            raise ValueError({"code": -32005, "message": "query returned more than 10000 results"})
+
+        return [f"yay-{block}" for block in range(from_block, to_block + 1) if block % 10 == 0]
+
+
+def expected(from_block: int, to_block: int):
+    return [f"yay-{block}" for block in range(from_block, to_block + 1) if block % 10 == 0]
+
+
+@pytest.fixture()
+def checkpoint(tmp_path) -> str:
+    return str(tmp_path / "db_testnet.json.backfill")
+
+
+class TestBackfill:
+
+    def test_results_are_in_block_order(self, checkpoint):
+        logs = FakeLogs()
+        backfill = Backfill(logs, checkpoint, workers=4, chunk_size=100, min_chunk_size=10)
+
+        assert backfill.run(0, 5000) == expected(0, 5000)
+        assert not os.path.exists(checkpoint)
+
+    def test_chunks_shrink_when_provider_rejects_range(self, checkpoint):
+        logs = FakeLogs(max_range=300)
+        backfill = Backfill(logs, checkpoint, workers=3, chunk_size=2000, min_chunk_size=10)
+
+        assert backfill.run(0, 10000) == expected(0, 10000)
+        rejected = [(start, end) for start, end in logs.ranges if end - start + 1 > 300]
+        assert len(rejected) < 0.25 * (len(logs.ranges) - len(rejected))
+        assert backfill.chunk_size <= 300
+
+    def test_chunks_grow_after_success(self, checkpoint):
+        logs = FakeLogs()
+        backfill = Backfill(logs, checkpoint, workers=1, chunk_size=100, min_chunk_size=10, max_chunk_size=1600)
+
+        backfill.run(0, 10000)
+
+        sizes = [end - start + 1 for start, end in logs.ranges]
+        assert sizes[:5] == [100, 200, 400, 800, 1600]
+
+    def test_gives_up_below_minimum_chunk(self, checkpoint):
+        logs = FakeLogs(max_range=5)
+        backfill = Backfill(logs, checkpoint, workers=2, chunk_size=100, min_chunk_size=10)
+
+        with pytest.raises(ValueError):
+            backfill.run(0, 1000)
+
+    def test_resumes_from_checkpoint(self, checkpoint):
+        interrupted = FakeLogs(fail_after=5)
+        with pytest.raises(KeyboardInterrupt):
+            Backfill(interrupted, checkpoint, workers=1, chunk_size=100, max_chunk_size=100).run(0, 2000)
+        assert os.path.exists(checkpoint)
+
+        resumed = FakeLogs()
+        result = Backfill(resumed, checkpoint, workers=2, chunk_size=100, max_chunk_size=100).run(0, 3000)
+
+        assert result == expected(0, 3000)
+        assert resumed.ranges[0][0] == 500
+        assert not os.path.exists(checkpoint)
+
+    def test_checkpoint_of_other_range_is_ignored(self, checkpoint):
+        with pytest.raises(KeyboardInterrupt):
+            Backfill(FakeLogs(fail_after=2), checkpoint, workers=1, chunk_size=100).run(0, 2000)
+
+        logs = FakeLogs()
+        assert Backfill(logs, checkpoint, workers=1, chunk_size=100).run(50, 2000) == expected(50, 2000)
+        assert logs.ranges[0][0] == 50
+
+
+class TestCatchUp:
+
+    def test_long_downtime_is_caught_up_in_chunks(self, checkpoint):
+        logs = FakeLogs(max_range=300)
+        etches = lambda from_block, to_block: [SimpleNamespace(yays=[yay], slate=yay.encode())
+                                               for yay in logs(from_block, to_block)]
+        database = SimpleDatabase(None, 0, "testnet", SimpleNamespace(ds_chief=SimpleNamespace(past_etch_in_range=etches)))
+        database.catch_up_path = checkpoint
+        database.last_block = 1000
+
+        assert database.get_new_yays(20000) == expected(1000, 20000)
+        assert max(end - start + 1 for start, end in logs.ranges) > 300
+        assert not os.path.exists(checkpoint)
+
+    def test_catch_up_inside_block_transaction(self, checkpoint, tmp_path):
+        logs = FakeLogs(max_range=300)
+        etches = lambda from_block, to_block: [SimpleNamespace(yays=[yay], slate=yay.encode())
+                                               for yay in logs(from_block, to_block)]
+        database = SimpleDatabase(None, 0, "testnet", SimpleNamespace(ds_chief=SimpleNamespace(past_etch_in_range=etches)))
+        database.catch_up_path = checkpoint
+        database.store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+        database.store.initialize(1000, [], {}, 1000)
+        database.load()
+
+        # Backfill workers unpack slates while the block's transaction is open on the keeper's thread
+        def catch_up():
+            with database.transaction():
+                database.update_db_yays(20000)
+
+        thread = threading.Thread(target=catch_up, daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+
+        assert not thread.is_alive()
+        assert database.get_db_yays() == expected(1000, 20000)
+        assert len(database.store.get_slates()) == len(expected(1000, 20000))
+
+    def test_short_gap_is_one_query(self, checkpoint):
+        logs = FakeLogs()
+        etches = lambda from_block, to_block: [SimpleNamespace(yays=[yay], slate=yay.encode())
+                                               for yay in logs(from_block, to_block)]
+        database = SimpleDatabase(None, 0, "testnet", SimpleNamespace(ds_chief=SimpleNamespace(past_etch_in_range=etches)))
+        database.last_block = 1000
+
+        assert database.get_new_yays(1100) == expected(1000, 1100)
+        assert logs.ranges == [(1000, 1100)]
@@ -0,0 +1,103 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+from web3 import Web3, HTTPProvider
+
+from chief_keeper.context import BlockContext
+
+from pymaker import Address
+from pymaker.governance import DSChief
+
+from rpc_node import StandInNode
+
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+SPELL = "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"
+EOA = "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"
+BLOCK = 17000000
+
+
+@pytest.fixture()
+def node() -> StandInNode:
+    node = StandInNode()
+    node.add_contract(CHIEF, {"hat()": lambda block: ("address", SPELL)})
+    node.add_contract(SPELL, {
+        "done()": lambda block: ("bool", False),
+        "eta()": lambda block: ("uint256", 1600000000 if block >= BLOCK else 0),
+    })
+    node.handlers["eth_blockNumber"] = lambda params: hex(BLOCK)
+    node.handlers["eth_getBlockByNumber"] = lambda params: {"number": params[0], "timestamp": hex(1600000000)}
+    node.start()
+    yield node
+    node.stop()
+
+
+def context_for(node: StandInNode, block_number: int = None) -> BlockContext:
+    web3 = Web3(HTTPProvider(node.url))
+    context = BlockContext(web3, block_number, DSChief(web3, Address(CHIEF)))
+    node.reset_counters()
+    return context
+
+
+class TestBlockContext:
+
+    def test_block_number_is_read_once(self, node):
+        context = context_for(node)
+
+        assert context.number == BLOCK
+        context.timestamp()
+        context.timestamp()
+
+        assert node.calls["eth_blockNumber"] == 0
+        assert node.calls["eth_getBlockByNumber"] == 1
+
+    def test_reads_are_memoized(self, node):
+        context = context_for(node)
+
+        for _ in range(3):
+            assert context.hat() == SPELL
+            assert context.is_contract(SPELL)
+            assert not context.is_contract(EOA)
+            assert context.done(SPELL) is False
+            assert context.eta(SPELL) == 1600000000
+
+        assert node.calls["eth_call"] == 3
+        assert node.calls["eth_getCode"] == 2
+
+    def test_reads_are_pinned_to_the_block(self, node):
+        context = context_for(node, BLOCK - 1)
+
+        assert context.eta(SPELL) == 0
+        context.hat()
+        context.done(SPELL)
+
+        assert node.call_blocks == [hex(BLOCK - 1)] * 3
+
+    def test_done_of_several_spells_is_read_in_one_batch(self, node):
+        spells = [Web3.toChecksumAddress(f"0x{i:040x}") for i in range(1, 4)]
+        for i, spell in enumerate(spells):
+            node.add_contract(spell, {"done()": lambda block, i=i: ("bool", i == 1)})
+        context = context_for(node)
+
+        context.prefetch_done(spells + [SPELL])
+
+        assert [context.done(spell) for spell in spells] == [False, True, False]
+        assert context.done(SPELL) is False
+        assert node.round_trips == 1
+        assert node.calls["eth_call"] == 4
@@ -0,0 +1,165 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import pytest
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.cursor import BlockCursor
+from chief_keeper.database import SimpleDatabase
+from chief_keeper.storage import TinyDBStore
+
+from rpc_node import StandInNode
+
+SPELL = "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"
+PHANTOM = "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"
+
+
+class Chain:
+    """Block hashes served by a `StandInNode`; `reorg()` replaces the blocks from a given number"""
+
+    def __init__(self, node: StandInNode, head: int):
+        self.node = node
+        self.hashes = {}
+        self.fork = 0
+        self.mine_to(head)
+        node.handlers["eth_getBlockByNumber"] = self._get_block
+
+    def block_hash(self, number: int, fork: int) -> str:
+        return "0x" + f"{fork:02x}" + f"{number:062x}"
+
+    def mine_to(self, head: int):
+        for number in range(len(self.hashes), head + 1):
+            self.hashes[number] = self.block_hash(number, self.fork)
+
+    def reorg(self, first: int):
+        self.fork += 1
+        head = max(self.hashes)
+        for number in range(first, head + 1):
+            self.hashes[number] = self.block_hash(number, self.fork)
+
+    def _get_block(self, params):
+        number = int(params[0], 16)
+        return {"number": hex(number), "hash": self.hashes[number], "parentHash": self.hashes[max(number - 1, 0)]}
+
+
+@pytest.fixture()
+def chain() -> Chain:
+    node = StandInNode()
+    chain = Chain(node, 100)
+    node.start()
+    yield chain
+    node.stop()
+
+
+class TestBlockCursor:
+
+    def test_follows_chain_with_one_read_per_block(self, chain: Chain):
+        cursor = BlockCursor(Web3(HTTPProvider(chain.node.url)))
+
+        for number in range(95, 101):
+            assert cursor.sync(number) is None
+
+        assert chain.node.calls["eth_getBlockByNumber"] == 6
+        assert cursor.last_block == 100
+
+    def test_finds_first_replaced_block(self, chain: Chain):
+        cursor = BlockCursor(Web3(HTTPProvider(chain.node.url)))
+        for number in range(90, 101):
+            cursor.sync(number)
+
+        chain.mine_to(105)
+        chain.reorg(97)
+
+        assert cursor.sync(105) == 97
+        assert sorted(cursor.hashes)[-2:] == [96, 105]
+
+    def test_reorg_deeper_than_recorded_blocks(self, chain: Chain):
+        cursor = BlockCursor(Web3(HTTPProvider(chain.node.url)), depth=3)
+        for number in range(90, 101):
+            cursor.sync(number)
+
+        chain.reorg(50)
+        chain.mine_to(101)
+
+        assert cursor.sync(101) == 98
+
+
+class NoNotes:
+    def get(self, from_block: int, to_block: int) -> list:
+        return []
+
+    def rewind(self, block_number: int):
+        pass
+
+
+class TestRollback:
+
+    @pytest.fixture()
+    def database(self, chain: Chain, tmp_path) -> SimpleDatabase:
+        database = SimpleDatabase(Web3(HTTPProvider(chain.node.url)), 0, "testnet", None)
+        database.cursor = BlockCursor(database.web3)
+        database.pause_notes = NoNotes()
+        database.store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+        database.store.initialize(100, [SPELL], {}, 100)
+        database.load()
+        database.check_reorg(100)
+        return database
+
+    def advance(self, database: SimpleDatabase, chain: Chain, block: int, etched: list, etas: dict):
+        chain.mine_to(block)
+        with database.transaction():
+            database.check_reorg(block)
+            database.update_db_yays(block, etched)
+            database.update_db_etas(block)
+            database.set_db_etas(etas)
+
+    def test_reorg_undoes_replaced_blocks_only(self, chain: Chain, database: SimpleDatabase):
+        self.advance(database, chain, 101, [], {SPELL: 1600000000.0})
+        self.advance(database, chain, 102, [PHANTOM], {SPELL: 1600000000.0, PHANTOM: 1700000000.0})
+
+        chain.reorg(102)
+        chain.mine_to(103)
+        assert database.check_reorg(103) == 102
+
+        assert database.get_db_yays() == [SPELL]
+        assert database.last_block == 101
+        assert database.get_db_etas() == {SPELL: 1600000000.0}
+        assert database.etas_block == 101
+        assert database.store.get_yays() == [SPELL]
+        assert database.store.get_block_hashes()[103] == chain.hashes[103]
+
+    def test_quiet_blocks_only_write_the_hashes(self, chain: Chain, database: SimpleDatabase):
+        written = os.stat(database.store.path).st_mtime_ns
+
+        self.advance(database, chain, 101, [], {})
+        self.advance(database, chain, 102, [], {})
+
+        assert os.stat(database.store.path).st_mtime_ns == written
+        assert database.store.get_block_hashes()[102] == chain.hashes[102]
+
+    def test_unjournaled_updates_are_scanned_again(self, chain: Chain, database: SimpleDatabase):
+        # Blocks recorded before a restart, with updates that were never journaled
+        database.cursor.load({number: chain.hashes[number] for number in range(97, 101)})
+        chain.mine_to(103)
+        chain.reorg(99)
+
+        assert database.check_reorg(103) == 99
+        assert database.last_block == 98
+        assert database.etas_block is None
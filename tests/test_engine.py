@@ -0,0 +1,112 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+
+import pytest
+from web3 import HTTPProvider
+
+from chief_keeper.engine import AsyncEngine
+from chief_keeper.rpc_pool import ProviderPool
+
+from rpc_node import RpcError, StandInNode
+
+DELAY = 0.2
+
+
+@pytest.fixture()
+def node() -> StandInNode:
+    node = StandInNode()
+
+    def slow_balance(params):
+        time.sleep(DELAY)
+        return hex(5 * 10**18)
+
+    def failing(params):
+        raise RpcError("header not found")
+
+    node.handlers["eth_getBalance"] = slow_balance
+    node.handlers["eth_getBlockByNumber"] = failing
+    node.start()
+    yield node
+    node.stop()
+
+
+@pytest.fixture()
+def engine(node) -> AsyncEngine:
+    engine = AsyncEngine(HTTPProvider(node.url, {"timeout": 5}), max_in_flight=3)
+    yield engine
+    engine.close()
+
+
+class TestAsyncEngine:
+
+    def test_reads_run_concurrently(self, engine):
+        def slow_read(value):
+            time.sleep(DELAY)
+            return value
+
+        started = time.perf_counter()
+        results = engine.gather({
+            "balance": lambda: engine.call("eth_getBalance", "0x50FF810797f75f6bfbf2227442e0c961a8562F4C", "latest"),
+            "tip": lambda: engine.blocking(slow_read, 1500000000),
+            "etched": lambda: engine.blocking(slow_read, []),
+        })
+        elapsed = time.perf_counter() - started
+
+        assert results == {"balance": hex(5 * 10**18), "tip": 1500000000, "etched": []}
+        assert elapsed < 2 * DELAY
+
+    def test_in_flight_requests_are_bounded(self, engine):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def tracked_read():
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+
+        engine.gather({f"read-{i}": (lambda: engine.blocking(tracked_read)) for i in range(10)})
+
+        assert in_flight[1] == 3
+
+    def test_failed_reads_are_returned_as_exceptions(self, engine):
+        results = engine.gather({
+            "block": lambda: engine.call("eth_getBlockByNumber", "0x1", False),
+            "balance": lambda: engine.call("eth_getBalance", "0x50FF810797f75f6bfbf2227442e0c961a8562F4C", "latest"),
+        })
+
+        assert isinstance(results["block"], ValueError)
+        assert results["balance"] == hex(5 * 10**18)
+
+    def test_requests_go_through_the_pool(self, node):
+        # The first node refuses connections, so the pool fails the read over to the second
+        pool = ProviderPool(["http://127.0.0.1:1", node.url], [(1, 1), (5, 5)])
+        engine = AsyncEngine(pool, max_in_flight=3)
+        try:
+            results = engine.gather({"balance": lambda: engine.call("eth_getBalance", "0x0", "latest")})
+        finally:
+            engine.close()
+            pool.stop()
+
+        assert results == {"balance": hex(5 * 10**18)}
+        assert node.calls["eth_getBalance"] == 1
@@ -0,0 +1,134 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.gas import GWEI, FeeHistoryTipSource, GasStrategyFactory, TipOracle, TipSource
+
+from rpc_node import StandInNode
+
+
+class CountingSource(TipSource):
+    name = "counting"
+
+    def __init__(self, tips: list):
+        self.tips = tips
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        tip = self.tips[min(self.fetches, len(self.tips)) - 1]
+        if isinstance(tip, Exception):
+            raise tip
+        return tip
+
+
+class TestTipOracle:
+    def test_serves_cached_tip_within_ttl(self):
+        source = CountingSource([2 * GWEI, 3 * GWEI])
+        oracle = TipOracle([source], refresh_interval=60, ttl=60)
+
+        assert oracle.tip() == 2 * GWEI
+        assert oracle.tip() == 2 * GWEI
+        assert source.fetches == 1
+
+    def test_ttl_is_at_least_the_refresh_interval(self):
+        oracle = TipOracle([CountingSource([2 * GWEI])], refresh_interval=120, ttl=60)
+
+        assert oracle.ttl == 120
+
+    def test_refreshes_stale_tip(self):
+        source = CountingSource([2 * GWEI, 3 * GWEI])
+        oracle = TipOracle([source], refresh_interval=0.05, ttl=0.05)
+
+        assert oracle.tip() == 2 * GWEI
+        time.sleep(0.1)
+        assert oracle.tip() == 3 * GWEI
+
+    def test_falls_through_sources(self):
+        failing = CountingSource([ValueError("unavailable")])
+        empty = CountingSource([None])
+        oracle = TipOracle([failing, empty], fallback_tip=GWEI)
+
+        assert oracle.tip() == GWEI
+        assert oracle.source == "static"
+        assert failing.fetches == 1 and empty.fetches == 1
+
+    def test_refreshes_in_background(self):
+        source = CountingSource([2 * GWEI, 3 * GWEI])
+        oracle = TipOracle([source], refresh_interval=0.05, ttl=60)
+        oracle.start()
+        time.sleep(0.2)
+        oracle.stop()
+
+        assert source.fetches >= 2
+        assert oracle.tip() == 3 * GWEI
+
+
+class TestGasStrategyFactory:
+    def avoided(self) -> float:
+        return REGISTRY.get_sample_value("chief_gas_fetches_avoided_total") or 0
+
+    def test_fetches_tip_only_when_building(self):
+        source = CountingSource([2 * GWEI])
+        factory = GasStrategyFactory(Web3(), TipOracle([source], refresh_interval=0, ttl=0))
+
+        before = self.avoided()
+        for _ in range(3):
+            factory.begin_block()
+            factory.end_block()
+
+        assert source.fetches == 0
+        assert self.avoided() == before + 3
+
+    def test_builds_strategy_from_current_tip(self):
+        source = CountingSource([2 * GWEI, 3 * GWEI])
+        factory = GasStrategyFactory(Web3(), TipOracle([source], refresh_interval=0, ttl=0))
+
+        before = self.avoided()
+        factory.begin_block()
+        assert factory().initial_tip == 2 * GWEI
+        assert factory().initial_tip == 3 * GWEI
+        factory.end_block()
+
+        assert self.avoided() == before
+
+
+class TestFeeHistoryTipSource:
+    @pytest.fixture()
+    def node(self) -> StandInNode:
+        node = StandInNode()
+        node.handlers["eth_feeHistory"] = lambda params: {
+            "oldestBlock": hex(96),
+            "baseFeePerGas": [hex(30 * GWEI)] * 5,
+            "gasUsedRatio": [0.5] * 4,
+            "reward": [[hex(1 * GWEI)], [hex(0)], [hex(3 * GWEI)], [hex(2 * GWEI)]],
+        }
+        node.start()
+        yield node
+        node.stop()
+
+    def test_median_of_non_empty_blocks(self, node):
+        source = FeeHistoryTipSource(Web3(HTTPProvider(node.url)), percentile=80, blocks=4)
+
+        assert source.fetch() == 2 * GWEI
+        assert node.calls["eth_feeHistory"] == 1
@@ -0,0 +1,152 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+import websockets
+
+from chief_keeper.heads import HeadSubscription
+
+
+class HeadsNode:
+    """WebSocket node that answers `eth_subscribe` and then publishes whatever heads are queued"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.sockets = []
+        self.server = None
+        self.port = None
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    def start(self) -> "HeadsNode":
+        async def serve():
+            self.server = await websockets.serve(self._handle, "127.0.0.1", 0)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+        asyncio.run_coroutine_threadsafe(serve(), self.loop).result()
+        return self
+
+    def stop(self):
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+
+    def publish(self, number: int, timestamp: int = None):
+        header = {"number": hex(number), "timestamp": hex(timestamp or int(time.time()))}
+        message = json.dumps({"jsonrpc": "2.0", "method": "eth_subscription",
+                              "params": {"subscription": "0x1", "result": header}})
+        for socket in list(self.sockets):
+            asyncio.run_coroutine_threadsafe(socket.send(message), self.loop).result()
+
+    async def _handle(self, socket, path):
+        request = json.loads(await socket.recv())
+        await socket.send(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": "0x1"}))
+        self.sockets.append(socket)
+        try:
+            await socket.wait_closed()
+        finally:
+            self.sockets.remove(socket)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture()
+def node() -> HeadsNode:
+    node = HeadsNode().start()
+    yield node
+    node.stop()
+
+
+class TestHeadSubscription:
+
+    def test_heads_are_delivered(self, node):
+        heads = []
+        subscription = HeadSubscription([node.url], heads.append)
+        subscription.start()
+        try:
+            wait_for(lambda: subscription.connected and node.sockets)
+            for number in [100, 101, 101, 99, 102]:
+                node.publish(number, 1600000000 + number)
+                time.sleep(0.05)
+
+            wait_for(lambda: heads and heads[-1].number == 102)
+            assert [head.number for head in heads] == [100, 101, 102]
+            assert heads[0].timestamp == 1600000100
+        finally:
+            subscription.stop()
+
+    def test_slow_processing_only_gets_the_latest_head(self, node):
+        heads = []
+
+        def slow_callback(head):
+            heads.append(head.number)
+            time.sleep(0.3)
+
+        subscription = HeadSubscription([node.url], slow_callback)
+        subscription.start()
+        try:
+            wait_for(lambda: subscription.connected and node.sockets)
+            for number in range(100, 106):
+                node.publish(number)
+                time.sleep(0.02)
+
+            wait_for(lambda: heads and heads[-1] == 105)
+            assert heads == [100, 105]
+        finally:
+            subscription.stop()
+
+    def test_falls_over_to_the_next_url(self, node):
+        heads = []
+        subscription = HeadSubscription(["ws://127.0.0.1:1", node.url], heads.append, reconnect_delay=0.1)
+        subscription.start()
+        try:
+            wait_for(lambda: subscription.connected and node.sockets)
+            node.publish(100)
+            wait_for(lambda: heads)
+        finally:
+            subscription.stop()
+
+    def test_reconnects_after_the_socket_dies(self, node):
+        heads = []
+        subscription = HeadSubscription([node.url], heads.append, reconnect_delay=0.1)
+        subscription.start()
+        try:
+            wait_for(lambda: subscription.connected and node.sockets)
+            asyncio.run_coroutine_threadsafe(node.sockets[0].close(), node.loop).result()
+            wait_for(lambda: not subscription.connected or not node.sockets)
+
+            wait_for(lambda: subscription.connected and node.sockets)
+            node.publish(100)
+            wait_for(lambda: heads)
+        finally:
+            subscription.stop()
@@ -83,6 +83,8 @@ class TestChiefKeeper:
         hat = mcd.ds_chief.get_hat()
         verify([hat.address], etas, 1)
 
+        keeper.check_eta()
+        keeper.transactions.wait()
         keeper.check_eta()
 
         # Confirm that the spell was casted and that the database was updated
@@ -105,11 +107,16 @@ class TestChiefKeeper:
         assert mcd.ds_chief.vote_yays([self.spell.address.address]).transact(from_address=guy_address)
 
         keeper.check_hat()
+        keeper.transactions.wait()
 
         # Confirm that the hat has been lifted
         newerHat = mcd.ds_chief.get_hat()
         assert newerHat.address == self.spell.address.address
 
+        # The new hat is scheduled on the next block
+        keeper.check_hat()
+        keeper.transactions.wait()
+
         # Confirm that the spell was scheduled
         assert self.spell.eta() != 0
 
@@ -120,6 +127,7 @@ class TestChiefKeeper:
         # clear out anything that came before
         keeper.check_hat()
         keeper.check_eta()
+        keeper.transactions.wait()
 
         # Give 5000 MKR to our_address
         amount = Wad.from_number(5000)
@@ -132,6 +140,9 @@ class TestChiefKeeper:
         assert mcd.ds_chief.vote_yays([spell.address.address]).transact(from_address=our_address)
 
         keeper.check_hat()
+        keeper.transactions.wait()
+        keeper.check_hat()
+        keeper.transactions.wait()
 
         block = mcd.web3.eth.blockNumber
         simpledb.update_db_etas(block)
@@ -141,6 +152,8 @@ class TestChiefKeeper:
         etas = keeper.database.db.get(doc_id=3)['upcoming_etas']
         verify([hat.address], etas, 1)
 
+        keeper.check_eta()
+        keeper.transactions.wait()
         keeper.check_eta()
 
         # Confirm that the spell was casted and that the database was updated
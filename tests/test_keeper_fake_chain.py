@@ -0,0 +1,198 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import glob
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+from web3 import Web3
+
+import chief_keeper
+from chief_keeper.chief_keeper import ChiefKeeper
+from chief_keeper.heads import Head
+from chief_keeper.metrics import health
+from chief_keeper.transactions import TransactionPipeline
+
+from rpc_node import FakeChain, StandInNode
+
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+PAUSE = "0xbE286431454714F511008713973d3B053A2d38f3"
+KEEPER = "0xaAaAaAaaAaAaAaaAaAAAAAAAAaaaAaAaAaaAaaAa"
+NETWORK = "test_keeper_fake_chain"
+
+
+def address(i: int) -> str:
+    return Web3.toChecksumAddress("0x" + f"{i + 1:040x}")
+
+
+class FailingTransact:
+    nonce = None
+
+    def transact(self, gas_strategy=None):
+        raise ValueError("connection reset")
+
+
+class FlakyPipeline(TransactionPipeline):
+    """Fails the first send of each intent in `fail_once`, and records the others instead of sending them"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_once = set()
+        self.sent = []
+
+    def _send(self, key, transact, gas_strategy, nonce, on_done):
+        if key in self.fail_once:
+            self.fail_once.remove(key)
+            return super()._send(key, FailingTransact(), gas_strategy, nonce, on_done)
+
+        self.sent.append(key)
+        receipt = SimpleNamespace(successful=True)
+        if on_done is not None:
+            on_done(receipt)
+        self._finish(key, receipt)
+
+
+def database_files() -> list:
+    directory = os.path.join(os.path.dirname(os.path.abspath(chief_keeper.__file__)), "database")
+    return glob.glob(os.path.join(directory, f"db_{NETWORK}.*"))
+
+
+@pytest.fixture()
+def chain(tmp_path, monkeypatch) -> FakeChain:
+    monkeypatch.setenv("METRICS_PORT", "0")
+    node = StandInNode()
+    chain = FakeChain(node, CHIEF, PAUSE)
+    chain.chief.etch([address(0)])
+    chain.chief.lock(address(100), 10**18)
+    chain.chief.vote(address(100), [address(0)])
+    chain.chief.lift(address(0))
+    chain.mine()
+    node.start()
+
+    deployment_file = str(tmp_path / "addresses.json")
+    with open(deployment_file, "w") as f:
+        json.dump({"MCD_ADM": CHIEF, "MCD_PAUSE": PAUSE}, f)
+    chain.deployment_file = deployment_file
+
+    yield chain
+    node.stop()
+    for path in database_files():
+        os.remove(path)
+
+
+@pytest.fixture()
+def keeper(chain: FakeChain) -> ChiefKeeper:
+    keeper = ChiefKeeper([
+        "--rpc-primary-url", chain.node.url, "--rpc-backup-url", chain.node.url, "--network", NETWORK,
+        "--eth-from", KEEPER, "--dss-deployment-file", chain.deployment_file, "--fast-start",
+        "--gas-tip-refresh", "0", "--health-file", "",
+    ])
+    keeper.transactions = FlakyPipeline(keeper.web3, KEEPER)
+    keeper.check_deployment()
+    chain.mine()
+    keeper.process_block()
+    yield keeper
+    keeper.shutdown()
+
+
+class TestCheckEta:
+    def test_cast_is_sent_again_after_failing(self, chain: FakeChain, keeper: ChiefKeeper):
+        spell = chain.pause.deploy(address(200), address(201))
+        chain.mine()
+        chain.chief.etch([spell])
+        keeper.process_block()
+
+        chain.mine()
+        chain.pause.plot(spell, chain.timestamp())
+        keeper.transactions.fail_once.add(("cast", spell))
+        keeper.process_block()
+        keeper.transactions.wait(10)
+        assert keeper.transactions.sent == []
+
+        chain.mine()
+        keeper.process_block()
+        keeper.transactions.wait(10)
+        assert keeper.transactions.sent == [("cast", spell)]
+
+        # Once cast, the eta is dropped on the exec note and no cast is sent again
+        chain.mine()
+        chain.pause.exec(spell)
+        keeper.process_block()
+        keeper.transactions.wait(10)
+        assert keeper.transactions.sent == [("cast", spell)]
+        assert spell not in keeper.database.get_db_etas()
+
+
+class TestBlockLag:
+    def test_lag_is_measured_from_the_chain_head(self, chain: FakeChain, keeper: ChiefKeeper):
+        chain.mine()
+        keeper.process_block()
+        assert REGISTRY.get_sample_value("chief_block_lag_blocks") == 0
+
+        # A head the chain has since moved 3 blocks past
+        chain.mine(4)
+        keeper.process_block(Head(chain.block - 3, chain.timestamp(chain.block - 3), time.time()))
+
+        assert REGISTRY.get_sample_value("chief_block_lag_blocks") == 3
+        assert health.block_lag == 3
+
+
+class TestProcessBlock:
+    def test_failed_block_is_processed_again(self, chain: FakeChain, keeper: ChiefKeeper, monkeypatch):
+        check_eta = keeper.check_eta
+        failures = [ValueError("connection reset")]
+
+        def flaky_check_eta(context):
+            if failures:
+                raise failures.pop()
+            check_eta(context)
+
+        monkeypatch.setattr(keeper, "check_eta", flaky_check_eta)
+        chain.mine()
+        keeper.process_block()
+        assert keeper.errors == 1
+        assert keeper.last_processed_block == chain.block - 1
+
+        # The next poll of the same block retries it
+        keeper.process_block()
+        assert keeper.errors == 1
+        assert keeper.last_processed_block == chain.block
+
+    def test_head_ahead_of_node_is_left_for_later(self, chain: FakeChain, keeper: ChiefKeeper, monkeypatch):
+        monkeypatch.setattr(chief_keeper.chief_keeper, "HEAD_WAIT_TIME", 0.2)
+        processed = keeper.last_processed_block
+
+        keeper.process_block(Head(chain.block + 1, chain.timestamp(chain.block + 1), time.time()))
+        assert keeper.errors == 0
+        assert keeper.last_processed_block == processed
+
+        chain.mine()
+        keeper.process_block()
+        assert keeper.errors == 0
+        assert keeper.last_processed_block == chain.block
+
+
+class TestArguments:
+    def test_negative_tip_refresh_is_rejected(self):
+        with pytest.raises(SystemExit):
+            ChiefKeeper(["--rpc-primary-url", "http://localhost:1", "--network", NETWORK, "--eth-from", KEEPER,
+                         "--gas-tip-refresh", "-1"])
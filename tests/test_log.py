@@ -0,0 +1,93 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import json
+import logging
+
+import pytest
+
+from chief_keeper.log import RATE_LIMITED, RateLimitFilter, configure_logging, log_context, stop_listener
+from chief_keeper.metrics import time_block_phase
+
+
+@pytest.fixture()
+def output():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield io.StringIO()
+    logging.basicConfig(force=True, handlers=handlers)
+    root.setLevel(level)
+
+
+def lines(output: io.StringIO) -> list:
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+class TestLogging:
+    def test_json_carries_block_and_phase(self, output):
+        configure_logging(json_output=True, stream=output)
+
+        with log_context(block=100):
+            logging.getLogger().info("checking")
+            with time_block_phase("db_yays"):
+                logging.getLogger().warning("updating")
+        logging.getLogger().info("idle")
+
+        assert lines(output) == [
+            {"time": lines(output)[0]["time"], "level": "INFO", "logger": "root", "message": "checking", "block": 100},
+            {"time": lines(output)[1]["time"], "level": "WARNING", "logger": "root", "message": "updating", "block": 100,
+             "phase": "db_yays"},
+            {"time": lines(output)[2]["time"], "level": "INFO", "logger": "root", "message": "idle"},
+        ]
+
+    def test_rate_limits_each_call_site(self, output):
+        now = [0]
+        configure_logging(json_output=True, stream=output)
+        logging.getLogger().handlers[0].addFilter(RateLimitFilter(60, clock=lambda: now[0]))
+
+        for block in range(5):
+            now[0] = block * 20
+            logging.getLogger().info(f"Checking Hat on block {block}", extra=RATE_LIMITED)
+            logging.getLogger().error(f"Error on block {block}", extra=RATE_LIMITED)
+
+        messages = [(line["message"], line.get("suppressed")) for line in lines(output)]
+        assert messages == [("Checking Hat on block 0", None)] + [(f"Error on block {block}", None) for block in range(3)] + \
+            [("Checking Hat on block 3", 2), ("Error on block 3", None), ("Error on block 4", None)]
+
+    def test_only_steady_state_lines_are_limited(self, output):
+        now = [0]
+        configure_logging(json_output=True, stream=output)
+        logging.getLogger().handlers[0].addFilter(RateLimitFilter(60, clock=lambda: now[0]))
+
+        for spell in range(3):
+            logging.getLogger().info(f"Casting spell ({spell})")
+
+        assert [line["message"] for line in lines(output)] == [f"Casting spell ({spell})" for spell in range(3)]
+
+    def test_queued_critical_writes_out_and_exits(self, output):
+        listener = configure_logging(queued=True, stream=output)
+        try:
+            logging.getLogger().info("before")
+            with pytest.raises(SystemExit):
+                logging.getLogger().critical("fatal")
+
+            assert output.getvalue().splitlines()[0].endswith("[INFO] root - before")
+            assert output.getvalue().splitlines()[1].endswith("[CRITICAL] root - fatal")
+        finally:
+            stop_listener(listener)
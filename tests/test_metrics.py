@@ -0,0 +1,201 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import tracemalloc
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+from chief_keeper import metrics
+from chief_keeper.metrics import AddressLabels, Health, MetricsServer
+
+HAT_METRICS = ["chief_new_hat_event", "chief_lift_called", "chief_valid_hat", "chief_hat"]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def address(i: int) -> str:
+    return "0x" + f"{i:040x}"
+
+
+def series_count(names: list) -> int:
+    return sum(len(family.samples) for family in REGISTRY.collect() if family.name in names)
+
+
+@pytest.fixture()
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(metrics, "address_labels", AddressLabels(capacity=4, ttl=60, clock=clock))
+    return clock
+
+
+def change_hat(i: int):
+    metrics.record_lift_called(address(i), address(i + 1))
+    metrics.record_new_hat_event(address(i), address(i + 1))
+    metrics.set_hat_validity(True, address(i + 1))
+
+
+class TestAddressLabels:
+    def test_evicts_least_recently_seen_past_capacity(self, clock):
+        for i in range(4):
+            metrics.record_schedule_called(address(1000 + i))
+        metrics.record_schedule_called(address(1000))
+        metrics.record_schedule_called(address(1004))
+
+        # 1001 was seen least recently, so the newest spell takes its place
+        assert REGISTRY.get_sample_value("chief_schedule_called_total", {"spell_address": address(1001)}) is None
+        assert REGISTRY.get_sample_value("chief_schedule_called_total", {"spell_address": address(1000)}) == 2
+        assert REGISTRY.get_sample_value("chief_schedule_called_total", {"spell_address": address(1004)}) == 1
+
+    def test_expires_idle_addresses_and_their_series(self, clock):
+        metrics.record_lift_called(address(2000), address(2001))
+        clock.now = 30
+        metrics.record_lift_called(address(2001), address(2002))
+        clock.now = 61
+        metrics.record_lift_called(address(2002), address(2003))
+
+        # 2000 is past the ttl and shares its only series with it, 2001 is still within it
+        assert REGISTRY.get_sample_value("chief_lift_called_total", {"old_hat_address": address(2000),
+                                                                     "new_hat_address": address(2001)}) is None
+        assert REGISTRY.get_sample_value("chief_lift_called_total", {"old_hat_address": address(2001),
+                                                                     "new_hat_address": address(2002)}) == 1
+        assert list(metrics.address_labels.last_seen) == [address(2001), address(2002), address(2003)]
+
+    def test_addresses_of_one_call_are_kept_together(self, monkeypatch):
+        monkeypatch.setattr(metrics, "address_labels", AddressLabels(capacity=1, ttl=60, clock=Clock()))
+
+        addresses = {address(i) for i in range(3000, 3010)}
+        for i in range(3000, 3010, 2):
+            metrics.record_lift_called(address(i), address(i + 1))
+
+            # Both addresses of the series just recorded are tracked, so the series is removed with them later
+            assert REGISTRY.get_sample_value("chief_lift_called_total", {"old_hat_address": address(i),
+                                                                         "new_hat_address": address(i + 1)}) == 1
+            assert set(metrics.address_labels.last_seen) == {address(i), address(i + 1)}
+            lifts = [sample for family in REGISTRY.collect() if family.name == "chief_lift_called"
+                     for sample in family.samples
+                     if sample.name.endswith("_total") and sample.labels["old_hat_address"] in addresses]
+            assert len(lifts) == 1
+
+    def test_current_hat_is_a_single_series(self, clock):
+        metrics.set_hat_validity(True, address(1))
+        metrics.set_hat_validity(False, address(2))
+
+        assert REGISTRY.get_sample_value("chief_hat_info", {"hat_address": address(2)}) == 1
+        assert REGISTRY.get_sample_value("chief_hat_info", {"hat_address": address(1)}) is None
+        assert REGISTRY.get_sample_value("chief_valid_hat", {"hat_address": address(2)}) == 0
+        assert REGISTRY.get_sample_value("chief_valid_hat", {"hat_address": address(1)}) is None
+
+    def test_memory_stays_flat_over_hat_changes(self, clock):
+        # pytest keeps every captured log record, which would count as growth once the root level is INFO
+        logging.disable(logging.INFO)
+        try:
+            for i in range(10000):
+                clock.now = i * 30
+                change_hat(i)
+
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            series = series_count(HAT_METRICS)
+            for i in range(10000, 100000):
+                clock.now = i * 30
+                change_hat(i)
+            growth = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        assert series_count(HAT_METRICS) <= series
+        assert growth < 64 * 1024
+
+
+class TestHealth:
+    def test_live_until_max_age_without_beat(self):
+        clock = Clock()
+        health = Health(max_age=900, clock=clock)
+
+        clock.now = 900
+        assert health.liveness()[0]
+        health.beat()
+        clock.now = 1801
+        assert not health.liveness()[0]
+
+    def test_ready_once_block_processed_with_usable_node(self):
+        clock = Clock()
+        health = Health(max_age=900, clock=clock)
+        assert not health.readiness()[0]
+
+        health.beat()
+        health.block_processed(100, 1, 0)
+        ready, status = health.readiness()
+        assert ready
+        assert status["last_processed_block"] == 100
+        assert status["block_lag"] == 1
+
+        health.rpc_status = lambda: (False, {"primary": {"healthy": False}})
+        ready, status = health.readiness()
+        assert not ready
+        assert status["rpc"] == {"primary": {"healthy": False}}
+
+    def test_rate_limits_file_writes(self, tmp_path):
+        clock = Clock()
+        path = tmp_path / "health.log"
+        health = Health(file_path=str(path), file_interval=60, clock=clock)
+
+        clock.now = 1000
+        health.beat()
+        clock.now = 1059
+        health.beat()
+        assert path.read_text() == "1000\n"
+
+        clock.now = 1060
+        health.beat()
+        assert path.read_text() == "1060\n"
+
+
+class TestMetricsServer:
+    @pytest.fixture()
+    def server(self, monkeypatch) -> MetricsServer:
+        monkeypatch.setattr(metrics, "health", Health(max_age=900))
+        monkeypatch.setenv("METRICS_PORT", "0")
+        server = MetricsServer(host="127.0.0.1")
+        server.start()
+        yield server
+        server.stop()
+
+    def test_serves_health_and_metrics(self, server):
+        url = f"http://127.0.0.1:{server.port}"
+
+        assert requests.get(f"{url}/healthz").status_code == 200
+        assert requests.get(f"{url}/readyz").status_code == 503
+
+        metrics.health.beat()
+        metrics.health.block_processed(100, 1, 0)
+        response = requests.get(f"{url}/readyz")
+        assert response.status_code == 200
+        assert response.json()["last_processed_block"] == 100
+
+        assert "chief_block_lag_blocks" in requests.get(f"{url}/metrics").text
@@ -0,0 +1,169 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+from web3 import Web3, HTTPProvider
+
+from chief_keeper.database import SimpleDatabase
+from chief_keeper.pause import PauseNotes
+from chief_keeper.storage import TinyDBStore
+
+from rpc_node import FakePause, RpcError, StandInNode
+
+PAUSE = "0xbE286431454714F511008713973d3B053A2d38f3"
+EOA = "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"
+
+
+def address(i: int) -> str:
+    return Web3.toChecksumAddress("0x" + f"{i + 1:040x}")
+
+
+@pytest.fixture()
+def pause() -> FakePause:
+    node = StandInNode()
+    pause = FakePause(node, PAUSE, block=100)
+    node.start()
+    yield pause
+    node.stop()
+
+
+@pytest.fixture()
+def database(pause, tmp_path) -> SimpleDatabase:
+    web3 = Web3(HTTPProvider(pause.node.url))
+    database = SimpleDatabase(web3, 0, "testnet", None)
+    database.store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+    database.store.initialize(pause.block, [address(i) for i in range(5)], {}, pause.block)
+    database.pause_notes = PauseNotes(web3, PAUSE)
+    database.load()
+
+    for i in range(5):
+        pause.deploy(address(i), address(100 + i))
+    return database
+
+
+class TestPauseNotes:
+
+    def test_consumers_share_one_query_per_block(self, pause):
+        notes = PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE)
+        pause.deploy(address(0), address(100))
+        pause.plot(address(0), 100)
+        notes.get(100, 100)
+        pause.node.reset_counters()
+
+        for block in range(101, 111):
+            pause.mine()
+            pause.plot(address(0), block)
+            assert [note.eta for note in notes.get(block, block)] == [block]
+            assert [note.eta for note in notes.get(block - 1, block)] == [block - 1, block]
+
+        assert pause.node.calls["eth_getLogs"] == 10
+
+    def test_old_blocks_are_forgotten(self, pause):
+        notes = PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE, keep_blocks=5)
+        pause.deploy(address(0), address(100))
+        pause.plot(address(0), 100)
+        pause.mine(10)
+
+        notes.get(100, pause.block)
+        assert notes.from_block == pause.block - 4
+        assert notes.notes == []
+
+        # Asking for blocks that were forgotten queries them again
+        assert [note.eta for note in notes.get(100, pause.block)] == [100]
+
+    def test_long_range_is_fetched_in_chunks(self, pause):
+        get_logs = pause.node.handlers["eth_getLogs"]
+
+        def limited_get_logs(params):
+            if int(params[0]["toBlock"], 16) - int(params[0]["fromBlock"], 16) >= 2000:
+                raise RpcError("block range is too large")
+            return get_logs(params)
+
+        pause.node.handlers["eth_getLogs"] = limited_get_logs
+        notes = PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE)
+        pause.deploy(address(0), address(100))
+        pause.plot(address(0), 100)
+        pause.mine(20000)
+        pause.drop(address(0), guy=address(2))
+        pause.plot(address(0), 200)
+
+        assert [(note.action, note.eta) for note in notes.get(100, pause.block)] == \
+               [("plot", 100), ("drop", 100), ("plot", 200)]
+
+
+class TestPauseEtas:
+
+    def test_plot_and_exec(self, pause, database):
+        pause.mine()
+        pause.plot(address(0), 1600000000)
+        pause.plot(address(1), 1600000100)
+        database.update_db_etas(pause.block)
+
+        assert database.get_db_etas() == {address(0): 1600000000.0, address(1): 1600000100.0}
+
+        pause.mine()
+        pause.exec(address(0))
+        database.update_db_etas(pause.block)
+
+        assert database.get_db_etas() == {address(1): 1600000100.0}
+        assert database.db.get(doc_id=3) == {"upcoming_etas": {address(1): 1600000100.0},
+                                             "last_block_checked_for_etas": pause.block}
+
+    def test_drop_removes_the_dropped_plan(self, pause, database):
+        pause.mine()
+        pause.plot(address(0), 1600000000)
+        pause.plot(address(1), 1600000000)
+        database.update_db_etas(pause.block)
+
+        pause.mine()
+        pause.drop(address(1), guy=address(2))
+        database.update_db_etas(pause.block)
+
+        assert database.get_db_etas() == {address(0): 1600000000.0}
+
+    def test_drop_after_restart_is_matched_by_eta(self, pause, database):
+        pause.mine()
+        pause.plot(address(0), 1600000000)
+        pause.plot(address(1), 1600000100)
+        database.update_db_etas(pause.block)
+
+        database.plans = {}
+        pause.mine()
+        pause.drop(address(1), guy=address(2))
+        database.update_db_etas(pause.block)
+
+        assert database.get_db_etas() == {address(0): 1600000000.0}
+
+    def test_plans_of_unknown_spells_are_ignored(self, pause, database):
+        pause.deploy(address(50), address(150))
+        pause.mine()
+        pause.plot(address(50), 1600000000)
+        database.update_db_etas(pause.block)
+
+        assert database.get_db_etas() == {}
+
+    def test_one_log_query_and_no_calls_per_block(self, pause, database):
+        pause.node.reset_counters()
+        for _ in range(10):
+            pause.mine()
+            database.update_db_etas(pause.block)
+
+        assert pause.node.calls["eth_getLogs"] == 10
+        assert pause.node.calls["eth_call"] == 0
+        assert pause.node.calls["eth_getCode"] == 0
@@ -0,0 +1,86 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+from prometheus_client import REGISTRY
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.metrics import time_block_phase
+from chief_keeper.rpc import batch_request, rpc_metrics_middleware
+
+from rpc_node import RpcError, StandInNode
+
+
+def fail(params):
+    raise RpcError("execution reverted")
+
+
+@pytest.fixture()
+def web3() -> Web3:
+    node = StandInNode()
+    node.handlers["eth_blockNumber"] = lambda params: hex(100)
+    node.handlers["eth_chainId"] = lambda params: hex(1)
+    node.handlers["eth_gasPrice"] = fail
+    node.start()
+
+    web3 = Web3(HTTPProvider(node.url))
+    web3.middleware_onion.add(rpc_metrics_middleware, "rpc_metrics")
+    yield web3
+    node.stop()
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestRpcMetrics:
+    def test_counts_requests_by_method(self, web3):
+        requests = sample("chief_rpc_requests_total", method="eth_blockNumber")
+        latencies = sample("chief_rpc_request_seconds_count", method="eth_blockNumber")
+        errors = sample("chief_rpc_request_errors_total", method="eth_gasPrice")
+
+        assert web3.eth.blockNumber == 100
+        assert web3.eth.blockNumber == 100
+        with pytest.raises(ValueError):
+            web3.eth.gasPrice
+
+        assert sample("chief_rpc_requests_total", method="eth_blockNumber") == requests + 2
+        assert sample("chief_rpc_request_seconds_count", method="eth_blockNumber") == latencies + 2
+        assert sample("chief_rpc_request_errors_total", method="eth_gasPrice") == errors + 1
+
+    def test_counts_batched_calls(self, web3):
+        requests = sample("chief_rpc_requests_total", method="eth_chainId")
+        errors = sample("chief_rpc_request_errors_total", method="eth_gasPrice")
+        batches = sample("chief_rpc_request_seconds_count", method="batch")
+
+        results = batch_request(web3, [("eth_chainId", []), ("eth_chainId", []), ("eth_gasPrice", [])], max_batch_size=2)
+
+        assert results[:2] == [hex(1), hex(1)]
+        assert isinstance(results[2], ValueError)
+        assert sample("chief_rpc_requests_total", method="eth_chainId") == requests + 2
+        assert sample("chief_rpc_request_errors_total", method="eth_gasPrice") == errors + 1
+        assert sample("chief_rpc_request_seconds_count", method="batch") == batches + 2
+
+    def test_times_phase_that_raises(self):
+        before = sample("chief_block_phase_seconds_count", phase="db_yays")
+
+        with pytest.raises(RuntimeError):
+            with time_block_phase("db_yays"):
+                raise RuntimeError()
+
+        assert sample("chief_block_phase_seconds_count", phase="db_yays") == before + 1
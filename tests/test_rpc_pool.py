@@ -0,0 +1,202 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import time
+
+import pytest
+from web3 import Web3
+
+from chief_keeper.rpc import batch_request
+from chief_keeper.rpc_pool import ProviderPool
+
+from rpc_node import RpcError, StandInNode, selector
+
+HAT = selector("hat()")
+
+
+def chain_node(head: int, delay: float = 0) -> StandInNode:
+    node = StandInNode()
+
+    def block_number(params):
+        time.sleep(delay)
+        return hex(head)
+
+    def call(params):
+        time.sleep(delay)
+        if int(params[1], 16) > head:
+            raise RpcError("header not found")
+        return "0x" + "00" * 31 + "01"
+
+    node.handlers["eth_blockNumber"] = block_number
+    node.handlers["eth_call"] = call
+    node.handlers["web3_clientVersion"] = lambda params: "stand-in"
+    return node.start()
+
+
+def closed_port_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+@pytest.fixture()
+def nodes():
+    started = []
+
+    def start(*args, **kwargs) -> StandInNode:
+        node = chain_node(*args, **kwargs)
+        started.append(node)
+        return node
+
+    yield start
+    for node in started:
+        node.stop()
+
+
+def call_params(block: int, data: str = "0x") -> list:
+    return [{"to": "0x" + "11" * 20, "data": data}, hex(block)]
+
+
+def filter_not_found(params):
+    raise RpcError("filter not found")
+
+
+def filter_node(node: StandInNode, block_hash: str):
+    """Lets `node` create block filter 0x1, whose changes are `block_hash`, and serve that block"""
+    node.handlers["eth_newBlockFilter"] = lambda params: "0x1"
+    node.handlers["eth_getFilterChanges"] = lambda params: [block_hash]
+    node.handlers["eth_getBlockByHash"] = lambda params: {"hash": block_hash, "number": hex(100)}
+
+
+class TestProviderPool:
+    def test_routes_to_fastest_node(self, nodes):
+        slow, fast = nodes(100, delay=0.05), nodes(100)
+        pool = ProviderPool([slow.url, fast.url], [10, 10])
+        pool.refresh_heads()
+        slow.reset_counters()
+        fast.reset_counters()
+
+        for _ in range(10):
+            pool.make_request("eth_call", call_params(100))
+
+        assert fast.calls["eth_call"] == 10
+        assert slow.calls["eth_call"] == 0
+
+    def test_fails_over_from_unreachable_node(self, nodes):
+        node = nodes(100)
+        pool = ProviderPool([closed_port_url(), node.url], [1, 10])
+
+        assert Web3(pool).isConnected()
+        assert pool.make_request("eth_blockNumber", [])["result"] == hex(100)
+        assert pool.ranked()[0].endpoint_uri == node.url
+
+    def test_head_is_credited_to_the_answering_node(self, nodes):
+        first, second = nodes(100), nodes(100, delay=0.02)
+        pool = ProviderPool([first.url, second.url], [10, 10])
+        pool.refresh_heads()
+
+        def not_found(params):
+            raise RpcError("header not found")
+
+        # The first node is still the fastest healthy one, but it is the second that answers
+        first.handlers["eth_blockNumber"] = not_found
+        second.handlers["eth_blockNumber"] = lambda params: hex(105)
+
+        assert pool.make_request("eth_blockNumber", [])["result"] == hex(105)
+        assert pool.endpoints[0].head == 100
+        assert pool.endpoints[1].head == 105
+
+    def test_routes_around_lagging_node(self, nodes):
+        lagging, synced = nodes(90), nodes(100, delay=0.02)
+        pool = ProviderPool([lagging.url, synced.url], [10, 10], max_head_lag=3)
+        pool.refresh_heads()
+
+        assert pool.head_lag(pool.endpoints[0]) == 10
+        assert pool.ranked()[0].endpoint_uri == synced.url
+
+    def test_retries_read_pinned_past_node_head(self, nodes):
+        behind, ahead = nodes(99), nodes(100, delay=0.02)
+        pool = ProviderPool([behind.url, ahead.url], [10, 10], max_head_lag=3)
+        pool.refresh_heads()
+
+        response = pool.make_request("eth_call", call_params(100))
+
+        assert "result" in response
+        assert behind.calls["eth_call"] == 1
+        assert ahead.calls["eth_call"] == 1
+
+    def test_hedges_slow_read_to_second_node(self, nodes):
+        first, second = nodes(100), nodes(100)
+        pool = ProviderPool([first.url, second.url], [10, 10], hedge=True, hedge_delay=0.05)
+        pool.refresh_heads()
+        first.handlers["eth_call"] = lambda params: time.sleep(1) or "0x01"
+
+        started = time.perf_counter()
+        response = pool.make_request("eth_call", call_params(100, HAT))
+
+        assert response["result"] == "0x" + "00" * 31 + "01"
+        assert time.perf_counter() - started < 0.5
+        assert second.calls["eth_call"] == 1
+
+        pool.stop()
+
+    def test_only_hat_and_approval_reads_are_hedged(self, nodes):
+        first, second = nodes(100), nodes(100)
+        pool = ProviderPool([first.url, second.url], [10, 10], hedge=True, hedge_delay=0.05)
+        pool.refresh_heads()
+        for node in [first, second]:
+            node.handlers["eth_call"] = lambda params: time.sleep(0.2) or "0x01"
+
+        # Neither a read of something else nor a batch that isn't only hat and approval reads goes to both nodes
+        pool.make_request("eth_call", call_params(100))
+        batch_request(Web3(pool), [("eth_call", call_params(100, HAT)), ("eth_blockNumber", [])])
+
+        assert first.calls["eth_call"] + second.calls["eth_call"] == 2
+        pool.stop()
+
+    def test_filters_stay_on_the_node_that_created_them(self, nodes):
+        block_hash = "0x" + "ab" * 32
+        first, second = nodes(100), nodes(100)
+        filter_node(first, block_hash)
+        second.handlers["eth_getFilterChanges"] = filter_not_found
+        second.handlers["eth_getBlockByHash"] = lambda params: None
+        pool = ProviderPool([first.url, second.url], [10, 10])
+
+        block_filter = Web3(pool).eth.filter("latest")
+        assert pool._filters[block_filter.filter_id] is pool.endpoints[0]
+
+        # The second node becomes the fastest, but the filter and the blocks it returns are read from the first
+        for _ in range(5):
+            pool.endpoints[0].record(1.0, True)
+        assert pool.ranked()[0] is pool.endpoints[1]
+
+        hashes = block_filter.get_new_entries()
+        assert Web3.toHex(hashes[0]) == block_hash
+        assert Web3(pool).eth.getBlock(hashes[0])["number"] == 100
+        assert second.calls["eth_getFilterChanges"] == 0
+        assert second.calls["eth_getBlockByHash"] == 0
+
+    def test_batches_through_pool(self, nodes):
+        node = nodes(100)
+        pool = ProviderPool([closed_port_url(), node.url], [1, 10])
+
+        results = batch_request(Web3(pool), [("eth_blockNumber", []), ("eth_call", call_params(101))])
+
+        assert results[0] == hex(100)
+        assert isinstance(results[1], ValueError)
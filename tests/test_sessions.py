@@ -0,0 +1,75 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.sessions import http_session
+
+from rpc_node import StandInNode
+
+
+@pytest.fixture()
+def node() -> StandInNode:
+    node = StandInNode()
+    node.handlers["eth_blockNumber"] = lambda params: hex(100)
+    node.handlers["eth_chainId"] = lambda params: time.sleep(0.5) or hex(1)
+    node.start()
+    yield node
+    node.stop()
+
+
+def request_count(host: str) -> float:
+    return REGISTRY.get_sample_value("chief_http_request_seconds_count", {"host": host}) or 0
+
+
+class TestHttpSession:
+    def test_reuses_connection(self, node):
+        web3 = Web3(HTTPProvider(node.url, {"timeout": (1, 5)}, session=http_session(pool_size=2)))
+
+        for _ in range(5):
+            assert web3.eth.blockNumber == 100
+
+        assert node.round_trips == 5
+        assert node.connections == 1
+
+    def test_records_latency_by_host(self, node):
+        before = request_count("127.0.0.1")
+        web3 = Web3(HTTPProvider(node.url, {"timeout": (1, 5)}, session=http_session()))
+
+        web3.eth.blockNumber
+        web3.eth.blockNumber
+
+        assert request_count("127.0.0.1") == before + 2
+
+    def test_read_timeout_is_separate(self, node):
+        web3 = Web3(HTTPProvider(node.url, {"timeout": (5, 0.1)}, session=http_session()))
+
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            web3.eth.chainId
+
+    def test_http2_requires_httpx(self):
+        pytest.importorskip("httpx")
+
+        session = http_session(http2=True)
+        assert session.get_adapter("https://example.com").client is not None
+        session.close()
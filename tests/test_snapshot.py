@@ -0,0 +1,111 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from chief_keeper.database import SimpleDatabase
+from chief_keeper.snapshot import SnapshotError, read_snapshot, write_snapshot
+from chief_keeper.storage import SQLiteStore, TinyDBStore
+
+YAYS = ["0x0000000000000000000000000000000000000000", "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"]
+SPELL = "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"
+SLATE = "0x" + "ab" * 32
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+
+
+@pytest.fixture()
+def snapshot(tmp_path) -> str:
+    store = TinyDBStore(str(tmp_path / "db_mainnet.json"))
+    store.initialize(303, YAYS, {SPELL: 1600000000.0}, 305, {SLATE: YAYS})
+    store.set_block_hashes({304: "0x01", 305: "0x02"})
+
+    path = str(tmp_path / "snapshot.json")
+    write_snapshot(store, path, "mainnet", CHIEF)
+    return path
+
+
+class TestSnapshot:
+
+    def test_round_trip(self, snapshot):
+        state = read_snapshot(snapshot, "mainnet", CHIEF.lower())
+
+        assert state["last_block"] == 303
+        assert state["yays"] == YAYS
+        assert state["etas"] == {SPELL: 1600000000.0}
+        assert state["etas_block"] == 305
+        assert state["slates"] == {SLATE: YAYS}
+        assert state["block_hashes"] == {304: "0x01", 305: "0x02"}
+
+    def test_rejects_other_network_or_chief(self, snapshot):
+        with pytest.raises(SnapshotError):
+            read_snapshot(snapshot, "kovan", CHIEF)
+        with pytest.raises(SnapshotError):
+            read_snapshot(snapshot, "mainnet", SPELL)
+
+    def test_rejects_tampered_state(self, snapshot):
+        with open(snapshot) as f:
+            content = json.load(f)
+        content["state"]["yays"].append(SPELL)
+        with open(snapshot, "w") as f:
+            json.dump(content, f)
+
+        with pytest.raises(SnapshotError):
+            read_snapshot(snapshot, "mainnet", CHIEF)
+
+    def test_rejects_other_version(self, snapshot):
+        with open(snapshot) as f:
+            content = json.load(f)
+        content["version"] += 1
+        with open(snapshot, "w") as f:
+            json.dump(content, f)
+
+        with pytest.raises(SnapshotError):
+            read_snapshot(snapshot, "mainnet", CHIEF)
+
+
+class TestCreateFromSnapshot:
+
+    def database_for(self, snapshot: str, store) -> SimpleDatabase:
+        deployment = SimpleNamespace(ds_chief=SimpleNamespace(address=SimpleNamespace(address=CHIEF)))
+        database = SimpleDatabase(None, 0, "mainnet", deployment, snapshot=snapshot)
+        database.store = store
+        return database
+
+    @pytest.mark.parametrize("backend", ["tinydb", "sqlite"])
+    def test_initializes_store(self, snapshot, tmp_path, backend):
+        store = TinyDBStore(str(tmp_path / "db_new.json")) if backend == "tinydb" else SQLiteStore(str(tmp_path / "db_new.sqlite"))
+        database = self.database_for(snapshot, store)
+
+        assert database.create_from_snapshot()
+        database.load()
+
+        assert database.last_block == 303
+        assert database.get_db_yays() == YAYS
+        assert database.get_db_etas() == {SPELL: 1600000000.0}
+        assert database.slates == {SLATE: YAYS}
+        assert store.get_block_hashes() == {304: "0x01", 305: "0x02"}
+
+    def test_falls_back_without_usable_snapshot(self, tmp_path):
+        store = TinyDBStore(str(tmp_path / "db_new.json"))
+
+        assert not self.database_for(str(tmp_path / "missing.json"), store).create_from_snapshot()
+        assert not self.database_for(None, store).create_from_snapshot()
+        assert not store.exists()
@@ -0,0 +1,159 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+
+import pytest
+
+from web3 import Web3, HTTPProvider
+
+from chief_keeper.context import BlockContext
+from chief_keeper.pause import PauseNotes, get_pause_notes
+from chief_keeper.spell_cache import SpellCache
+
+from rpc_node import FakePause, StandInNode
+
+PAUSE = "0xbE286431454714F511008713973d3B053A2d38f3"
+SPELL = "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"
+OTHER_SPELL = Web3.toChecksumAddress("0xf267b4e8a7f7a1bc6fc3e1e8e1e5e3b0ba5c4c1d")
+ACTION = Web3.toChecksumAddress("0x1b1da62c0dc7a7af1c3e7e0b7c0b5e0b5f0bd4e6")
+EOA = "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"
+
+
+@pytest.fixture()
+def pause() -> FakePause:
+    node = StandInNode()
+    pause = FakePause(node, PAUSE, block=100)
+    pause.deploy(SPELL, ACTION)
+    pause.deploy(OTHER_SPELL, ACTION)
+    node.start()
+    yield pause
+    node.stop()
+
+
+@pytest.fixture()
+def cache_path(tmp_path) -> str:
+    return str(tmp_path / "db_testnet.spells.json")
+
+
+def read_all(pause: FakePause, cache: SpellCache) -> tuple:
+    context = BlockContext(Web3(HTTPProvider(pause.node.url)), pause.block, spell_cache=cache)
+    return (context.is_contract(EOA), context.is_contract(SPELL), context.done(SPELL), context.eta(SPELL),
+            context.done(OTHER_SPELL))
+
+
+class TestSpellCache:
+
+    def test_parses_pause_notes(self, pause):
+        pause.plot(SPELL, 1600000000)
+        pause.mine()
+        pause.exec(SPELL)
+
+        notes = get_pause_notes(Web3(HTTPProvider(pause.node.url)), PAUSE, 0, pause.block)
+
+        assert [(note.action, note.guy, note.usr, note.eta, note.block_number) for note in notes] == [
+            ("plot", SPELL, ACTION, 1600000000, 100),
+            ("exec", SPELL, ACTION, 1600000000, 101),
+        ]
+
+    def test_settled_and_unchanged_entries_are_not_read_again(self, pause, cache_path):
+        cache = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        cache.load(pause.block)
+        assert read_all(pause, cache) == (False, True, False, 0, False)
+
+        pause.mine()
+        pause.node.reset_counters()
+        assert read_all(pause, cache) == (False, True, False, 0, False)
+
+        assert pause.node.calls["eth_getCode"] == 0
+        assert pause.node.calls["eth_call"] == 0
+        assert pause.node.calls["eth_getLogs"] == 1
+
+    def test_plot_and_exec_invalidate_the_spell(self, pause, cache_path):
+        cache = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        cache.load(pause.block)
+        read_all(pause, cache)
+
+        pause.mine()
+        pause.plot(SPELL, 1600000000)
+        assert read_all(pause, cache) == (False, True, False, 1600000000, False)
+
+        pause.mine()
+        pause.exec(SPELL)
+        assert read_all(pause, cache) == (False, True, True, 1600000000, False)
+
+        # A done spell is settled, so later notes don't cause it to be read again
+        pause.mine()
+        pause.plot(SPELL, 1700000000)
+        pause.node.reset_counters()
+        read_all(pause, cache)
+        assert pause.node.calls["eth_call"] == 0
+
+    def test_drop_invalidates_unsettled_spells(self, pause, cache_path):
+        cache = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        cache.load(pause.block)
+        read_all(pause, cache)
+
+        pause.mine()
+        pause.drop(OTHER_SPELL, guy=SPELL)
+        pause.node.reset_counters()
+        read_all(pause, cache)
+
+        assert pause.node.calls["eth_call"] == 3
+        assert pause.node.calls["eth_getCode"] == 0
+
+    def test_survives_restarts(self, pause, cache_path):
+        cache = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        cache.load(pause.block)
+        read_all(pause, cache)
+        cache.save()
+
+        # Notes logged while the keeper was down are applied on the first sync after the restart
+        pause.mine()
+        pause.plot(SPELL, 1600000000)
+        pause.mine()
+
+        restarted = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        restarted.load(pause.block)
+        pause.node.reset_counters()
+
+        assert read_all(pause, restarted) == (False, True, False, 1600000000, False)
+        assert pause.node.calls["eth_call"] == 2
+        assert pause.node.calls["eth_getCode"] == 0
+
+    def test_quiet_blocks_only_move_the_block(self, pause, cache_path):
+        cache = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        cache.load(pause.block)
+        read_all(pause, cache)
+        cache.save()
+        written = os.stat(cache_path).st_mtime_ns
+
+        for _ in range(3):
+            pause.mine()
+            read_all(pause, cache)
+            cache.save()
+
+        assert os.stat(cache_path).st_mtime_ns == written
+        with open(cache_path) as f:
+            assert json.load(f)["block"] == 100
+
+        restarted = SpellCache(cache_path, PauseNotes(Web3(HTTPProvider(pause.node.url)), PAUSE))
+        restarted.load(pause.block)
+        assert restarted.block == 103
+        assert restarted.entries == cache.entries
@@ -0,0 +1,343 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.database import SimpleDatabase
+from chief_keeper.storage import SQLiteStore, TinyDBStore, migrate
+
+from pymaker import Address
+from pymaker.governance import DSChief
+
+from rpc_node import FakeChief, StandInNode
+
+YAYS = ["0x0000000000000000000000000000000000000000", "0x50FF810797f75f6bfbf2227442e0c961a8562F4C"]
+SPELL = "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"
+SLATE = "0x" + "ab" * 32
+CHIEF = "0x0a3f6849f78076aefaDf113F5BED87720274dDC0"
+
+
+@pytest.fixture(params=["tinydb", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "tinydb":
+        store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+    else:
+        store = SQLiteStore(str(tmp_path / "db_testnet.sqlite"))
+
+    assert not store.exists()
+    store.initialize(100, YAYS, {})
+    assert store.exists()
+    yield store
+    store.close()
+
+
+class TestStore:
+
+    def test_initialize(self, store):
+        assert store.get_last_block() == 100
+        assert store.get_yays() == YAYS
+        assert store.get_etas() == {}
+        assert store.get_etas_block() is None
+        assert store.get_slates() == {}
+
+    def test_add_slates_keeps_first_unpacking(self, store):
+        store.add_slates({SLATE: YAYS})
+        store.add_slates({SLATE: [SPELL]})
+
+        assert store.get_slates() == {SLATE: YAYS}
+
+    def test_etas_block(self, store):
+        with store.transaction():
+            store.set_etas({SPELL: 1600000000.0})
+            store.set_etas_block(110)
+
+        assert store.get_etas_block() == 110
+
+    def test_add_yays_keeps_order_and_drops_duplicates(self, store):
+        store.add_yays([SPELL, YAYS[0]])
+
+        assert store.get_yays() == YAYS + [SPELL]
+
+    def test_remove_yays(self, store):
+        store.add_yays([SPELL])
+        store.remove_yays([YAYS[1]])
+
+        assert store.get_yays() == [YAYS[0], SPELL]
+
+    def test_block_hashes(self, store):
+        assert store.get_block_hashes() == {}
+
+        store.set_block_hashes({100: "0x01", 101: "0x02"})
+        store.set_block_hashes({101: "0x03"})
+
+        assert store.get_block_hashes() == {101: "0x03"}
+
+    def test_transaction_commits_together(self, store):
+        with store.transaction():
+            store.add_yays([SPELL])
+            store.set_last_block(110)
+            store.set_etas({SPELL: 1600000000.0})
+
+            # Writes are visible inside the transaction
+            assert store.get_last_block() == 110
+
+        assert store.get_last_block() == 110
+        assert store.get_yays() == YAYS + [SPELL]
+        assert store.get_etas() == {SPELL: 1600000000.0}
+
+    def test_transaction_rolls_back(self, store):
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                store.add_yays([SPELL])
+                store.set_last_block(110)
+                raise RuntimeError("crash mid-block")
+
+        assert store.get_last_block() == 100
+        assert store.get_yays() == YAYS
+
+    def test_nested_transaction_commits_with_outermost(self, store):
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                with store.transaction():
+                    store.set_last_block(110)
+                raise RuntimeError("crash mid-block")
+
+        assert store.get_last_block() == 100
+
+
+class TestTinyDBStore:
+
+    def test_keeps_original_layout(self, tmp_path):
+        path = str(tmp_path / "db_testnet.json")
+        store = TinyDBStore(path)
+        store.initialize(303, YAYS, {SPELL: 1600000000.0})
+
+        with open(path) as f:
+            assert json.load(f) == {"_default": {
+                "1": {"last_block_checked_for_yays": 303},
+                "2": {"yays": YAYS},
+                "3": {"upcoming_etas": {SPELL: 1600000000.0}, "last_block_checked_for_etas": None},
+                "4": {"slates": {}},
+            }}
+        assert store.db.get(doc_id=2)["yays"] == YAYS
+
+    def test_adds_slates_to_older_databases(self, tmp_path):
+        path = str(tmp_path / "db_testnet.json")
+        with open(path, "w") as f:
+            json.dump({"_default": {
+                "1": {"last_block_checked_for_yays": 303},
+                "2": {"yays": YAYS},
+                "3": {"upcoming_etas": {}},
+            }}, f)
+
+        store = TinyDBStore(path)
+        store.open()
+        store.add_slates({SLATE: YAYS})
+
+        assert store.get_yays() == YAYS
+        assert store.get_slates() == {SLATE: YAYS}
+
+    def test_transaction_rewrites_file_once(self, tmp_path, monkeypatch):
+        store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+        store.initialize(100, YAYS, {})
+        writes = []
+        monkeypatch.setattr(store.db._storage, "write", lambda data, write=store.db._storage.write: writes.append(write(data)))
+
+        with store.transaction():
+            store.add_yays([SPELL])
+            store.set_last_block(110)
+            store.set_etas({SPELL: 1600000000.0})
+
+        assert len(writes) == 1
+
+    def test_positions_are_written_on_their_own(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "db_testnet.json")
+        store = TinyDBStore(path)
+        store.initialize(100, YAYS, {})
+        writes = []
+        monkeypatch.setattr(store.db._storage, "write", lambda data, write=store.db._storage.write: writes.append(write(data)))
+
+        with store.transaction():
+            store.set_last_block(110)
+            store.set_etas_block(110)
+            store.set_block_hashes({110: "0x01"})
+
+        assert writes == []
+        reopened = TinyDBStore(path)
+        reopened.open()
+        assert (reopened.get_last_block(), reopened.get_etas_block(), reopened.get_block_hashes()) == (110, 110, {110: "0x01"})
+
+        # The next rewrite of the database takes the positions back in
+        store.add_yays([SPELL])
+        assert len(writes) == 1
+        assert not os.path.exists(store.positions_path)
+        with open(path) as f:
+            assert json.load(f)["_default"]["1"] == {"last_block_checked_for_yays": 110,
+                                                     "recent_block_hashes": {"110": "0x01"}}
+
+
+class TestMigration:
+
+    def test_migrates_json_database(self, tmp_path):
+        json_path, sqlite_path = str(tmp_path / "db_testnet.json"), str(tmp_path / "db_testnet.sqlite")
+        TinyDBStore(json_path).initialize(303, YAYS + [SPELL], {SPELL: 1600000000.0}, 305, {SLATE: YAYS})
+
+        migrate(json_path, sqlite_path)
+
+        store = SQLiteStore(sqlite_path)
+        assert store.exists()
+        store.open()
+        assert store.get_last_block() == 303
+        assert store.get_yays() == YAYS + [SPELL]
+        assert store.get_etas() == {SPELL: 1600000000.0}
+        assert store.get_etas_block() == 305
+        assert store.get_slates() == {SLATE: YAYS}
+
+    def test_leaves_older_json_database_untouched(self, tmp_path):
+        json_path, sqlite_path = str(tmp_path / "db_testnet.json"), str(tmp_path / "db_testnet.sqlite")
+        with open(json_path, "w") as f:
+            json.dump({"_default": {"1": {"last_block_checked_for_yays": 303}, "2": {"yays": YAYS},
+                                    "3": {"upcoming_etas": {}, "last_block_checked_for_etas": 303}}}, f)
+        with open(json_path, "rb") as f:
+            before = f.read()
+
+        migrate(json_path, sqlite_path)
+
+        with open(json_path, "rb") as f:
+            assert f.read() == before
+        store = SQLiteStore(sqlite_path)
+        store.open()
+        assert store.get_yays() == YAYS
+        assert store.get_slates() == {}
+
+    def test_refuses_to_overwrite(self, tmp_path):
+        json_path, sqlite_path = str(tmp_path / "db_testnet.json"), str(tmp_path / "db_testnet.sqlite")
+        TinyDBStore(json_path).initialize(303, YAYS, {})
+        migrate(json_path, sqlite_path)
+
+        with pytest.raises(FileExistsError):
+            migrate(json_path, sqlite_path)
+
+
+class TestWriteBehind:
+
+    @pytest.fixture()
+    def memorydb(self, tmp_path):
+        database = SimpleDatabase(None, 0, "testnet", None)
+        database.store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+        database.store.initialize(100, ["0x0000000000000000000000000000000000000000"], {})
+        database.load()
+        database.get_yays = lambda begin, end: ["0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"]
+        return database
+
+    def test_block_changes_are_written_once(self, memorydb):
+        writes = []
+        storage = memorydb.db._storage
+        storage.write = lambda data, write=storage.write: writes.append(write(data))
+
+        with memorydb.transaction():
+            memorydb.update_db_yays(110)
+            memorydb.set_db_etas({"0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1": 1600000000.0})
+
+            # Reads are served from memory before the block is written back
+            assert "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1" in memorydb.get_db_yays()
+            assert writes == []
+
+        assert len(writes) == 1
+        assert memorydb.db.get(doc_id=1)["last_block_checked_for_yays"] == 110
+        assert memorydb.db.get(doc_id=2)["yays"] == ["0x0000000000000000000000000000000000000000",
+                                                     "0x57Da1B8F38A5eCF91E9FEe8a047DF0F0A88716A1"]
+
+    def test_failed_block_is_rolled_back(self, memorydb):
+        with pytest.raises(RuntimeError):
+            with memorydb.transaction():
+                memorydb.update_db_yays(110)
+                raise RuntimeError("crash mid-block")
+
+        assert memorydb.last_block == 100
+        assert memorydb.get_db_yays() == ["0x0000000000000000000000000000000000000000"]
+        assert memorydb.db.get(doc_id=1)["last_block_checked_for_yays"] == 100
+
+    def test_flush_interval_defers_writes_until_close(self, memorydb):
+        memorydb.flush_interval = 3600
+        memorydb.load()
+
+        memorydb.update_db_yays(110)
+        assert memorydb.db.get(doc_id=1)["last_block_checked_for_yays"] == 100
+
+        memorydb.close()
+        assert memorydb.store.get_last_block() == 110
+
+
+class TestSlateCache:
+
+    @pytest.fixture()
+    def chief(self) -> FakeChief:
+        node = StandInNode()
+        chief = FakeChief(node, CHIEF, max_yays=5)
+        node.start()
+        yield chief
+        node.stop()
+
+    def database_for(self, chief: FakeChief, tmp_path, **kwargs) -> SimpleDatabase:
+        web3 = Web3(HTTPProvider(chief.node.url))
+        database = SimpleDatabase(web3, 0, "testnet", SimpleNamespace(ds_chief=DSChief(web3, Address(CHIEF))), **kwargs)
+        database.store = TinyDBStore(str(tmp_path / "db_testnet.json"))
+        if not database.store.exists():
+            database.store.initialize(100, [], {})
+        else:
+            database.store.open()
+        database.load()
+        return database
+
+    def test_unpacks_slate_in_one_batch(self, chief: FakeChief, tmp_path):
+        slate = chief.etch([SPELL, YAYS[1]])
+        database = self.database_for(chief, tmp_path)
+        chief.node.reset_counters()
+
+        assert database.get_slate_yays(slate) == [SPELL, YAYS[1]]
+        assert database.get_slate_yays(slate) == [SPELL, YAYS[1]]
+        # MAX_YAYS once, then every index of the slate in a single batch
+        assert chief.node.round_trips == 2
+        assert chief.node.calls["eth_call"] == 6
+
+    def test_unpacks_slate_one_yay_at_a_time_without_batches(self, chief: FakeChief, tmp_path):
+        slate = chief.etch([SPELL, YAYS[1]])
+        database = self.database_for(chief, tmp_path)
+        database.batching = False
+        chief.node.reset_counters()
+
+        assert database.get_slate_yays(slate) == [SPELL, YAYS[1]]
+        assert chief.node.calls["eth_call"] == 4
+
+    def test_unpacked_slates_survive_restarts(self, chief: FakeChief, tmp_path):
+        slate = chief.etch([SPELL])
+        database = self.database_for(chief, tmp_path)
+        database.get_slate_yays(slate)
+        database.close()
+
+        database = self.database_for(chief, tmp_path)
+        chief.node.reset_counters()
+
+        assert database.get_slate_yays(slate) == [SPELL]
+        assert chief.node.calls["eth_call"] == 0
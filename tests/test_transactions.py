@@ -0,0 +1,218 @@
+# This file is part of Maker Keeper Framework.
+#
+# Copyright (C) 2019 KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from web3 import HTTPProvider, Web3
+
+from chief_keeper.transactions import NonceManager, TransactionPipeline
+
+from rpc_node import StandInNode
+
+ACCOUNT = Web3.toChecksumAddress("0x00000000000000000000000000000000000000aa")
+SPELL = Web3.toChecksumAddress("0x00000000000000000000000000000000000000bb")
+CAST_ABI = [{"type": "function", "name": "cast", "inputs": [], "outputs": [], "stateMutability": "nonpayable"}]
+
+
+class Target:
+    def __init__(self, address: str):
+        self.address = address
+
+
+class Receipt:
+    def __init__(self, successful: bool):
+        self.successful = successful
+
+
+class FakeTransact:
+    """Stands in for a pymaker Transact, sending on the thread's event loop like `transact()` does"""
+
+    def __init__(self, release: threading.Event = None, fail: bool = False):
+        self.release = release
+        self.fail = fail
+        self.nonce = None
+        self.gas_strategy = None
+        self.contract = Web3().eth.contract(abi=CAST_ABI)
+        self.function_name = "cast"
+        self.parameters = []
+        self.address = Target(SPELL)
+        self.sent = False
+
+    def transact(self, gas_strategy=None):
+        self.gas_strategy = gas_strategy
+        self.sent = True
+
+        async def send():
+            if self.release is not None:
+                self.release.wait(5)
+            if self.fail:
+                raise ValueError("nonce too low")
+            return Receipt(True)
+
+        return asyncio.get_event_loop().run_until_complete(send())
+
+
+@pytest.fixture()
+def node() -> StandInNode:
+    node = StandInNode()
+    node.transaction_count = 7
+    node.handlers["eth_getTransactionCount"] = lambda params: hex(node.transaction_count)
+    node.start()
+    yield node
+    node.stop()
+
+
+@pytest.fixture()
+def pipeline(node) -> TransactionPipeline:
+    pipeline = TransactionPipeline(Web3(HTTPProvider(node.url)), ACCOUNT, max_pending=4)
+    yield pipeline
+    pipeline.stop()
+
+
+class TestNonceManager:
+    def test_reserves_consecutive_nonces(self, node):
+        nonces = NonceManager(Web3(HTTPProvider(node.url)), ACCOUNT)
+
+        assert [nonces.reserve() for _ in range(3)] == [7, 8, 9]
+
+    def test_release_reuses_last_nonce_and_resyncs_otherwise(self, node):
+        nonces = NonceManager(Web3(HTTPProvider(node.url)), ACCOUNT)
+        first, second = nonces.reserve(), nonces.reserve()
+
+        nonces.release(second)
+        assert nonces.reserve() == second
+
+        nonces.release(first)
+        node.transaction_count = 8
+        assert nonces.reserve() == 8
+
+    def test_follows_transactions_sent_elsewhere(self, node):
+        nonces = NonceManager(Web3(HTTPProvider(node.url)), ACCOUNT)
+        nonces.reserve()
+
+        node.transaction_count = 12
+        assert nonces.reserve() == 12
+
+
+class TestTransactionPipeline:
+    def test_submit_returns_before_inclusion(self, pipeline):
+        release = threading.Event()
+        transact = FakeTransact(release)
+
+        started = time.perf_counter()
+        assert pipeline.submit(("cast", "0xspell"), lambda: transact, lambda: "strategy")
+        assert time.perf_counter() - started < 1
+        assert pipeline.is_pending(("cast", "0xspell"))
+
+        release.set()
+        assert pipeline.wait(5)
+        assert transact.gas_strategy == "strategy"
+        assert pipeline.pop_finished()[("cast", "0xspell")].successful
+
+    def test_deduplicates_pending_intent(self, pipeline):
+        release = threading.Event()
+        built = []
+
+        def build():
+            built.append(FakeTransact(release))
+            return built[-1]
+
+        assert pipeline.submit(("lift", "0xspell"), build, lambda: None)
+        assert not pipeline.submit(("lift", "0xspell"), build, lambda: None)
+        assert REGISTRY.get_sample_value("chief_transactions_deduplicated_total", {"action": "lift"}) >= 1
+
+        release.set()
+        pipeline.wait(5)
+        assert len(built) == 1
+
+        assert pipeline.submit(("lift", "0xspell"), build, lambda: None)
+        pipeline.wait(5)
+
+    def test_concurrent_intents_get_distinct_nonces(self, pipeline):
+        release = threading.Event()
+        transacts = [FakeTransact(release) for _ in range(3)]
+
+        for i, transact in enumerate(transacts):
+            pipeline.submit(("cast", i), lambda transact=transact: transact, lambda: None)
+
+        release.set()
+        pipeline.wait(5)
+        assert [transact.nonce for transact in transacts] == [7, 8, 9]
+
+    def test_failure_reports_no_receipt(self, pipeline):
+        outcomes = []
+        before = REGISTRY.get_sample_value("chief_transaction_inclusion_seconds_count", {"action": "schedule"}) or 0
+
+        pipeline.submit(("schedule", "0xspell"), lambda: FakeTransact(fail=True), lambda: None, outcomes.append)
+        pipeline.wait(5)
+
+        assert outcomes == [None]
+        assert pipeline.pop_finished() == {("schedule", "0xspell"): None}
+        assert pipeline.nonces.reserve() == 7
+        assert (REGISTRY.get_sample_value("chief_transaction_inclusion_seconds_count", {"action": "schedule"}) or 0) == before
+
+    def test_records_time_to_inclusion(self, pipeline):
+        before = REGISTRY.get_sample_value("chief_transaction_inclusion_seconds_count", {"action": "cast"}) or 0
+
+        pipeline.submit(("cast", "0xspell"), lambda: FakeTransact(), lambda: None)
+        pipeline.wait(5)
+
+        assert REGISTRY.get_sample_value("chief_transaction_inclusion_seconds_count", {"action": "cast"}) == before + 1
+
+
+class TestTransactionSimulator:
+    def simulated(self, outcome: str) -> float:
+        return REGISTRY.get_sample_value("chief_transactions_simulated_total", {"action": "cast", "outcome": outcome}) or 0
+
+    def test_skips_transaction_that_would_revert(self, node, pipeline):
+        transact = FakeTransact()
+        gas_strategies = []
+        before = self.simulated("revert")
+
+        assert not pipeline.submit(("cast", SPELL), lambda: transact, lambda: gas_strategies.append(1), block_number=10)
+
+        assert not transact.sent
+        assert gas_strategies == []
+        assert not pipeline.is_pending(("cast", SPELL))
+        assert pipeline.pop_finished() == {}
+        assert node.calls["eth_call"] == 1
+        assert self.simulated("revert") == before + 1
+
+    def test_simulates_once_per_block(self, node, pipeline):
+        for _ in range(3):
+            pipeline.submit(("cast", SPELL), lambda: FakeTransact(), lambda: None, block_number=10)
+        assert node.calls["eth_call"] == 1
+
+        pipeline.submit(("cast", SPELL), lambda: FakeTransact(), lambda: None, block_number=11)
+        assert node.calls["eth_call"] == 2
+
+    def test_sends_transaction_that_would_succeed(self, node, pipeline):
+        node.add_contract(SPELL, {"cast()": lambda block: ("bool", True)})
+        transact = FakeTransact()
+        before = self.simulated("ok")
+
+        assert pipeline.submit(("cast", SPELL), lambda: transact, lambda: None, block_number=10)
+        pipeline.wait(5)
+
+        assert transact.sent
+        assert node.call_blocks == ["pending"]
+        assert self.simulated("ok") == before + 1